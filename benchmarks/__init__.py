@@ -0,0 +1 @@
+"""Замеры производительности и эталонные реализации для сравнения вывода."""
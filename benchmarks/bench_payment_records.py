@@ -0,0 +1,125 @@
+"""Замер памяти выплат в VK боте: PaymentRecord/PaymentData против прежних вложенных dict.
+
+Запуск из корня репозитория (нужны зависимости main_bot_VK):
+    python -m benchmarks.bench_payment_records [--rows 10000] [--curators 1000]
+
+Строит --rows выплат из синтетических строк ведомостей куратора (как после чтения CSV:
+каждая строка - новые объекты str), считает прирост памяти через tracemalloc и проверяет,
+что данные в обоих представлениях совпадают. Код выхода 1 при расхождении.
+"""
+
+import argparse
+import gc
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+
+import main_bot_VK as vk
+
+COLUMNS = [
+    'phone', 'console', 'type', 'name', 'vk_id', 'email', 'groups', 'stud_all', 'stud_rep', 'base', 'stud_salary',
+    'slivs', 'rr', 'rr_salary', 'okk', 'okk_salary', 'kpi_total', 'checks_all', 'checks_prev', 'checks_salary',
+    'dop_checks', 'up', 'webs', 'chats', 'callsg', 'callsp', 'meth', 'dop_sk', 'fines', 'total',
+]
+MONEY_VALUES = ['', '0', '22', '35', '210', '4720.0', '970.2', '1386', '55.0']
+
+
+def _fresh(value: str) -> str:
+    # Отдельный объект строки, как у значений, разобранных из файла
+    return ''.join(list(value))
+
+
+def statement_rows(count: int, curators: int, seed: int = 26) -> list:
+    """[(vk_id, строка, имя файла)]: у каждого куратора выплаты из нескольких ведомостей."""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        c = i % curators
+        values = [f'7900{c:07d}', f'Куратор Кураторович {c}', 'Личный куратор', f'Куратор Кураторович {c}',
+                  str(100000000 + c), f'c{c}@mail.ru', f'Аня Колотович | Группа {c % 7}']
+        values += [rng.choice(MONEY_VALUES) for _ in COLUMNS[len(values):]]
+        rows.append((100000000 + c, {k: _fresh(v) for k, v in zip(COLUMNS, values)},
+                     _fresh(f'Русский_ОГЭ_ПГК_{i % 20}.csv')))
+    return rows
+
+
+def reference_payment_data(row: dict, vk_id, original_filename: str) -> dict:
+    """Данные выплаты в прежнем виде: dict со всеми полями, строки не интернированы."""
+    def pick(*keys):
+        for k in keys:
+            value = row.get(k)
+            if value is not None and value == value:
+                return str(value)
+        return ''
+    data = {
+        'fio': pick('ФИО', 'fio', 'name', 'full_name', 'FIO'),
+        'phone': pick('Телефон', 'phone', 'Phone', 'telephone'),
+        'console': pick('console', 'Console'),
+        'curator': pick('Куратор', 'curator', 'manager', 'curator_name'),
+        'vk_id': str(vk_id),
+        'mail': pick('Почта', 'mail', 'email', 'Email'),
+        'groups': pick('Группы', 'groups', 'group', 'groups_list'),
+    }
+    for k in vk.PAYMENT_MONEY_FIELDS:
+        data[k] = pick(k, k.capitalize(), k.upper(), k.replace('_', ' ').capitalize())
+    data['total'] = data.get('total') or pick('Итого', 'Total', 'total')
+    data['total_amount'] = vk.payment_render.parse_amount(data['total'])
+    data['original_filename'] = original_filename
+    return data
+
+
+def reference_record(vk_id, row: dict, original_filename: str) -> dict:
+    data = reference_payment_data(row, vk_id, original_filename)
+    data['is_repet'] = False
+    return {'id': str(uuid.uuid4()), 'data': data, 'created_at': time.time(), 'status': 'new'}
+
+
+def current_record(vk_id, row: dict, original_filename: str):
+    data = vk._map_row_to_payment_data(row, vk_id, original_filename)
+    data['is_repet'] = False
+    return vk.PaymentRecord(id=str(uuid.uuid4()), data=data, created_at=time.time(), status='new')
+
+
+def measure(build, rows: list):
+    """(байт на выплату, секунд на построение, выплаты)."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    records = [build(vk_id, row, filename) for vk_id, row, filename in rows]
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / len(rows), elapsed, records
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--curators', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    # Строки ведомостей строятся для каждого замера заново: их память в замер не входит,
+    # а интернирование в текущем коде не должно опираться на объекты прошлого прогона
+    old_bytes, old_time, old_records = measure(reference_record, statement_rows(args.rows, args.curators))
+    new_bytes, new_time, new_records = measure(current_record, statement_rows(args.rows, args.curators))
+
+    mismatches = [
+        (i, key) for i, (old, new) in enumerate(zip(old_records, new_records))
+        for key in set(old['data']) | set(new['data'].keys())
+        if old['data'].get(key) != new['data'].get(key)
+    ]
+    print(f'{args.rows} payments, {args.curators} curators, {len(vk._payment_shapes)} shapes cached')
+    print(f'  reference: {old_bytes:.0f} B/payment, {old_time:.2f}s')
+    print(f'  current:   {new_bytes:.0f} B/payment, {new_time:.2f}s, x{old_bytes / new_bytes:.2f} less memory')
+    print(f'  {len(mismatches)} mismatches')
+    for i, key in mismatches[:5]:
+        print(f'    payment {i} {key}: {old_records[i]["data"].get(key)!r} != {new_records[i]["data"].get(key)!r}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
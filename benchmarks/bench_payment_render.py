@@ -0,0 +1,160 @@
+"""Сравнение и замер рендера текста выплаты куратора: текущий payment_render против эталона.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_payment_render [--rows 10000] [--repeat 5]
+
+Сначала проверяет, что compose_payment_sections, разделы в оформлении ведомости
+(VK fallback) и render_payment_text совпадают с эталоном на синтетической ведомости,
+затем печатает лучшее время из --repeat прогонов. Код выхода 1 при расхождении.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import payment_render
+from benchmarks import payment_render_reference as reference
+
+FILENAME = 'Физика_ЕГЭ_1.csv'
+COLUMNS = [
+    'name', 'type', 'email', 'groups', 'stud_gk', 'stud_gkp', 'stud_all', 'stud_rep', 'rep_salary', 'base',
+    'stud_salary', 'stud_salary_gk', 'stud_salary_gkp', 'slivs_gk', 'rr_gk', 'rr_salary_gk', 'okk_gk',
+    'okk_salary_gk', 'slivs_gkp', 'rr_gkp', 'rr_salary_gkp', 'okk_gkp', 'okk_salary_gkp', 'kpi_total',
+    'checks_salary', 'dop_checks', 'up', 'chats', 'webs', 'meth', 'dop_sk', 'callsg', 'callsp', 'fines',
+    'total', 'comment',
+]
+TEXT_COLUMNS = ('name', 'type', 'email', 'groups')
+# Значения на границах разбора: пустые, NaN, '-0', запятая, проценты, пробелы, не числа
+EDGE_VALUES = ['', '0', '0.0', '5', '12', '1 500', '2500,50', '-3', '0.85', '85%', '12,5%', '1', 'abc', 'nan',
+               '-', '  7 ', '3.14159', '100000', '0,5', '-0', '-0.0', '1e3', '50%', None]
+EDGE_TEXTS = [None, '', 'Иванова А.', 'ГК', 'a@b.ru', ' Г1, Г2 ']
+EDGE_COMMENTS = [None, '', '0', '-', 'нет', 'Проверьте сумму', '  доплата за март  ', '—', '0.00']
+
+
+def edge_row(rng: random.Random, dense: bool) -> dict:
+    """Строка со случайными граничными значениями; часть столбцов отсутствует."""
+    row = {}
+    for column in COLUMNS:
+        if rng.random() < (0.05 if dense else 0.3):
+            continue
+        if column == 'comment':
+            row[column] = rng.choice(EDGE_COMMENTS)
+        elif column in TEXT_COLUMNS:
+            row[column] = rng.choice(EDGE_TEXTS)
+        else:
+            row[column] = rng.choice(EDGE_VALUES) if rng.random() < 0.6 else rng.choice([None, '0'])
+    return row
+
+
+def realistic_row(rng: random.Random) -> dict:
+    """Строка, похожая на настоящую ведомость: денежные значения почти все разные."""
+    row = {column: '0' for column in COLUMNS}
+    row.update(
+        name=f'Куратор {rng.randint(1, 10 ** 6)}', type='ГК', email=f'c{rng.randint(1, 10 ** 6)}@x.ru',
+        groups=f'Г{rng.randint(1, 300)}', stud_gk=str(rng.randint(0, 60)), base=rng.choice(['250', '300', '350']),
+        stud_salary_gk=str(rng.randint(0, 20000)), rr_gk=f'0,{rng.randint(50, 99):02d}',
+        rr_salary_gk=f'{rng.randint(0, 5000)},{rng.randint(0, 99):02d}', okk_gk=f'{rng.randint(60, 100)}%',
+        okk_salary_gk=str(rng.randint(0, 5000)), checks_salary=str(rng.randint(0, 3000)),
+        up=str(rng.choice([0, 0, 500, 1000])), fines=str(rng.choice([0, 0, 0, 200])),
+        total=f'{rng.randint(1000, 50000)}.{rng.randint(0, 99):02d}',
+        comment=rng.choice(['', '', f'Проверьте сумму {rng.randint(1, 99)}']),
+    )
+    return row
+
+
+def edge_rows(count: int, seed: int = 49) -> list:
+    rng = random.Random(seed)
+    return [edge_row(rng, i % 2 == 0) for i in range(count)]
+
+
+def realistic_rows(count: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    return [realistic_row(rng) for _ in range(count)]
+
+
+def reference_statement_sections(p: dict) -> list:
+    """Разделы в оформлении ведомости (в порядке вывода) так, как их раньше собирал VK fallback поверх эталона."""
+    sections = reference.compose_payment_sections(p)
+    result = []
+    for key in ["studs", "retention", "okk", "checks", "extras", "fines", "total"]:
+        block = sections.get(key, "")
+        if not block:
+            continue
+        if key == "checks":
+            block = "\n[Проверки]" + block
+        if key == "extras" and block.startswith("\n[Иная деятельность]"):
+            block = "\n[ Иная деятельность]" + block[len("\n[Иная деятельность]"):]
+        if key == "fines" and block.startswith("\n\n→ Штрафы"):
+            block = "\n\n" + block[len("\n\n→ "):]
+        if key == "total" and block.startswith("\n\n→ ИТОГО"):
+            block = "\n\n" + block[len("\n\n→ "):]
+        result.append((key, block))
+    return result
+
+
+def statement_sections(p: dict) -> list:
+    return [(key, block) for key, block in payment_render.compose_statement_sections(p).items() if block]
+
+
+def find_mismatches(rows: list) -> list:
+    """[(имя проверки, строка, эталон, текущий вывод)] для всех расхождений."""
+    mismatches = []
+    for row in rows:
+        filled = reference.fill_missing(row, '0')
+        checks = [
+            ('compose_payment_sections', row, reference.compose_payment_sections, payment_render.compose_payment_sections),
+            ('compose_payment_sections/filled', filled, reference.compose_payment_sections,
+             payment_render.compose_payment_sections),
+            ('statement_sections/filled', filled, reference_statement_sections, statement_sections),
+        ]
+        for name, data, old, new in checks:
+            expected, actual = old(data), new(data)
+            if expected != actual:
+                mismatches.append((name, row, expected, actual))
+        expected = reference.render_payment_text(row, FILENAME)
+        actual = payment_render.render_payment_text(row, FILENAME)
+        if expected != actual:
+            mismatches.append(('render_payment_text', row, expected, actual))
+    return mismatches
+
+
+def best_time(func, rows: list, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for row in rows:
+            func(row)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    datasets = [('edge', edge_rows(args.rows)), ('realistic', realistic_rows(args.rows))]
+    failed = False
+    for label, rows in datasets:
+        mismatches = find_mismatches(rows)
+        print(f'{label}: {len(rows)} rows, {len(mismatches)} mismatches')
+        for name, row, expected, actual in mismatches[:3]:
+            print(f'  {name}: {row!r}\n    reference: {expected!r}\n    current:   {actual!r}')
+        failed = failed or bool(mismatches)
+
+        for name, old, new in [
+            ('render_payment_text',
+             lambda r: reference.render_payment_text(r, FILENAME), lambda r: payment_render.render_payment_text(r, FILENAME)),
+            ('compose_payment_sections', reference.compose_payment_sections, payment_render.compose_payment_sections),
+        ]:
+            t_old = best_time(old, rows, args.repeat)
+            t_new = best_time(new, rows, args.repeat)
+            print(f'  {name}: reference {t_old:.3f}s ({t_old / len(rows) * 1e6:.1f}us/row), '
+                  f'current {t_new:.3f}s ({t_new / len(rows) * 1e6:.1f}us/row), x{t_old / t_new:.2f}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
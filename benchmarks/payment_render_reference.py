@@ -0,0 +1,437 @@
+"""Эталон: payment_render.py до компиляции шаблона выплаты куратора в PaymentTemplate.
+
+Замороженная копия прежней реализации compose_payment_sections / render_payment_text
+для сравнения в benchmarks/bench_payment_render.py и tests/test_payment_render.py.
+Боты этот модуль не импортируют; менять его нельзя - текст должен совпадать с тем,
+что отправлялся до переписывания шаблона.
+"""
+
+import re
+
+# Версия шаблонов render_payment_text / render_repet_payment_text
+TEMPLATE_VERSION = 1
+
+
+def fill_missing(row: dict, fill: str) -> dict:
+    """Аналог fillna(): None -> fill."""
+    return {key: fill if value is None else value for key, value in row.items()}
+
+
+def to_int_safe(value) -> int:
+    try:
+        if value is None:
+            return 0
+        s = str(value).replace('\u00A0', '').replace('\xa0', '').replace(' ', '').replace(',', '.')
+        if s == '' or s.lower() == 'nan':
+            return 0
+        return int(float(s))
+    except Exception:
+        return 0
+
+
+def to_float_safe(value) -> float:
+    try:
+        if value is None:
+            return 0.0
+        s = str(value).replace('\u00A0', '').replace('\xa0', '').replace(' ', '').replace(',', '.')
+        if s == '' or s.lower() == 'nan':
+            return 0.0
+        return float(s)
+    except Exception:
+        return 0.0
+
+
+def to_float_str_money(value) -> str:
+    try:
+        if value is None:
+            return '0'
+        s = str(value).replace('\u00A0', '').replace('\xa0', '').replace(' ', '').replace(',', '.')
+        if s == '' or s.lower() == 'nan':
+            return '0'
+        return str(round(float(s), 2))
+    except Exception:
+        return '0'
+
+
+def is_meaningful_comment(comment) -> bool:
+    """Проверяет, содержит ли комментарий полезный текст (не '0', '-', 'nan' и т.п.)."""
+    if comment is None:
+        return False
+    comment_str = str(comment).strip()
+    if not comment_str:
+        return False
+    lowered = comment_str.lower()
+    meaningless_values = {
+        '0', '0.0', '0,0', 'nan', 'none', 'нет', 'no', 'none', 'пусто', 'n/a', 'н/д', '—', '-', '––'
+    }
+    if lowered in meaningless_values:
+        return False
+    if re.fullmatch(r'0+(\.0+)?', lowered):
+        return False
+    stripped = comment_str.strip('-').strip('—').strip()
+    if not stripped:
+        return False
+    return True
+
+
+def compose_payment_sections(p: dict) -> dict:
+    """Строит текстовые блоки для разных разделов выплаты."""
+    sections = {
+        "studs": "",
+        "retention": "",
+        "okk": "",
+        "checks": "",
+        "extras": "",
+        "fines": "",
+        "total": ""
+    }
+
+    def _as_money(value) -> str:
+        return to_float_str_money(value)
+
+    def _format_percent(value) -> str:
+        if value is None:
+            return ''
+        s = str(value).strip()
+        if not s or s.lower() in ('nan', 'none', '-', '—'):
+            return ''
+        try:
+            has_pct = s.endswith('%')
+            num = float(s.replace('%', '').replace(',', '.'))
+            if not has_pct and abs(num) <= 1:
+                num *= 100
+            num = round(num, 2)
+            if num.is_integer():
+                return f"{int(num)}%"
+            return f"{num}%"
+        except Exception:
+                return s
+
+    # Сопровождение ГК / ГК+
+    stud_gk = to_int_safe(p.get('stud_gk'))
+    stud_gkp = to_int_safe(p.get('stud_gkp'))
+    stud_all = to_int_safe(p.get('stud_all'))
+    stud_rep = to_int_safe(p.get('stud_rep'))
+    rep_salary = to_float_str_money(p.get('rep_salary'))
+    base_val = to_int_safe(p.get('base'))
+    stud_salary_total = to_int_safe(p.get('stud_salary'))
+    raw_stud_salary_gk = p.get('stud_salary_gk')
+    raw_stud_salary_gkp = p.get('stud_salary_gkp')
+    stud_salary_gk_val = to_int_safe(raw_stud_salary_gk)
+    stud_salary_gkp_val = to_int_safe(raw_stud_salary_gkp)
+
+    slivs_gk = to_int_safe(p.get('slivs_gk'))
+    rr_gk = _format_percent(p.get('rr_gk'))
+    rr_salary_gk = _as_money(p.get('rr_salary_gk'))
+    okk_gk = _format_percent(p.get('okk_gk'))
+    okk_salary_gk = _as_money(p.get('okk_salary_gk'))
+
+    slivs_gkp = to_int_safe(p.get('slivs_gkp'))
+    rr_gkp = _format_percent(p.get('rr_gkp'))
+    rr_salary_gkp = _as_money(p.get('rr_salary_gkp'))
+    okk_gkp = _format_percent(p.get('okk_gkp'))
+    okk_salary_gkp = _as_money(p.get('okk_salary_gkp'))
+
+    kpi_total_val = to_float_str_money(p.get('kpi_total'))
+    splitted_blocks = []
+
+    def _append_block(title: str, lines) -> None:
+        if lines:
+            splitted_blocks.append(f"\n{title}\n" + ''.join(lines) + "\n")
+
+    def _has_explicit(value) -> bool:
+        if value is None:
+            return False
+        if isinstance(value, str):
+            return value.strip() != ''
+        return True
+
+    gk_lines = []
+    if stud_gk > 0:
+        gk_lines.append(f"\nВсего учеников - ГК: {stud_gk}")
+    if base_val > 0:
+        gk_lines.append(f"\nОклад за ученика: {base_val}₽")
+    if stud_salary_gk_val > 0 or _has_explicit(raw_stud_salary_gk):
+        gk_lines.append(f"\n→ Сумма оклада: {stud_salary_gk_val}₽")
+    elif stud_salary_total > 0:
+        gk_lines.append(f"\n→ Сумма оклада: {stud_salary_total}₽")
+        if stud_rep > 0:
+            gk_lines.append(f"\nКол-во учеников с тарифом с репетитором: {stud_rep}")
+    if rep_salary != '0' and to_float_safe(rep_salary) > 0:
+        gk_lines.append(f"\nДоплата за учеников с репетитором: {rep_salary}₽")
+    if rr_gk:
+        gk_lines.append(f"\nRetention ГК: {rr_gk}")
+    if rr_salary_gk != '0':
+        gk_lines.append(f"\n→ Оплата за retention ГК: {rr_salary_gk}₽")
+    if okk_gk:
+        gk_lines.append(f"\nOKK ГК: {okk_gk}")
+    if okk_salary_gk != '0':
+        gk_lines.append(f"\n→ Оплата за OKK ГК: {okk_salary_gk}₽")
+    
+    # Calculate KPI for GK - выводим всегда, если есть хотя бы одна из строк оплаты
+    if rr_salary_gk != '0' or okk_salary_gk != '0':
+        kpi_gk = to_float_safe(rr_salary_gk) + to_float_safe(okk_salary_gk)
+        kpi_gk_str = to_float_str_money(kpi_gk)
+        gk_lines.append(f"\n→ Сумма KPI (OKK+Retention): {kpi_gk_str}₽")
+    
+    # Append block only if there are students (stud_gk > 0)
+    if stud_gk > 0:
+        _append_block('[Сопровождение ГК]', gk_lines)
+
+    gkp_lines = []
+    if stud_gkp > 0:
+        gkp_lines.append(f"\nВсего учеников - ГК+: {stud_gkp}")
+    if base_val > 0:
+        gkp_lines.append(f"\nОклад за ученика: {base_val}₽")
+    if stud_salary_gkp_val > 0 or _has_explicit(raw_stud_salary_gkp):
+        gkp_lines.append(f"\n→ Сумма оклада: {stud_salary_gkp_val}₽")
+    if rr_gkp:
+        gkp_lines.append(f"\nRetention ГК+: {rr_gkp}")
+    if rr_salary_gkp != '0':
+        gkp_lines.append(f"\n→ Оплата за retention ГК+: {rr_salary_gkp}₽")
+    if okk_gkp:
+        gkp_lines.append(f"\nOKK ГК+: {okk_gkp}")
+    if okk_salary_gkp != '0':
+        gkp_lines.append(f"\n→ Оплата за OKK ГК+: {okk_salary_gkp}₽")
+    
+    # Calculate KPI for GK+ - выводим всегда, если есть хотя бы одна из строк оплаты
+    if rr_salary_gkp != '0' or okk_salary_gkp != '0':
+        kpi_gkp = to_float_safe(rr_salary_gkp) + to_float_safe(okk_salary_gkp)
+        kpi_gkp_str = to_float_str_money(kpi_gkp)
+        gkp_lines.append(f"\n→ Сумма KPI (OKK+Retention): {kpi_gkp_str}₽")
+    
+    # Append block only if there are students (stud_gkp > 0)
+    if stud_gkp > 0:
+        _append_block('[Сопровождение ГК+]', gkp_lines)
+
+    if splitted_blocks:
+        studs_combined = ''.join(splitted_blocks)
+        sections['studs'] = studs_combined
+    elif any(value > 0 for value in (stud_all, stud_rep, stud_salary_total)) or (rep_salary != '0' and to_float_safe(rep_salary) > 0):
+        # Проверяем, есть ли хотя бы одно ненулевое значение (кроме base_val и kpi_total_val)
+        has_meaningful_data = any(value > 0 for value in (stud_all, stud_rep, stud_salary_total)) or (rep_salary != '0' and to_float_safe(rep_salary) > 0)
+        if has_meaningful_data:
+            studs_section = "\n[Сопровождение учеников]"
+            if stud_all > 0:
+                studs_section += f"\nВсего учеников в группах: {stud_all}"
+            if stud_rep > 0:
+                studs_section += f"\nКол-во учеников с тарифом с репетитором: {stud_rep}"
+            if base_val > 0:
+                studs_section += f"\nОклад за ученика: {base_val}₽"
+            if rep_salary != '0' and to_float_safe(rep_salary) > 0:
+                studs_section += f"\nДоплата за учеников с репетитором: {rep_salary}₽"
+            if stud_salary_total > 0:
+                studs_section += f"\n→ Сумма оклада: {stud_salary_total}₽"
+            if kpi_total_val != '0' and to_float_safe(kpi_total_val) > 0:
+                studs_section += f"\n→ Сумма KPI (OKK+Retention): {kpi_total_val}₽"
+            sections['studs'] = studs_section
+
+    # Retention и OKK (общие блоки показываем только если нет отдельных секций)
+    if not splitted_blocks:
+        # Проверяем, есть ли хотя бы одно ненулевое значение в retention
+        has_retention_data = (
+            (rr_salary_gk != '0' and to_float_safe(rr_salary_gk) > 0) or
+            (rr_salary_gkp != '0' and to_float_safe(rr_salary_gkp) > 0)
+        )
+        if has_retention_data:
+            retention_section = "\n[Retention]"
+            if rr_gk:
+                retention_section += f"\nRetention ГК: {rr_gk}"
+            if rr_salary_gk != '0':
+                retention_section += f"\nОплата за retention ГК: {rr_salary_gk}₽"
+            if rr_gkp:
+                retention_section += f"\nRetention ГК+: {rr_gkp}"
+            if rr_salary_gkp != '0':
+                retention_section += f"\nОплата за retention ГК+: {rr_salary_gkp}₽"
+            sections['retention'] = retention_section
+
+        # Проверяем, есть ли хотя бы одно ненулевое значение в OKK
+        has_okk_data = (
+            (okk_salary_gk != '0' and to_float_safe(okk_salary_gk) > 0) or
+            (okk_salary_gkp != '0' and to_float_safe(okk_salary_gkp) > 0) or
+            (kpi_total_val != '0' and to_float_safe(kpi_total_val) > 0)
+        )
+        if has_okk_data:
+            okk_section = "\n[Показатели ОКК]"
+            if okk_gk:
+                okk_section += f"\nOKK ГК: {okk_gk}"
+            if okk_salary_gk != '0':
+                okk_section += f"\nОплата за OKK ГК: {okk_salary_gk}₽"
+            if okk_gkp:
+                okk_section += f"\nOKK ГК+: {okk_gkp}"
+            if okk_salary_gkp != '0':
+                okk_section += f"\nОплата за OKK ГК+: {okk_salary_gkp}₽"
+            if kpi_total_val != '0' and to_float_safe(kpi_total_val) > 0:
+                okk_section += f"\n→ Сумма KPI (OKK+Retention): {kpi_total_val}₽"
+            sections['okk'] = okk_section
+
+    # Проверки (существующий блок)
+    checks_section = ""
+    checks_salary = to_int_safe(p.get('checks_salary'))
+    dop_checks = to_int_safe(p.get('dop_checks'))
+    if checks_salary > 0 or dop_checks > 0:
+        if checks_salary > 0:
+            checks_section += f"\n→ Проверка домашних работ: {checks_salary}₽"
+        if dop_checks > 0:
+            checks_section += f"\n→ Дополнительно – за проверки (данные СК): {dop_checks}₽"
+        checks_section += "\n"
+    sections["checks"] = checks_section
+
+    # Дополнительная деятельность (существующий блок)
+    extras_keys = ['up','chats','webs','meth','dop_sk','callsg','callsp']
+    extras_names = {
+        'up': 'За учебную поддержку',
+        'chats': 'Модерация чатов',
+        'webs': 'Модерация вебинаров',
+        'callsg': 'Групповые созвоны',
+        'callsp': 'Индивидуальные созвоны',
+        'dop_sk': 'Доп. суммы, начисленные СК',
+        'meth': 'Стол заказов',
+    }
+    extras_total = sum(to_int_safe(p.get(k)) for k in extras_keys)
+    dops_section = ""
+    if extras_total > 0:
+        dops_section = "\n\n[Иная деятельность]"
+        for k in extras_keys:
+            v = to_int_safe(p.get(k))
+            if v > 0:
+                dops_section += f"\n{extras_names[k]}: {v}₽"
+        dops_section += f"\n→ Всего в категории: {extras_total}₽"
+    sections["extras"] = dops_section
+
+    # Штрафы (существующий блок)
+    fines_val = to_int_safe(p.get('fines'))
+    fines_section = f"\n\n→ Штрафы: -{fines_val}₽" if fines_val > 0 else f"\n\nШтрафы: отсутствуют"
+    sections["fines"] = fines_section
+
+    # Итого + комментарий
+    total_section = f"\n\n→ ИТОГО К ВЫПЛАТЕ: {to_float_str_money(p.get('total'))}₽"
+    comment = p.get('comment', '')
+    if is_meaningful_comment(comment):
+        total_section += f"\n[!!!] Комментарий: {str(comment).strip()}"
+    sections["total"] = total_section
+
+    return sections
+
+
+def render_payment_text(row: dict, original_filename: str) -> str:
+    """Текст выплаты куратора по строке персонального CSV."""
+    p = fill_missing(row, '0')
+    
+    # Современный формат с учётом новых столбцов
+    sections = compose_payment_sections(p)
+    checks_block = sections["checks"]
+    if checks_block:
+        checks_block = "\n[Проверки]" + checks_block
+    extras_block = sections["extras"]
+    if extras_block.startswith("\n[Иная деятельность]"):
+        extras_block = "\n[ Иная деятельность]" + extras_block[len("\n[Иная деятельность]"):]
+    fines_block = sections["fines"]
+    if fines_block.startswith("\n\n→ Штрафы"):
+        fines_block = "\n\n" + fines_block[len("\n\n→ "):]
+    total_block = sections["total"]
+    if total_block.startswith("\n\n→ ИТОГО"):
+        total_block = "\n\n" + total_block[len("\n\n→ "):]
+    
+    groups_str = str(p.get('groups', '')).strip()
+    groups_line = f"\nГруппы: {groups_str}" if groups_str else ""
+    
+    base = (f"=== Согласование выплаты ==="
+            f"\nВедомость: {original_filename.replace('.csv', '').replace('_', ' ')}"
+            f"\nКуратор: {p.get('name', '')}"
+            f"\nТип куратора: {p.get('type', '')}"
+            f"\nПочта на платформе: {p.get('email', '')}"
+            f"{groups_line}\n")
+
+    final = ("\n\nНажмите «Согласен», если у Вас нет разногласий с выставленными цифрами"
+             "\nНажмите «Не согласен», если Вы не согласны с каким-либо из пунктов"
+             "\nПросмотр ведомости возможен в течение 36 часов")
+
+    msg = (base
+           + sections["studs"]
+           + sections["retention"]
+           + sections["okk"]
+           + checks_block
+           + extras_block
+           + fines_block
+           + total_block
+           + final)
+    return msg
+
+
+def _pick(row: dict, *keys) -> str:
+    for key in keys:
+        value = row.get(key)
+        if value is not None and value == value:  # None и NaN — пусто
+            return str(value)
+    return ''
+
+
+def repet_row_data(row: dict) -> dict:
+    """Поля строки репетитора, которыми render_repet_payment_text дополняет пустые столбцы.
+
+    Те же ключи, что у маппинга выплаты репетитора в VK боте.
+    """
+    return {
+        'fio': _pick(row, 'Репетитор', 'ФИО', 'fio', 'name', 'full_name', 'FIO'),
+        'subject': _pick(row, 'Предмет'),
+        'lessons_held': _pick(row, 'Кол-во состоявшихся занятий'),
+        'lessons_no_student': _pick(row, 'Кол-во занятий, на которые не явился ученик'),
+        'base_payment': _pick(row, 'Базовое вознаграждение за проведенные занятия'),
+        'okk': _pick(row, 'OKK', 'ОКК'),
+        'rr': _pick(row, 'RR'),
+        'kpi': _pick(row, 'KPI'),
+        'preparation': _pick(row, 'Подготовка к занятиям'),
+        'penalties': _pick(row, 'Штраф'),
+        'total': _pick(row, 'ИТОГ', 'Итого', 'Total', 'total'),
+    }
+
+
+def render_repet_payment_text(row: dict, data=None) -> str:
+    """Текст выплаты репетитора; data - данные выплаты (по умолчанию из той же строки)."""
+    if data is None:
+        data = repet_row_data(row)
+    p = fill_missing(row, '0')
+    
+    # Форматируем сообщение по новому шаблону
+    msg = "Открыта ведомость\n\n"
+    msg += "=== Согласование выплаты ===\n"
+    msg += f"ФИО: {p.get('Репетитор', '') or data.get('fio', '')}\n"
+    msg += f"Предмет: {p.get('Предмет', '') or data.get('subject', '')}\n"
+    msg += f"Кол-во проведенных занятий: {p.get('Кол-во состоявшихся занятий', '') or data.get('lessons_held', '')}\n"
+    msg += f"Уроки без подключения ученика: {p.get('Кол-во занятий, на которые не явился ученик', '') or data.get('lessons_no_student', '')}\n"
+    msg += f"Оплата за занятия: {p.get('Базовое вознаграждение за проведенные занятия', '') or data.get('base_payment', '')}\n"
+    msg += f"Оценка контроля качества: {p.get('OKK', '') or p.get('ОКК', '') or data.get('okk', '')}\n"
+    msg += f"Критерий удержания учеников: {p.get('RR', '') or data.get('rr', '')}\n"
+    msg += f"Дополнительное вознаграждение за качество: {p.get('KPI', '') or data.get('kpi', '')}\n"
+    # Приоритет: data['preparation'] (из маппинга), затем из CSV напрямую
+    prep_val = data.get('preparation', '') or ''
+    if not str(prep_val).strip() or str(prep_val).strip() == '0':
+        prep_val = p.get('Подготовка к занятиям', '')
+    prep_str = str(prep_val).strip() if prep_val else '0'
+    msg += f"Доп. вознаграждение за подготовку: {prep_str}\n"
+    msg += f"Штрафы: {p.get('Штраф', '') or data.get('penalties', '')}\n"
+    msg += f"Итоговая сумма: {p.get('ИТОГ', '') or data.get('total', '')}\n\n"
+    msg += "Нажмите «Согласен», если у Вас нет разногласий с выставленными цифрами\n"
+    msg += "Нажмите «Не согласен», если Вы не согласны с каким-либо из пунктов\n"
+    msg += "Просмотр ведомости возможен в течение 36 часов"
+    
+    return msg
+
+
+def render_rows(items) -> list:
+    """[(db_id, is_repet, original_filename, row)] -> [(текст, db_id)]; выполняется и в пуле процессов.
+
+    Строки, которые не удалось отрендерить, пропускаются - VK бот отрендерит их сам.
+    """
+    rendered = []
+    for db_id, is_repet, original_filename, row in items:
+        try:
+            if is_repet:
+                text = render_repet_payment_text(row)
+            else:
+                text = render_payment_text(row, original_filename)
+        except Exception:
+            continue
+        rendered.append((text, db_id))
+    return rendered
@@ -4,6 +4,9 @@
 # Добавлена команда/кнопка для рассылки уведомлений кураторам (VK) —
 # берутся уникальные vk_id из vedomosti_users и отправляется сообщение через VK API.
 
+import csv
+import hashlib
+import io
 import os
 import re
 import time
@@ -14,9 +17,13 @@ import threading
 import sqlite3
 import random
 import string
+import tempfile
 import uuid
+import zipfile
+import asyncio
+import multiprocessing
 from typing import Optional
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import requests
 import pandas as pd
@@ -24,6 +31,11 @@ import pandas as pd
 from telegram import Update, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes
 from telegram.ext import filters
+
+import migrations
+import payment_render
+import snapshot
+
 # try load config.py if exists
 try:
     import config
@@ -33,6 +45,8 @@ except Exception:
 TELEGRAM_TOKEN = getattr(config, 'TELEGRAM_TOKEN', os.environ.get('TELEGRAM_TOKEN'))
 SERVICE_ACCOUNT_FILE = getattr(config, 'SERVICE_ACCOUNT_FILE', os.environ.get('SERVICE_ACCOUNT_FILE', 'isu_groups.json'))
 UPLOADS_DIR = getattr(config, 'UPLOADS_DIR', os.environ.get('UPLOADS_DIR', 'uploads'))
+# Загрузки хранятся один раз по sha256 содержимого: uploads/store/<ab>/<sha256>.<ext>
+UPLOADS_STORE_DIR = os.path.join(UPLOADS_DIR, 'store')
 DRY_RUN = getattr(config, 'DRY_RUN', os.environ.get('DRY_RUN', 'False') in ('True', 'true', '1'))
 
 HOSTING_ROOT = getattr(config, 'HOSTING_ROOT', os.environ.get('HOSTING_ROOT', 'hosting'))
@@ -45,7 +59,19 @@ ARCHIVE_CHECK_INTERVAL = float(getattr(config, 'ARCHIVE_CHECK_INTERVAL', os.envi
 
 CURRENT_SHEETS_FILE = getattr(config, 'CURRENT_SHEETS_FILE', 'current_sheets.json')
 ALLOWED_EXCEL_EXT = {'xlsx', 'xls', 'csv'}
+# Пакетная публикация (/send_batch): книга с листами или zip с файлами ведомостей
+ALLOWED_BATCH_EXT = {'xlsx', 'xls', 'zip'}
+BATCH_MANIFEST_NAMES = ('manifest', 'манифест')
+# Пререндер текстов выплат: пул процессов только для больших ведомостей (запуск пула дороже рендера)
+RENDER_WORKERS = int(getattr(config, 'RENDER_WORKERS', os.environ.get('RENDER_WORKERS', min(4, os.cpu_count() or 1))))
+RENDER_PARALLEL_MIN_ROWS = 2000
+RENDER_CHUNK_SIZE = 500
+BATCH_PUBLISH_WORKERS = int(getattr(config, 'BATCH_PUBLISH_WORKERS', os.environ.get('BATCH_PUBLISH_WORKERS', min(4, os.cpu_count() or 1))))
 DB_PATH = getattr(config, 'DB_PATH', os.environ.get('DB_PATH', 'hosting.db'))
+# Холодная история: строки заархивированных ведомостей переносятся сюда из vedomosti_users
+ARCHIVE_DB_PATH = getattr(config, 'ARCHIVE_DB_PATH', os.environ.get('ARCHIVE_DB_PATH', 'archive.db'))
+# Бинарный снимок открытых ведомостей для VK бота (см. snapshot.py)
+SNAPSHOT_PATH = getattr(config, 'SNAPSHOT_PATH', os.environ.get('SNAPSHOT_PATH', 'statements.snap'))
 
 # VK-related config (must be provided in config.py or env)
 VK_TOKEN = getattr(config, 'VK_TOKEN', os.environ.get('VK_TOKEN', None))
@@ -93,65 +119,71 @@ def save_json(path: str, data):
 # ----------------- sqlite: vedomosti users (simplified schema) -----------------
 
 def init_db():
-    try:
-        conn = sqlite3.connect(DB_PATH, timeout=30)
-        c = conn.cursor()
-        
-        # Включаем WAL режим для лучшей конкурентности
-        c.execute('PRAGMA journal_mode=WAL')
-        
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS vedomosti_users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                vk_id TEXT,
-                personal_path TEXT,
-                original_filename TEXT,
-                state TEXT DEFAULT ''
-            )
-        ''')
-        conn.commit()
-        conn.close()
-        log.info('SQLite initialized with WAL mode (%s)', DB_PATH)
-    except Exception:
-        log.exception('Failed to initialize sqlite DB')
+    """Создаёт/обновляет схему hosting.db (см. migrations.py)."""
+    version = migrations.apply_migrations(DB_PATH)
+    log.info('SQLite schema at version %s (%s)', version, DB_PATH)
+    import_json_state()
+    sync_statements_registry()
+    refresh_statements_snapshot()
 
 
-def ensure_vedomosti_status_columns():
-    """Ensure columns status, disagree_reason, confirmed_at, created_at, archive_at exist in vedomosti_users."""
+JSON_STATE_CHECKPOINT = 'tg_json_state_import'
+
+
+def import_json_state():
+    """Однократно переносит users.json и current_sheets.json в tg_users / tg_current_sheets.
+
+    Строки, уже записанные в БД, не перезаписываются. После переноса ставится отметка
+    в migration_checkpoints, и файлы больше не читаются (остаются на диске как есть).
+    """
     try:
-        conn = sqlite3.connect(DB_PATH, timeout=30)
-        c = conn.cursor()
-        c.execute("PRAGMA table_info(vedomosti_users)")
-        cols = [r[1] for r in c.fetchall()]
-        if 'status' not in cols:
-            c.execute("ALTER TABLE vedomosti_users ADD COLUMN status TEXT DEFAULT ''")
-        if 'disagree_reason' not in cols:
-            c.execute("ALTER TABLE vedomosti_users ADD COLUMN disagree_reason TEXT DEFAULT ''")
-        if 'confirmed_at' not in cols:
-            c.execute("ALTER TABLE vedomosti_users ADD COLUMN confirmed_at INTEGER")
-        if 'created_at' not in cols:
-            c.execute("ALTER TABLE vedomosti_users ADD COLUMN created_at INTEGER DEFAULT 0")
-        if 'archive_at' not in cols:
-            c.execute("ALTER TABLE vedomosti_users ADD COLUMN archive_at INTEGER DEFAULT 0")
-        # Track archive warning dispatch
-        if 'warning_sent' not in cols:
-            c.execute("ALTER TABLE vedomosti_users ADD COLUMN warning_sent INTEGER DEFAULT 0")
-        if 'warning_sent_at' not in cols:
-            c.execute("ALTER TABLE vedomosti_users ADD COLUMN warning_sent_at INTEGER DEFAULT 0")
-        conn.commit()
-        conn.close()
-        log.info('SQLite columns ensured: status/disagree_reason/confirmed_at/created_at/archive_at/warning_sent')
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT completed_at FROM migration_checkpoints WHERE name = ?',
+                               (JSON_STATE_CHECKPOINT,)).fetchone()
+            if row and row[0]:
+                conn.execute('COMMIT')
+                return
+            now = int(time.time())
+            # users.json хранит пары в обе стороны: {"<username>": <id>, "<id>": "<username>"}
+            usernames = {}
+            for key, value in (load_json(USERS_FILE) or {}).items():
+                if str(key).isdigit():
+                    usernames[int(key)] = str(value or '') or usernames.get(int(key), '')
+                elif str(value).isdigit():
+                    usernames.setdefault(int(value), str(key))
+            conn.executemany('INSERT OR IGNORE INTO tg_users(user_id, username, updated_at) VALUES (?,?,?)',
+                             [(uid, username, now) for uid, username in usernames.items()])
+            sheets = []
+            for key, value in (load_json(CURRENT_SHEETS_FILE) or {}).items():
+                if str(key).lstrip('-').isdigit() and isinstance(value, dict):
+                    sheets.append((int(key), value.get('file_path') or '', int(bool(value.get('awaiting_meta'))), now))
+            conn.executemany('INSERT OR IGNORE INTO tg_current_sheets(user_id, file_path, awaiting_meta, updated_at) VALUES (?,?,?,?)',
+                             sheets)
+            conn.execute('INSERT OR REPLACE INTO migration_checkpoints(name, last_id, completed_at, updated_at) VALUES (?,?,?,?)',
+                         (JSON_STATE_CHECKPOINT, 0, now, now))
+            conn.execute('COMMIT')
+            log.info('Imported %d users from %s and %d current sheets from %s into SQLite',
+                     len(usernames), USERS_FILE, len(sheets), CURRENT_SHEETS_FILE)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
     except Exception:
-        log.exception('Failed to ensure vedomosti status columns')
+        log.exception('Failed to import JSON user state into %s', DB_PATH)
+
 
-def insert_vedomosti_user(vk_id: str, personal_path: str, original_filename: str, state: str = ''):
+def insert_vedomosti_user(vk_id: str, personal_path: str, original_filename: str, state: str = '', total: Optional[float] = None):
     try:
         conn = sqlite3.connect(DB_PATH, timeout=30)
         c = conn.cursor()
         now = int(time.time())
         archive_time = now + (36 * 3600)  # 36 часов в секундах
-        c.execute('INSERT INTO vedomosti_users(vk_id, personal_path, original_filename, state, created_at, archive_at) VALUES (?,?,?,?,?,?)',
-                  (str(vk_id), personal_path, original_filename, state, now, archive_time))
+        state_kind, payment_uuid = migrations.split_vedomosti_state(state)
+        c.execute('INSERT INTO vedomosti_users(vk_id, personal_path, original_filename, state, state_kind, payment_uuid, total, created_at, archive_at) VALUES (?,?,?,?,?,?,?,?,?)',
+                  (str(vk_id), personal_path, original_filename, state, state_kind, payment_uuid, total, now, archive_time))
         conn.commit()
         conn.close()
         log.info('Inserted vedomosti user %s with archive time %s', vk_id, archive_time)
@@ -171,6 +203,186 @@ def save_hosting_index(idx: dict):
         log.exception('Failed to persist hosting index %s', HOSTING_INDEX)
 
 
+# ----------------- statements registry -----------------
+# Таблица statements (см. migrations.py) хранит имя файла, папку и нормализованное имя каждой
+# ведомости в open/archive. Команды находят ведомость по названию через resolve_statement,
+# а не обходом папок и не LIKE по vedomosti_users.
+
+STATEMENT_LOCATIONS = ('open', 'archive')
+
+
+def normalize_statement_name(name: str) -> str:
+    """'• Русский_ОГЭ_ПГК.csv' -> 'русский огэ пгк'."""
+    name = str(name or '').strip().lstrip('•').strip()
+    if name.lower().endswith('.csv'):
+        name = name[:-4]
+    return ' '.join(name.replace('_', ' ').lower().split())
+
+
+def _location_root(location: str) -> str:
+    return os.path.join(HOSTING_ROOT, OPEN_DIRNAME if location == 'open' else ARCHIVE_DIRNAME)
+
+
+def register_statement(filename: str, folder: str, location: str = 'open'):
+    """Добавляет копию ведомости в реестр (после публикации, архивации, восстановления).
+
+    Запись определяет пара (папка, имя файла): открытая ведомость и её архивные копии
+    с тем же именем хранятся отдельно. Записи этого имени, чьей папки уже нет на диске
+    (ведомость перенесли), удаляются.
+    """
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        moved = [(row_id,) for row_id, row_folder in conn.execute(
+            'SELECT id, folder FROM statements WHERE filename = ?', (filename,))
+            if row_folder != folder and not os.path.exists(row_folder)]
+        conn.executemany('DELETE FROM statements WHERE id = ?', moved)
+        conn.execute("""
+            INSERT INTO statements(filename, normalized_name, folder, location, updated_at) VALUES (?,?,?,?,?)
+            ON CONFLICT(folder, filename) DO UPDATE SET
+                normalized_name = excluded.normalized_name, location = excluded.location,
+                updated_at = excluded.updated_at
+        """, (filename, normalize_statement_name(filename), folder, location, int(time.time())))
+        conn.commit()
+        conn.close()
+    except Exception:
+        log.exception('Failed to register statement %s (%s)', filename, folder)
+
+
+def unregister_statement(filename: str, folder: Optional[str] = None):
+    """Удаляет из реестра копию ведомости в folder (или все копии с этим именем)."""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        if folder is None:
+            conn.execute('DELETE FROM statements WHERE filename = ?', (filename,))
+        else:
+            conn.execute('DELETE FROM statements WHERE filename = ? AND folder = ?', (filename, folder))
+        conn.commit()
+        conn.close()
+    except Exception:
+        log.exception('Failed to unregister statement %s', filename)
+
+
+def statement_locations(filename: str) -> set:
+    """Где ещё зарегистрированы копии ведомости с этим именем: подмножество {'open', 'archive'}."""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        rows = conn.execute('SELECT DISTINCT location FROM statements WHERE filename = ?', (filename,)).fetchall()
+        conn.close()
+    except Exception:
+        log.exception('Failed to read registry locations of statement %s', filename)
+        return set(STATEMENT_LOCATIONS)
+    return {row[0] for row in rows}
+
+
+def sync_statements_registry() -> int:
+    """Сверяет реестр с папками open/archive: один обход при старте и при промахе поиска.
+
+    Для архивных ведомостей в folder хранится путь к zip-контейнеру (или к папке, ещё не упакованной).
+    В реестр попадают все найденные копии, в том числе одноимённые в open и archive; время
+    изменения папки или контейнера записывается в updated_at, чтобы свежая копия шла первой.
+    """
+    found = {}
+    for location in STATEMENT_LOCATIONS:
+        root_path = _location_root(location)
+        if not os.path.exists(root_path):
+            continue
+        for root, dirs, files in os.walk(root_path):
+            if 'users' in root:
+                continue
+            for file in files:
+                if file.endswith('.csv'):
+                    found[(root, file)] = location
+                elif location == 'archive' and file.endswith(ARCHIVE_CONTAINER_EXT):
+                    # Контейнер <ведомость>.zip: в реестре хранится путь к самому файлу
+                    found[(os.path.join(root, file), archived_statement_filename(file))] = location
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        known = {(row[0], row[1]): (row[2], row[3])
+                 for row in conn.execute('SELECT folder, filename, location, id FROM statements')}
+        conn.executemany("""
+            INSERT INTO statements(filename, normalized_name, folder, location, updated_at) VALUES (?,?,?,?,?)
+            ON CONFLICT(folder, filename) DO UPDATE SET
+                normalized_name = excluded.normalized_name, location = excluded.location,
+                updated_at = excluded.updated_at
+        """, [(fn, normalize_statement_name(fn), folder, location, int(os.path.getmtime(folder)))
+              for (folder, fn), location in found.items() if known.get((folder, fn), (None,))[0] != location])
+        conn.executemany('DELETE FROM statements WHERE id = ?',
+                         [(row_id,) for key, (_, row_id) in known.items() if key not in found])
+        conn.commit()
+        conn.close()
+    except Exception:
+        log.exception('Failed to sync statements registry')
+        return 0
+    log.info('Statements registry synced: %d statements', len(found))
+    return len(found)
+
+
+def _statement_candidates(conn, query: str, location: str) -> list:
+    rows = []
+    if len(query) >= 3:
+        try:
+            # Фраза в кавычках: триграммы ищут её как подстроку нормализованного имени
+            # IN (подзапрос), а не JOIN: иначе планировщик повторяет поиск FTS для каждой строки реестра
+            rows = conn.execute("""
+                SELECT filename, folder, normalized_name, updated_at FROM statements
+                WHERE id IN (SELECT rowid FROM statements_fts WHERE statements_fts MATCH ?) AND location = ?
+            """, ('"' + query.replace('"', '""') + '"', location)).fetchall()
+        except sqlite3.OperationalError:
+            rows = None
+    if not rows:
+        rows = conn.execute(
+            'SELECT filename, folder, normalized_name, updated_at FROM statements WHERE location = ? AND instr(normalized_name, ?) > 0',
+            (location, query)).fetchall()
+    # Название, в котором имя ведомости - лишь часть ("Русский ОГЭ ПГК 2025" для "Русский_ОГЭ_ПГК")
+    rows += conn.execute(
+        'SELECT filename, folder, normalized_name, updated_at FROM statements WHERE location = ? AND instr(?, normalized_name) > 0',
+        (location, query)).fetchall()
+    return rows
+
+
+def resolve_statement(name: str, location: str = 'open', exact: bool = False, limit: int = 5) -> list:
+    """Находит ведомости по названию; возвращает [(folder, filename), ...] от лучшего совпадения.
+
+    Порядок: точное совпадение нормализованных имён, затем имя, начинающееся с запроса,
+    затем содержащее его (короткие имена выше), затем имена, целиком входящие в запрос.
+    exact=True оставляет только точные совпадения. Если ничего не найдено, реестр один раз
+    сверяется с папками (на случай файлов, положенных вручную) и поиск повторяется.
+    """
+    query = normalize_statement_name(name)
+    if not query:
+        return []
+    for attempt in range(2):
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            if exact:
+                rows = conn.execute(
+                    'SELECT filename, folder, normalized_name, updated_at FROM statements WHERE location = ? AND normalized_name = ?',
+                    (location, query)).fetchall()
+            else:
+                rows = _statement_candidates(conn, query, location)
+            conn.close()
+        except Exception:
+            log.exception('Failed to resolve statement %r', name)
+            return []
+        ranked = {}
+        for filename, folder, normalized, updated_at in rows:
+            if normalized == query:
+                rank = 0
+            elif normalized.startswith(query):
+                rank = 1
+            elif query in normalized:
+                rank = 2
+            else:
+                rank = 3
+            # Среди одноимённых копий (архив одной ведомости за разные периоды) первой идёт свежая
+            ranked[(folder, filename)] = (rank, abs(len(normalized) - len(query)), filename, -(updated_at or 0))
+        if ranked or attempt:
+            break
+        sync_statements_registry()
+    result = sorted(ranked, key=ranked.get)
+    return [(folder, filename) for folder, filename in result if os.path.exists(folder)][:limit]
+
+
 # ----------------- users/admins persistence -----------------
 
 def load_admins_from_file() -> set:
@@ -195,26 +407,57 @@ def save_admins_to_file():
         log.exception('Failed to save admins to %s', ADMINS_FILE)
 
 def load_users() -> dict:
-    return load_json(USERS_FILE) or {}
+    """Все пользователи в прежнем формате users.json: {username: id, "<id>": username}."""
+    users = {}
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        rows = conn.execute('SELECT user_id, username FROM tg_users ORDER BY updated_at').fetchall()
+        conn.close()
+    except Exception:
+        log.exception('Failed to load users from %s', DB_PATH)
+        return users
+    for uid, username in rows:
+        if username:
+            users[username] = int(uid)
+        users[str(uid)] = username or ''
+    return users
+
+def find_user_id_by_username(username: str) -> Optional[int]:
+    """id пользователя по @username из tg_users (последняя запись с этим именем) или None."""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        row = conn.execute('SELECT user_id FROM tg_users WHERE username = ? ORDER BY updated_at DESC LIMIT 1',
+                           (username,)).fetchone()
+        conn.close()
+        return int(row[0]) if row else None
+    except Exception:
+        log.exception('Failed to look up user @%s', username)
+        return None
 
-def save_users(users: dict):
+def find_username(user_id: int) -> str:
     try:
-        save_json(USERS_FILE, users)
-        log.info('Saved users to %s', USERS_FILE)
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        row = conn.execute('SELECT username FROM tg_users WHERE user_id = ?', (int(user_id),)).fetchone()
+        conn.close()
+        return (row[0] or '') if row else ''
     except Exception:
-        log.exception('Failed to save users file %s', USERS_FILE)
+        log.exception('Failed to look up username for %s', user_id)
+        return ''
 
 def save_user_entry(user):
     try:
-        users = load_users()
-        uid = str(user.id)
+        uid = int(user.id)
         username = (user.username or '').strip()
-        if username:
-            users[username] = int(uid)
-            users[uid] = username
-        else:
-            users[uid] = users.get(uid, '')
-        save_users(users)
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        # Пустое имя не затирает уже известное (как и прежде в users.json)
+        conn.execute("""
+            INSERT INTO tg_users(user_id, username, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = CASE WHEN excluded.username != '' THEN excluded.username ELSE tg_users.username END,
+                updated_at = excluded.updated_at
+        """, (uid, username, int(time.time())))
+        conn.commit()
+        conn.close()
         log.info('Saved user entry: id=%s username=%s', uid, username)
     except Exception:
         log.exception('Failed to save user entry for %s', getattr(user, 'id', None))
@@ -226,30 +469,207 @@ ADMIN_IDS = set(load_admins_from_file())
 # ----------------- current state per user -----------------
 
 def save_current_for_user(user_id: int, file_path: str = '', awaiting_meta: bool = False):
-    d = load_json(CURRENT_SHEETS_FILE) or {}
-    d[str(user_id)] = {'file_path': file_path or '', 'awaiting_meta': bool(awaiting_meta)}
-    save_json(CURRENT_SHEETS_FILE, d)
-    log.info('Saved current for %s -> file=%s awaiting_meta=%s', user_id, file_path, awaiting_meta)
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        conn.execute('INSERT OR REPLACE INTO tg_current_sheets(user_id, file_path, awaiting_meta, updated_at) VALUES (?,?,?,?)',
+                     (int(user_id), file_path or '', int(bool(awaiting_meta)), int(time.time())))
+        conn.commit()
+        conn.close()
+        log.info('Saved current for %s -> file=%s awaiting_meta=%s', user_id, file_path, awaiting_meta)
+    except Exception:
+        log.exception('Failed to save current sheet for %s', user_id)
 
 def load_current_for_user(user_id: int) -> dict:
-    d = load_json(CURRENT_SHEETS_FILE) or {}
-    return d.get(str(user_id), {})
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        row = conn.execute('SELECT file_path, awaiting_meta FROM tg_current_sheets WHERE user_id = ?',
+                           (int(user_id),)).fetchone()
+        conn.close()
+    except Exception:
+        log.exception('Failed to load current sheet for %s', user_id)
+        return {}
+    if not row:
+        return {}
+    return {'file_path': row[0] or '', 'awaiting_meta': bool(row[1])}
+
+
+# ----------------- statements snapshot -----------------
+
+_snapshot_lock = threading.Lock()
+
+
+def refresh_statements_snapshot() -> Optional[int]:
+    """Пересобирает снимок открытых ведомостей, который VK бот читает через mmap.
+
+    Берутся персональные файлы всех строк vedomosti_users (в горячей БД только
+    открытые ведомости). Файлы с теми же mtime и размером не перечитываются -
+    строка берётся из прошлого снимка. Возвращает число записей или None при ошибке.
+    """
+    with _snapshot_lock:
+        try:
+            previous = {}
+            generation = 1
+            if os.path.exists(SNAPSHOT_PATH):
+                try:
+                    old = snapshot.StatementSnapshot(SNAPSHOT_PATH)
+                    generation = old.generation + 1
+                    previous = {path: (mtime_ns, size, row) for _, path, mtime_ns, size, row in old.records()}
+                except Exception:
+                    log.warning('Previous statements snapshot %s is unreadable, rebuilding from files', SNAPSHOT_PATH)
+
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            try:
+                rows = conn.execute("SELECT DISTINCT vk_id, personal_path FROM vedomosti_users "
+                                    "WHERE personal_path IS NOT NULL AND personal_path != ''").fetchall()
+            finally:
+                conn.close()
+
+            records = []
+            reread = 0
+            for vk_id, personal_path in rows:
+                try:
+                    st = os.stat(personal_path)
+                except FileNotFoundError:
+                    continue
+                cached = previous.get(personal_path)
+                if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                    row = cached[2]
+                else:
+                    row = snapshot.read_first_csv_row(personal_path)
+                    reread += 1
+                if row is None:
+                    continue
+                vk_num = int(vk_id) if str(vk_id).isdigit() else 0
+                records.append((vk_num, personal_path, st.st_mtime_ns, st.st_size, row))
+
+            count = snapshot.write_snapshot(SNAPSHOT_PATH, records, generation)
+            log.info('Statements snapshot %s written: %d records (%d files read), generation %d',
+                     SNAPSHOT_PATH, count, reread, generation)
+            return count
+        except Exception:
+            log.exception('Failed to refresh statements snapshot')
+            return None
+
+
+# ----------------- pre-rendered payment texts -----------------
+
+def prerender_statement_texts(filename: str, personal_paths=None) -> int:
+    """Рендерит тексты выплат ведомости и сохраняет их с версией шаблона (см. payment_render.py).
+
+    personal_paths=None - все строки ведомости; иначе только эти файлы и строки без
+    текста текущей версии шаблона (после /update). Строки, которые не удалось
+    отрендерить, помечаются RENDER_FAILED_VERSION. Возвращает число текстов.
+    """
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            rows = conn.execute("SELECT id, is_repet, personal_path, render_version FROM vedomosti_users "
+                                "WHERE original_filename = ? AND personal_path != ''", (filename,)).fetchall()
+        finally:
+            conn.close()
+        if personal_paths is not None:
+            wanted = set(personal_paths)
+            done = (payment_render.TEMPLATE_VERSION, payment_render.RENDER_FAILED_VERSION)
+            rows = [r for r in rows if r[2] in wanted or r[3] not in done]
+        if not rows:
+            return 0
+
+        items = []
+        for db_id, is_repet, personal_path, _ in rows:
+            try:
+                row = snapshot.read_first_csv_row(personal_path)
+            except OSError:
+                continue
+            if row is not None:
+                items.append((db_id, bool(is_repet), os.path.basename(filename), row))
+
+        rendered = []
+        # Процесс-исполнитель /send_batch сам работает в пуле - там рендерим на месте
+        if len(items) >= RENDER_PARALLEL_MIN_ROWS and RENDER_WORKERS > 1 and multiprocessing.parent_process() is None:
+            chunks = [items[i:i + RENDER_CHUNK_SIZE] for i in range(0, len(items), RENDER_CHUNK_SIZE)]
+            with ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn')) as executor:
+                rendered = [pair for part in executor.map(payment_render.render_rows, chunks) for pair in part]
+        elif items:
+            rendered = payment_render.render_rows(items)
+
+        rendered_ids = {db_id for _, db_id in rendered}
+        failed = [r[0] for r in rows if r[0] not in rendered_ids]
+
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            conn.executemany('UPDATE vedomosti_users SET rendered_text = ?, render_version = ? WHERE id = ?',
+                             [(text, payment_render.TEMPLATE_VERSION, db_id) for text, db_id in rendered])
+            # Без файла или с ошибкой шаблона - текст остаётся VK боту, повторно не перебираем
+            conn.executemany('UPDATE vedomosti_users SET rendered_text = NULL, render_version = ? WHERE id = ?',
+                             [(payment_render.RENDER_FAILED_VERSION, db_id) for db_id in failed])
+            conn.commit()
+        finally:
+            conn.close()
+        log.info('Pre-rendered %d payment texts for %s (template v%d, %d failed)',
+                 len(rendered), filename, payment_render.TEMPLATE_VERSION, len(failed))
+        return len(rendered)
+    except Exception:
+        log.exception('Failed to pre-render payment texts for %s', filename)
+        return 0
+
+
+def prerender_stale_texts() -> int:
+    """Дорендеривает строки без текста или со старой версией шаблона (после обновления бота)."""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            filenames = migrations.select_stale_render_files(
+                conn, (payment_render.TEMPLATE_VERSION, payment_render.RENDER_FAILED_VERSION))
+        finally:
+            conn.close()
+    except Exception:
+        log.exception('Failed to look up stale payment texts')
+        return 0
+    return sum(prerender_statement_texts(filename, personal_paths=()) for filename in filenames)
 
 
 # ----------------- file conversion & publishing -----------------
 
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def store_upload(path: str) -> tuple:
+    """Переносит скачанный файл в хранилище по хэшу; возвращает (путь в хранилище, был ли уже там)."""
+    digest = file_sha256(path)
+    ext = os.path.splitext(path)[1].lower()
+    stored_path = os.path.join(UPLOADS_STORE_DIR, digest[:2], digest + ext)
+    if os.path.exists(stored_path):
+        os.remove(path)
+        return stored_path, True
+    os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+    os.replace(path, stored_path)
+    return stored_path, False
+
+
+def is_stored_upload(path: str) -> bool:
+    return os.path.abspath(path).startswith(os.path.abspath(UPLOADS_STORE_DIR) + os.sep)
+
+
 def ensure_csv(path: str) -> Optional[str]:
     if not path:
         return None
     lower = path.lower()
     if lower.endswith('.csv'):
         return path
+    csv_name = os.path.splitext(path)[0] + '.csv'
+    if is_stored_upload(path) and os.path.exists(csv_name):
+        # Файл в хранилище неизменен (имя = хэш), поэтому готовый CSV из него актуален
+        return csv_name
     try:
         df = pd.read_excel(path)
     except Exception as e:
         log.exception('Failed to read Excel %s: %s', path, e)
         return None
-    csv_name = os.path.splitext(path)[0] + '.csv'
     try:
         df.to_csv(csv_name, index=False, encoding='utf-8')
         log.info('Converted %s -> %s', path, csv_name)
@@ -259,7 +679,57 @@ def ensure_csv(path: str) -> Optional[str]:
         return None
 
 
-def publish_to_hosting(csv_path: str, subject: str, course_type: str, block: str, uploaded_by: int, excel_path: str = None) -> Optional[str]:
+def _read_statement_rows(path: str) -> list:
+    for encoding in ('utf-8-sig', 'cp1251'):
+        try:
+            with open(path, 'r', encoding=encoding, newline='') as f:
+                return [row for row in csv.reader(f)]
+        except UnicodeDecodeError:
+            continue
+    return []
+
+
+def same_statement_rows(path_a: str, path_b: str) -> bool:
+    """Совпадают ли строки двух CSV ведомости (сначала по хэшу файлов, затем построчно)."""
+    if os.path.getsize(path_a) == os.path.getsize(path_b) and file_sha256(path_a) == file_sha256(path_b):
+        return True
+    return _read_statement_rows(path_a) == _read_statement_rows(path_b)
+
+
+def _place_published_csv(csv_path: str, dest_path: str):
+    # Файл из хранилища загрузок копируем (он может понадобиться снова), остальные перемещаем
+    if is_stored_upload(csv_path):
+        shutil.copy2(csv_path, dest_path)
+    else:
+        shutil.move(csv_path, dest_path)
+
+
+def _publish_over_open(dest_path: str, csv_path: str, import_fn, outcome: dict) -> bool:
+    """Повторная публикация в уже открытую ведомость.
+
+    Те же строки - ничего не меняется (никаких новых файлов, строк БД и уведомлений).
+    Изменённый файл проходит через update_statement_data: переписываются только
+    изменившиеся персональные файлы, новые строки импортируются. False - сравнение
+    не удалось (например, нет столбца vk_id), и ведомость публикуется как раньше, заново.
+    """
+    if same_statement_rows(csv_path, dest_path):
+        outcome['status'] = 'unchanged'
+        log.info('Publish of %s skipped: rows are identical to the open statement', dest_path)
+    else:
+        ok, updated_users = update_statement_data(os.path.dirname(dest_path), os.path.basename(dest_path), csv_path,
+                                                  import_new=import_fn)
+        if not ok:
+            log.warning('Diff publish of %s failed, falling back to full import', dest_path)
+            return False
+        outcome.update(status='updated', updated_users=updated_users)
+    if not is_stored_upload(csv_path) and os.path.exists(csv_path):
+        os.remove(csv_path)
+    return True
+
+
+def publish_to_hosting(csv_path: str, subject: str, course_type: str, block: str, uploaded_by: int, excel_path: str = None,
+                       report: Optional[dict] = None) -> Optional[str]:
+    """Публикует ведомость; report (если передан) получает status: 'new', 'unchanged' или 'updated'."""
     if not os.path.exists(csv_path):
         log.warning('publish: file not found %s', csv_path)
         return None
@@ -278,12 +748,16 @@ def publish_to_hosting(csv_path: str, subject: str, course_type: str, block: str
     fname = f"{subject_safe}_{course_safe}_{block_safe}.csv"  # Новое имя файла
     dest_path = os.path.join(dest_dir, fname)
 
-    try:
-        shutil.move(csv_path, dest_path)
-    except Exception as e:
-        log.exception('Failed to move file to hosting: %s', e)
-        return None
+    # Ведомость уже открыта: повторная публикация идёт через сравнение строк, а не повторный импорт
+    outcome = {'status': 'new'}
+    if not (os.path.exists(dest_path) and _publish_over_open(dest_path, csv_path, import_users_from_csv, outcome)):
+        try:
+            _place_published_csv(csv_path, dest_path)
+        except Exception as e:
+            log.exception('Failed to move file to hosting: %s', e)
+            return None
 
+    register_statement(fname, dest_dir, 'open')
     log.info('Published to hosting: %s (subject=%s course_type=%s block=%s)', dest_path, subject, course_type, block)
 
     # Копируем Excel файл в ту же папку (нужен для расчёта RR - там хранятся min/max)
@@ -297,17 +771,24 @@ def publish_to_hosting(csv_path: str, subject: str, course_type: str, block: str
         except Exception as e:
             log.warning('Failed to copy Excel file to hosting: %s', e)
 
+    if report is not None:
+        report.update(outcome)
+    if outcome['status'] != 'new':
+        return dest_path
+
     # импортируем пользователей и создаём персональные файлы
     try:
         import_users_from_csv(dest_path, original_filename=os.path.basename(dest_path))
+        prerender_statement_texts(os.path.basename(dest_path))
     except Exception:
         log.exception('Failed to import users from %s', dest_path)
 
     return dest_path
 
 
-def publish_to_hosting_repet(csv_path: str, subject: str, course_type: str, block: str, uploaded_by: int, excel_path: str = None) -> Optional[str]:
-    """Публикует файл для репетиторов на хостинг."""
+def publish_to_hosting_repet(csv_path: str, subject: str, course_type: str, block: str, uploaded_by: int, excel_path: str = None,
+                             report: Optional[dict] = None) -> Optional[str]:
+    """Публикует файл для репетиторов на хостинг (report - как в publish_to_hosting)."""
     if not os.path.exists(csv_path):
         log.warning('publish_repet: file not found %s', csv_path)
         return None
@@ -326,12 +807,16 @@ def publish_to_hosting_repet(csv_path: str, subject: str, course_type: str, bloc
     fname = f"{subject_safe}_{course_safe}_{block_safe}.csv"
     dest_path = os.path.join(dest_dir, fname)
 
-    try:
-        shutil.move(csv_path, dest_path)
-    except Exception as e:
-        log.exception('Failed to move file to hosting: %s', e)
-        return None
+    # Ведомость уже открыта: повторная публикация идёт через сравнение строк, а не повторный импорт
+    outcome = {'status': 'new'}
+    if not (os.path.exists(dest_path) and _publish_over_open(dest_path, csv_path, import_users_from_csv_repet, outcome)):
+        try:
+            _place_published_csv(csv_path, dest_path)
+        except Exception as e:
+            log.exception('Failed to move file to hosting: %s', e)
+            return None
 
+    register_statement(fname, dest_dir, 'open')
     log.info('Published repet to hosting: %s (subject=%s course_type=%s block=%s)', dest_path, subject, course_type, block)
 
     # Копируем Excel файл в ту же папку (если есть)
@@ -345,9 +830,15 @@ def publish_to_hosting_repet(csv_path: str, subject: str, course_type: str, bloc
         except Exception as e:
             log.warning('Failed to copy Excel file to hosting: %s', e)
 
+    if report is not None:
+        report.update(outcome)
+    if outcome['status'] != 'new':
+        return dest_path
+
     # импортируем пользователей-репетиторов и создаём персональные файлы
     try:
         import_users_from_csv_repet(dest_path, original_filename=os.path.basename(dest_path))
+        prerender_statement_texts(os.path.basename(dest_path))
     except Exception:
         log.exception('Failed to import repet users from %s', dest_path)
 
@@ -363,6 +854,72 @@ def _safe_filename_component(s: str) -> str:
     s = re.sub(r'__+', '_', s)
     return s[:120] or 'unknown'
 
+
+def _free_personal_path(users_dir: str, personal_name: str) -> str:
+    """Путь персонального файла, не занятый другим: два импорта в одну секунду (новые строки
+    повторной публикации) дают те же <vk_id>_<время>_<номер строки> и иначе перезаписали бы файл."""
+    path = os.path.join(users_dir, personal_name)
+    base, ext = os.path.splitext(path)
+    n = 1
+    while os.path.exists(path):
+        n += 1
+        path = f'{base}_{n}{ext}'
+    return path
+
+
+# Столбцы итоговой суммы, ФИО и групп в порядке, в котором их выбирает VK-бот при показе выплаты
+TOTAL_COLUMNS = ('total', 'Total', 'TOTAL', 'Итого')
+REPET_TOTAL_COLUMNS = ('ИТОГ', 'Итого', 'Total', 'total')
+FIO_COLUMNS = ('ФИО', 'fio', 'name', 'full_name', 'FIO')
+REPET_FIO_COLUMNS = ('Репетитор',) + FIO_COLUMNS
+GROUPS_COLUMNS = ('Группы', 'groups', 'group', 'groups_list')
+
+
+def row_value(row, columns) -> Optional[str]:
+    """Первое непустое (не NaN) значение строки DataFrame из столбцов columns."""
+    for col in columns:
+        value = row.get(col)
+        if value is not None and not pd.isna(value):
+            return str(value)
+    return None
+
+
+def row_total(row, columns) -> Optional[float]:
+    """Разбирает итог строки DataFrame по первому непустому столбцу из columns."""
+    value = row_value(row, columns)
+    return 0.0 if value is None else payment_render.parse_amount(value)
+
+
+def _insert_imported_rows(db_operations, kind: str):
+    """Пакетная вставка строк ведомости: (vk_id, personal_path, original_filename, total, fio, groups).
+
+    Строки с нулевой суммой записываются сразу как skip_zero_total (без персонального файла),
+    остальные получают уникальный '<kind>:<uuid>'. fio/groups/total/is_repet сохраняются,
+    чтобы VK-бот строил список выплат без чтения персональных файлов.
+    """
+    now = int(time.time())
+    archive_time = now + (36 * 3600)  # 36 часов в секундах
+    is_repet = 1 if kind == 'repet_imported' else 0
+    params = []
+    for vk_str, personal_path, orig_fn, total, fio, groups in db_operations:
+        if total == 0:
+            state, state_kind, payment_uuid = 'skip_zero_total', 'skip_zero_total', None
+        else:
+            # Для КАЖДОЙ строки свой идентификатор, чтобы не было общего payment_id на всю ведомость
+            payment_uuid = str(uuid.uuid4())
+            state, state_kind = f"{kind}:{payment_uuid}", kind
+        params.append((str(vk_str), personal_path, orig_fn, state, state_kind, payment_uuid,
+                       total, fio or '', groups or '', is_repet, now, archive_time))
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    c = conn.cursor()
+    c.executemany(
+        'INSERT INTO vedomosti_users(vk_id, personal_path, original_filename, state, state_kind, payment_uuid, total, fio, groups, is_repet, created_at, archive_at) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
+        params
+    )
+    conn.commit()
+    conn.close()
+
+
 def extract_vk_id(vk_value: str) -> Optional[str]:
     """
     Извлекает числовой VK ID из строки.
@@ -436,6 +993,7 @@ def import_users_from_csv(dest_path: str, original_filename: str):
 
     timestamp = int(time.time())
     count = 0
+    skipped_zero = 0
     
     # Оптимизация: группируем операции с БД
     db_operations = []
@@ -453,11 +1011,21 @@ def import_users_from_csv(dest_path: str, original_filename: str):
                 continue
             
             vk_str = vk_id_extracted
+
+            # Нулевые выплаты не показываются в VK: не пишем для них персональный файл
+            total = row_total(row, TOTAL_COLUMNS)
+            fio = row_value(row, FIO_COLUMNS)
+            groups = row_value(row, GROUPS_COLUMNS)
+            if total == 0:
+                db_operations.append((vk_str, '', original_filename, total, fio, groups))
+                skipped_zero += 1
+                continue
+
             vk_safe = _safe_filename_component(vk_str)
 
             # Формируем читаемое и короткое имя:
             personal_name = f"{vk_safe}_{timestamp}_{idx}_{base_original}.csv"
-            personal_path = os.path.join(users_dir, personal_name)
+            personal_path = _free_personal_path(users_dir, personal_name)
 
             # extract single-row dataframe preserving columns/headers
             try:
@@ -471,7 +1039,7 @@ def import_users_from_csv(dest_path: str, original_filename: str):
                     continue
 
             # Добавляем операцию в очередь вместо немедленного выполнения
-            db_operations.append((vk_str, personal_path, original_filename))
+            db_operations.append((vk_str, personal_path, original_filename, total, fio, groups))
             count += 1
             log.info('Created personal file for vk_id=%s -> %s', vk_str, personal_path)
         except Exception:
@@ -480,24 +1048,9 @@ def import_users_from_csv(dest_path: str, original_filename: str):
     # Выполняем все операции с БД одним пакетом
     if db_operations:
         try:
-            conn = sqlite3.connect(DB_PATH, timeout=30)
-            c = conn.cursor()
-            now = int(time.time())
-            archive_time = now + (36 * 3600)  # 36 часов в секундах
-
-            # Для КАЖДОЙ строки создаём уникальный идентификатор состояния, чтобы не
-            # было одного общего payment_id для всех пользователей одной ведомости.
-            for vk_str, personal_path, original_filename in db_operations:
-                unique_state = f"imported:{uuid.uuid4()}"
-                log.info('Creating unique state for vk_id=%s: %s', vk_str, unique_state)
-                c.execute(
-                    'INSERT INTO vedomosti_users(vk_id, personal_path, original_filename, state, created_at, archive_at) VALUES (?,?,?,?,?,?)',
-                    (str(vk_str), personal_path, original_filename, unique_state, now, archive_time)
-                )
-
-            conn.commit()
-            conn.close()
-            log.info('Bulk inserted %d vedomosti users to database with unique states', len(db_operations))
+            _insert_imported_rows(db_operations, 'imported')
+            log.info('Bulk inserted %d vedomosti users to database with unique states (%d zero-total skipped)',
+                     len(db_operations), skipped_zero)
         except Exception:
             log.exception('Failed to bulk insert vedomosti users')
 
@@ -544,6 +1097,7 @@ def import_users_from_csv_repet(dest_path: str, original_filename: str):
 
     timestamp = int(time.time())
     count = 0
+    skipped_zero = 0
     
     # Оптимизация: группируем операции с БД
     db_operations = []
@@ -565,12 +1119,21 @@ def import_users_from_csv_repet(dest_path: str, original_filename: str):
             else:
                 log.warning('Cannot parse VK ID from: %s', vk_link_str)
                 continue
-            
+
+            # Нулевые выплаты не показываются в VK: не пишем для них персональный файл
+            total = row_total(row, REPET_TOTAL_COLUMNS)
+            fio = row_value(row, REPET_FIO_COLUMNS)
+            groups = row_value(row, GROUPS_COLUMNS)
+            if total == 0:
+                db_operations.append((vk_str, '', original_filename, total, fio, groups))
+                skipped_zero += 1
+                continue
+
             vk_safe = _safe_filename_component(vk_str)
 
             # Формируем читаемое и короткое имя:
             personal_name = f"{vk_safe}_{timestamp}_{idx}_{base_original}.csv"
-            personal_path = os.path.join(users_dir, personal_name)
+            personal_path = _free_personal_path(users_dir, personal_name)
 
             # extract single-row dataframe preserving columns/headers
             try:
@@ -584,7 +1147,7 @@ def import_users_from_csv_repet(dest_path: str, original_filename: str):
                     continue
 
             # Добавляем операцию в очередь вместо немедленного выполнения
-            db_operations.append((vk_str, personal_path, original_filename))
+            db_operations.append((vk_str, personal_path, original_filename, total, fio, groups))
             count += 1
             log.info('Created personal file for repet vk_id=%s -> %s', vk_str, personal_path)
         except Exception:
@@ -593,23 +1156,9 @@ def import_users_from_csv_repet(dest_path: str, original_filename: str):
     # Выполняем все операции с БД одним пакетом
     if db_operations:
         try:
-            conn = sqlite3.connect(DB_PATH, timeout=30)
-            c = conn.cursor()
-            now = int(time.time())
-            archive_time = now + (36 * 3600)  # 36 часов в секундах
-
-            # Для КАЖДОЙ строки создаём уникальный идентификатор состояния с префиксом repet_
-            for vk_str, personal_path, orig_fn in db_operations:
-                unique_state = f"repet_imported:{uuid.uuid4()}"
-                log.info('Creating unique state for repet vk_id=%s: %s', vk_str, unique_state)
-                c.execute(
-                    'INSERT INTO vedomosti_users(vk_id, personal_path, original_filename, state, created_at, archive_at) VALUES (?,?,?,?,?,?)',
-                    (str(vk_str), personal_path, orig_fn, unique_state, now, archive_time)
-                )
-
-            conn.commit()
-            conn.close()
-            log.info('Bulk inserted %d repet vedomosti users to database with unique states', len(db_operations))
+            _insert_imported_rows(db_operations, 'repet_imported')
+            log.info('Bulk inserted %d repet vedomosti users to database with unique states (%d zero-total skipped)',
+                     len(db_operations), skipped_zero)
         except Exception:
             log.exception('Failed to bulk insert repet vedomosti users')
 
@@ -741,9 +1290,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         '/update <название ведомости> — обновить данные в существующей ведомости (заменить файл и уведомить пользователей с изменениями)\n'
         '/liststatements — показать список всех открытых и архивных ведомостей\n'
         '/find <VK ID или ссылка> — поиск ведомостей по VK ID пользователя\n'
-        'Пример: /find https://vk.com/id160898445\n'
+        'Пример: /find https://vk.com/id160898445 (добавьте "архив" в конце, чтобы показать и архивные)\n'
         '/archive <название ведомости> - ведомость переместится в архивную сразу же, она исчезнет у Кураторов в интерфейсе ВК\n'
         '/delete <название1> <название2> ... - удалить одну или несколько архивных ведомостей\n'
+        '/restore <название ведомости> - вернуть архивную ведомость в открытые\n'
+        '/send_batch [repet] - опубликовать все листы книги XLSX (или файлы zip) разом; лист называется '
+        '"<предмет> <тип курса> <блок>" или описан в листе manifest (sheet, subject, course_type, block, kind)\n'
     )
 
 async def description(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -761,9 +1313,12 @@ async def description(update: Update, context: ContextTypes.DEFAULT_TYPE):
         '/update <название ведомости> — обновить данные в существующей ведомости (заменить файл и уведомить пользователей с изменениями)\n'
         '/liststatements — показать список всех открытых и архивных ведомостей\n'
         '/find <VK ID или ссылка> — поиск ведомостей по VK ID пользователя\n'
-        'Пример: /find https://vk.com/id160898445\n'
+        'Пример: /find https://vk.com/id160898445 (добавьте "архив" в конце, чтобы показать и архивные)\n'
         '/archive <название ведомости> - ведомость переместится в архивную сразу же, она исчезнет у Кураторов в интерфейсе ВК\n'
         '/delete <название1> <название2> ... - удалить одну или несколько архивных ведомостей\n'
+        '/restore <название ведомости> - вернуть архивную ведомость в открытые\n'
+        '/send_batch [repet] - опубликовать все листы книги XLSX (или файлы zip) разом; лист называется '
+        '"<предмет> <тип курса> <блок>" или описан в листе manifest (sheet, subject, course_type, block, kind)\n'
     )
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -779,8 +1334,8 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     filename = doc.file_name or f'document_{doc.file_id}'
     ext = os.path.splitext(filename)[1].lstrip('.').lower()
-    if ext not in ALLOWED_EXCEL_EXT:
-        await msg.reply_text(f'Неподдерживаемое расширение .{ext}. Поддерживаемые: .xlsx, .xls, .csv')
+    if ext not in ALLOWED_EXCEL_EXT | ALLOWED_BATCH_EXT:
+        await msg.reply_text(f'Неподдерживаемое расширение .{ext}. Поддерживаемые: .xlsx, .xls, .csv, .zip (для /send_batch)')
         return
 
     os.makedirs(UPLOADS_DIR, exist_ok=True)
@@ -800,14 +1355,24 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text('Не удалось загрузить файл. Попробуйте ещё раз.')
         return
 
+    was_duplicate = False
+    try:
+        local_path, was_duplicate = store_upload(local_path)
+        log.info('Stored upload %s as %s (duplicate=%s)', safe_title, local_path, was_duplicate)
+    except Exception:
+        log.exception('Failed to store upload %s, keeping it in %s', safe_title, UPLOADS_DIR)
+
     save_current_for_user(from_id, file_path=local_path, awaiting_meta=True)
 
     reply = ('Файл сохранён, ожидает публикации.\n'
              'Отправьте инфу командой: /send <предмет> <тип курса> <блок>\n'
              'Пример: /send Русский ОГЭ ПГК\n'
              'Для репетиторов: /send_repet <предмет> <тип курса> <блок>\n'
-             'Пример: /send_repet Физика ОГЭ 1\n\n'
+             'Пример: /send_repet Физика ОГЭ 1\n'
+             'Книгу с несколькими листами или zip опубликуйте целиком: /send_batch (для репетиторов: /send_batch repet)\n\n'
              'Для обновления существующей ведомости используйте: /update <название ведомости>')
+    if was_duplicate:
+        reply = 'Такой файл уже загружался ранее (совпадает содержимое).\n' + reply
     if not DRY_RUN:
         await msg.reply_text(reply)
     else:
@@ -833,21 +1398,17 @@ async def notify_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         conn = sqlite3.connect(DB_PATH, timeout=30)
         c = conn.cursor()
         
-        subject_normalized = subject.replace(' ', '_')
-        
-        c.execute('SELECT DISTINCT vk_id FROM vedomosti_users WHERE original_filename = ?', (subject_normalized + '.csv',))
+        # Имя файла берём из реестра ведомостей; выборка идёт по точному original_filename (индекс)
+        found, candidates = resolve_statement_for_action(subject, 'open')
+        if candidates:
+            conn.close()
+            await update.message.reply_text(statement_candidates_text(subject, candidates))
+            return
+        filename = found[1] if found else subject.replace(' ', '_') + '.csv'
+        log.info('notify: statement "%s" resolved to %s', subject, filename)
+        c.execute("""SELECT DISTINCT vk_id FROM vedomosti_users WHERE original_filename = ? AND IFNULL(state_kind, '') <> 'skip_zero_total'""", (filename,))
         rows = c.fetchall()
         
-        if not rows:
-            flexible_pattern = subject.replace(' ', '[_ ]').replace('_', '[_ ]')
-            c.execute('SELECT DISTINCT vk_id FROM vedomosti_users WHERE original_filename REGEXP ?', (flexible_pattern,))
-            rows = c.fetchall()
-            
-            if not rows:
-                c.execute('SELECT DISTINCT vk_id FROM vedomosti_users WHERE REPLACE(original_filename, "_", " ") LIKE ?', 
-                         ('%' + subject.replace('_', ' ') + '%',))
-                rows = c.fetchall()
-        
         conn.close()
     except Exception:
         log.exception('Failed to read vedomosti_users for notify')
@@ -1025,30 +1586,13 @@ async def notify_repet_command(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     try:
-        # Нормализуем название
-        subject_normalized = subject.replace(' ', '_')
-        target_filename = subject_normalized + '.csv'
-        
-        # Ищем CSV файл ведомости
-        csv_path = None
-        open_path = os.path.join(HOSTING_ROOT, OPEN_DIRNAME)
-        
-        if os.path.exists(open_path):
-            for root, dirs, files in os.walk(open_path):
-                if 'users' in root:
-                    continue
-                for file in files:
-                    if file == target_filename:
-                        csv_path = os.path.join(root, file)
-                        break
-                    # Гибкий поиск
-                    file_normalized = file.replace('.csv', '').replace('_', ' ').lower()
-                    subject_check = subject.replace('_', ' ').lower()
-                    if subject_check in file_normalized or file_normalized in subject_check:
-                        csv_path = os.path.join(root, file)
-                        break
-                if csv_path:
-                    break
+        # Ищем CSV файл ведомости (только точное имя)
+        found, candidates = resolve_statement_for_action(subject, 'open')
+        if candidates:
+            await update.message.reply_text(statement_candidates_text(subject, candidates))
+            return
+        target_filename = found[1] if found else subject.replace(' ', '_') + '.csv'
+        csv_path = os.path.join(*found) if found else None
         
         if not csv_path or not os.path.exists(csv_path):
             await update.message.reply_text(f'Файл ведомости "{subject}" не найден.\nИспользуйте /liststatements для просмотра доступных ведомостей.')
@@ -1216,6 +1760,22 @@ async def send_keyboard_command(update: Update, context: ContextTypes.DEFAULT_TY
 
 # ----------------- other command handlers (unchanged) -----------------
 
+async def _republish_reply(dest: str, report: dict) -> Optional[str]:
+    """Ответ на повторную публикацию уже открытой ведомости (None - ведомость новая)."""
+    statement_name = os.path.splitext(os.path.basename(dest))[0]
+    if report.get('status') == 'unchanged':
+        return (f'Ведомость "{statement_name}" уже опубликована с теми же данными - без изменений.\n'
+                f'Новые файлы и записи не создавались, уведомления не отправлялись.')
+    if report.get('status') == 'updated':
+        updated_users = report.get('updated_users') or []
+        if updated_users:
+            # Рассылка идёт с паузами между сообщениями - не держим цикл событий бота
+            await asyncio.to_thread(send_update_notifications, updated_users, statement_name)
+        return (f'Ведомость "{statement_name}" уже была опубликована и обновлена по изменившимся строкам.\n'
+                f'Обновлено пользователей: {len(updated_users)}')
+    return None
+
+
 async def _process_send_command(from_id: int, text: str, msg_reply_func):
     text = (text or '').strip()
     
@@ -1255,10 +1815,15 @@ async def _process_send_command(from_id: int, text: str, msg_reply_func):
             log.info('[DRY RUN] %s', reply)
         return
 
-    dest = publish_to_hosting(csv_path, subject, course_type, block, uploaded_by=from_id, excel_path=original_excel_path)
+    report = {}
+    # Публикация читает и пишет тысячи файлов и рендерит тексты в пуле процессов - в отдельном потоке
+    dest = await asyncio.to_thread(publish_to_hosting, csv_path, subject, course_type, block, uploaded_by=from_id,
+                                   excel_path=original_excel_path, report=report)
     if dest:
         save_current_for_user(from_id, file_path='', awaiting_meta=False)
-        reply = (f'Ведомость опубликована: {dest}\n'
+        if report.get('status') != 'unchanged':
+            await asyncio.to_thread(refresh_statements_snapshot)
+        reply = await _republish_reply(dest, report) or (f'Ведомость опубликована: {dest}\n'
          f'Название ведомости: {os.path.basename(dest)}')
     else:
         reply = 'Публикация не удалась.'
@@ -1321,10 +1886,14 @@ async def _process_send_repet_command(from_id: int, text: str, msg_reply_func):
             log.info('[DRY RUN] %s', reply)
         return
 
-    dest = publish_to_hosting_repet(csv_path, subject, course_type, block, uploaded_by=from_id, excel_path=original_excel_path)
+    report = {}
+    dest = await asyncio.to_thread(publish_to_hosting_repet, csv_path, subject, course_type, block, uploaded_by=from_id,
+                                   excel_path=original_excel_path, report=report)
     if dest:
         save_current_for_user(from_id, file_path='', awaiting_meta=False)
-        reply = (f'Ведомость для репетиторов опубликована: {dest}\n'
+        if report.get('status') != 'unchanged':
+            await asyncio.to_thread(refresh_statements_snapshot)
+        reply = await _republish_reply(dest, report) or (f'Ведомость для репетиторов опубликована: {dest}\n'
                  f'Название ведомости: {os.path.basename(dest)}')
     else:
         reply = 'Публикация не удалась.'
@@ -1346,6 +1915,246 @@ async def send_repet_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await _process_send_repet_command(from_id, msg.text or '', msg.reply_text)
 
 
+# ----------------- batch publishing -----------------
+
+def _batch_target(name: str) -> Optional[tuple]:
+    """Имя листа/файла "Русский ОГЭ ПГК" (или через _) -> (предмет, тип курса, блок), как в /send."""
+    parts = [p for p in re.split(r'[\s_]+', str(name or '').strip()) if p]
+    if len(parts) < 3:
+        return None
+    return parts[0], parts[1], parts[2]
+
+
+def _read_batch_manifest(df) -> dict:
+    """Лист manifest: sheet, subject, course_type, block[, kind] -> {имя листа: (предмет, тип, блок, kind)}."""
+    columns = {str(col).strip().lower(): col for col in df.columns}
+    sheet_col = columns.get('sheet') or columns.get('file')
+    if not sheet_col or not all(k in columns for k in ('subject', 'course_type', 'block')):
+        raise ValueError('manifest должен содержать столбцы sheet, subject, course_type, block')
+    manifest = {}
+    for _, row in df.iterrows():
+        sheet = str(row.get(sheet_col, '') or '').strip()
+        if not sheet or sheet.lower() == 'nan':
+            continue
+        kind = str(row.get(columns['kind'], '') or '').strip().lower() if 'kind' in columns else ''
+        manifest[sheet] = (str(row[columns['subject']]).strip(), str(row[columns['course_type']]).strip(),
+                           str(row[columns['block']]).strip(), kind)
+    return manifest
+
+
+def _write_sheet_excel(df, xlsx_path: str):
+    """Лист книги отдельным xlsx с теми же адресами ячеек: заголовок - первая строка, данные - со второй.
+
+    Как и при /send, файл кладётся рядом с ведомостью: VK бот читает из него min/max для расчёта RR.
+    """
+    header = [None if str(col).startswith('Unnamed:') else col for col in df.columns]
+    pd.DataFrame([header] + df.values.tolist()).to_excel(xlsx_path, header=False, index=False)
+
+
+def split_batch_upload(path: str, batch_dir: str, default_kind: str = 'regular') -> tuple:
+    """Разбирает книгу (все листы за одно чтение) или zip на отдельные CSV ведомостей.
+
+    Возвращает (items, errors): items - словари source/csv_path/excel_path/subject/course_type/block/kind,
+    errors - строки для отчёта о пропущенных листах/файлах. excel_path - лист книги отдельным
+    xlsx или исходный файл Excel из zip (для CSV из zip - None, как при /send CSV).
+    """
+    sheets = {}
+    excel_members = {}  # имя файла из zip -> (содержимое, расширение) для файлов Excel
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                member = info.filename
+                if info.is_dir() or member.startswith('__MACOSX/') or os.path.basename(member).startswith('.'):
+                    continue
+                stem, ext = os.path.splitext(os.path.basename(member))
+                ext = ext.lstrip('.').lower()
+                if ext not in ALLOWED_EXCEL_EXT:
+                    continue
+                with zf.open(info) as f:
+                    data = io.BytesIO(f.read())
+                try:
+                    if ext == 'csv':
+                        try:
+                            sheets[stem] = pd.read_csv(data, dtype=str)
+                        except UnicodeDecodeError:
+                            data.seek(0)
+                            sheets[stem] = pd.read_csv(data, encoding='cp1251', dtype=str)
+                    else:
+                        # Как и ensure_csv, из файла в архиве берётся первый лист
+                        sheets[stem] = pd.read_excel(data)
+                        excel_members[stem] = (data.getvalue(), ext)
+                except Exception:
+                    log.exception('Failed to read %s from %s', member, path)
+                    sheets[stem] = None
+    else:
+        sheets = pd.read_excel(path, sheet_name=None)
+
+    errors = []
+    manifest = None
+    for name in list(sheets):
+        if name.strip().lower() in BATCH_MANIFEST_NAMES:
+            df = sheets.pop(name)
+            try:
+                manifest = _read_batch_manifest(df)
+            except Exception as e:
+                errors.append(f'{name}: {e}')
+                return [], errors
+
+    os.makedirs(batch_dir, exist_ok=True)
+    items = []
+    seen_targets = {}  # (предмет, тип, блок) -> kind: обычная и репетиторская ведомости пишутся в одну папку
+    for name, df in sheets.items():
+        if manifest is not None:
+            target = manifest.get(name.strip())
+            if not target:
+                errors.append(f'{name}: нет строки в manifest, пропущен')
+                continue
+            subject, course_type, block, kind = target
+        else:
+            target = _batch_target(name)
+            if not target:
+                errors.append(f'{name}: имя должно быть "<предмет> <тип курса> <блок>", пропущен')
+                continue
+            subject, course_type, block = target
+            kind = ''
+        if df is None:
+            errors.append(f'{name}: не удалось прочитать')
+            continue
+        if df.empty:
+            errors.append(f'{name}: пустой лист, пропущен')
+            continue
+        kind = 'repet' if kind in ('repet', 'репет', 'репетиторы') else (default_kind if not kind else 'regular')
+        key = (subject.lower(), course_type.lower(), block.lower())
+        if key in seen_targets:
+            if seen_targets[key] != kind:
+                errors.append(f'{name}: обычная и репетиторская ведомости {subject} {course_type} {block} '
+                              f'попадают в одну папку, пропущен')
+            else:
+                errors.append(f'{name}: ведомость {subject} {course_type} {block} уже есть в этой загрузке, пропущен')
+            continue
+        seen_targets[key] = kind
+        csv_path = os.path.join(batch_dir, f'{len(items):03d}.csv')
+        df.to_csv(csv_path, index=False, encoding='utf-8')
+        excel_path = None
+        try:
+            if name in excel_members:
+                content, ext = excel_members[name]
+                excel_path = os.path.join(batch_dir, f'{len(items):03d}.{ext}')
+                with open(excel_path, 'wb') as f:
+                    f.write(content)
+            elif not path.lower().endswith('.zip'):
+                excel_path = os.path.join(batch_dir, f'{len(items):03d}.xlsx')
+                _write_sheet_excel(df, excel_path)
+        except Exception:
+            log.exception('Failed to save Excel copy of %s, publishing without it', name)
+            excel_path = None
+        items.append({'source': name, 'csv_path': csv_path, 'excel_path': excel_path, 'subject': subject,
+                      'course_type': course_type, 'block': block, 'kind': kind})
+    return items, errors
+
+
+def _publish_batch_item(item: dict, uploaded_by: int) -> dict:
+    """Публикует одну ведомость пакета (выполняется в отдельном процессе)."""
+    result = {'source': item['source'], 'dest': None, 'status': 'failed'}
+    publish = publish_to_hosting_repet if item['kind'] == 'repet' else publish_to_hosting
+    report = {}
+    try:
+        dest = publish(item['csv_path'], item['subject'], item['course_type'], item['block'],
+                       uploaded_by=uploaded_by, excel_path=item.get('excel_path'), report=report)
+    except Exception as e:
+        log.exception('Batch publish of %s failed', item['source'])
+        result['error'] = str(e)
+        return result
+    if dest:
+        result.update(report, dest=dest)
+    return result
+
+
+def publish_batch(path: str, uploaded_by: int, default_kind: str = 'regular') -> tuple:
+    """Публикует все ведомости из книги/zip параллельно; возвращает (results, errors)."""
+    # Свой каталог на каждый запуск: одинаковая книга от двух админов (или повтор во время
+    # публикации) не должна делить файлы, которые другой запуск удалит по окончании
+    batch_root = os.path.join(UPLOADS_DIR, 'batch')
+    os.makedirs(batch_root, exist_ok=True)
+    batch_dir = tempfile.mkdtemp(prefix=os.path.splitext(os.path.basename(path))[0] + '-', dir=batch_root)
+    try:
+        items, errors = split_batch_upload(path, batch_dir, default_kind)
+        if not items:
+            return [], errors
+        log.info('Batch publish of %s: %d statements, %d workers', path, len(items), BATCH_PUBLISH_WORKERS)
+        # spawn, а не fork: процесс бота держит потоки (архиватор, рассылки) и соединения с БД
+        workers = max(1, min(BATCH_PUBLISH_WORKERS, len(items)))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(_publish_batch_item, item, uploaded_by) for item in items]
+            results = []
+            for item, future in zip(items, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    log.exception('Batch worker failed for %s', item['source'])
+                    results.append({'source': item['source'], 'dest': None, 'status': 'failed', 'error': str(e)})
+        return results, errors
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+async def send_batch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /send_batch [repet]: публикует все листы загруженной книги (или файлы zip)."""
+    msg = update.message
+    from_id = msg.from_user.id
+    if not is_admin(from_id):
+        log.info('Ignoring /send_batch from non-admin %s', from_id)
+        await msg.reply_text('Только админы могут публиковать файлы.')
+        return
+
+    default_kind = 'repet' if context.args and context.args[0].lower() in ('repet', 'репет') else 'regular'
+    file_path = load_current_for_user(from_id).get('file_path', '')
+    if not file_path:
+        await msg.reply_text('Нет ожидающего файла. Сначала пришлите книгу XLSX с листами или zip.')
+        return
+    if os.path.splitext(file_path)[1].lstrip('.').lower() not in ALLOWED_BATCH_EXT:
+        await msg.reply_text('Для /send_batch нужна книга XLSX/XLS или zip. Одиночный CSV публикуйте через /send.')
+        return
+
+    await msg.reply_text('Публикую ведомости из файла, это может занять несколько минут...')
+    try:
+        results, errors = await asyncio.get_running_loop().run_in_executor(
+            None, publish_batch, file_path, from_id, default_kind)
+    except Exception as e:
+        log.exception('Error in send_batch command')
+        await msg.reply_text(f'Ошибка при пакетной публикации: {str(e)}')
+        return
+
+    lines = []
+    published = 0
+    for result in results:
+        dest = result.get('dest')
+        if not dest:
+            lines.append(f'❌ {result["source"]}: публикация не удалась {result.get("error", "")}'.rstrip())
+            continue
+        published += 1
+        statement_name = os.path.splitext(os.path.basename(dest))[0]
+        if result.get('status') == 'unchanged':
+            lines.append(f'➖ {statement_name}: без изменений')
+        elif result.get('status') == 'updated':
+            updated_users = result.get('updated_users') or []
+            if updated_users:
+                await asyncio.to_thread(send_update_notifications, updated_users, statement_name)
+            lines.append(f'🔄 {statement_name}: обновлено пользователей {len(updated_users)}')
+        else:
+            lines.append(f'✅ {statement_name}: опубликована')
+    lines.extend(f'⚠️ {error}' for error in errors)
+    if published:
+        save_current_for_user(from_id, file_path='', awaiting_meta=False)
+        await asyncio.to_thread(refresh_statements_snapshot)
+
+    report = f'Пакетная публикация: {published} из {len(results)} ведомостей.\n\n' + '\n'.join(lines)
+    # Telegram ограничивает длину сообщений до 4096 символов
+    if len(report) > 4000:
+        report = report[:4000] + '\n...(отчет обрезан)'
+    await msg.reply_text(report)
+
+
 async def addadmin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     from_id = msg.from_user.id
@@ -1378,15 +2187,9 @@ async def addadmin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 log.info('Resolved @%s via get_chat -> id=%s', username, target_id)
             except Exception as e:
                 log.info('get_chat failed for @%s: %s — пытаемся локальную базу', username, e)
-                users = load_users()
-                if username in users:
-                    try:
-                        target_id = int(users[username])
-                        log.info('Resolved @%s via local users.json -> id=%s', username, target_id)
-                    except Exception:
-                        target_id = None
-                else:
-                    target_id = None
+                target_id = find_user_id_by_username(username)
+                if target_id is not None:
+                    log.info('Resolved @%s via local users table -> id=%s', username, target_id)
 
     if not target_id:
         await msg.reply_text(
@@ -1441,15 +2244,9 @@ async def deladmin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 log.info('Resolved @%s via get_chat -> id=%s', username, target_id)
             except Exception as e:
                 log.info('get_chat failed for @%s: %s — пытаемся локальную базу', username, e)
-                users = load_users()
-                if username in users:
-                    try:
-                        target_id = int(users[username])
-                        log.info('Resolved @%s via local users.json -> id=%s', username, target_id)
-                    except Exception:
-                        target_id = None
-                else:
-                    target_id = None
+                target_id = find_user_id_by_username(username)
+                if target_id is not None:
+                    log.info('Resolved @%s via local users table -> id=%s', username, target_id)
 
     if not target_id:
         await msg.reply_text(
@@ -1487,10 +2284,9 @@ async def listadmins_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await msg.reply_text('Список админов пуст.')
         return
 
-    users = load_users()
     lines = []
     for aid in sorted(ADMIN_IDS):
-        uname = users.get(str(aid)) or ''
+        uname = find_username(aid)
         if uname:
             lines.append(f'@{uname} ({aid})')
         else:
@@ -1544,6 +2340,8 @@ async def liststatements_command(update: Update, context: ContextTypes.DEFAULT_T
                 for file in files:
                     if file.endswith('.csv'):
                         archive_statements.append(file)
+                    elif file.endswith(ARCHIVE_CONTAINER_EXT):
+                        archive_statements.append(archived_statement_filename(file))
 
         # Формируем ответ
         response_lines = []
@@ -1629,17 +2427,12 @@ async def archive_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     statement_name = ' '.join(context.args).strip()
     
     try:
-        # Нормализуем название (как в notify_command)
-        statement_normalized = statement_name.replace(' ', '_')
-        target_filename = statement_normalized + '.csv'
-        
-        # Ищем ведомость в открытых папках
-        statement_folder = find_statement_folder(target_filename)
-        if not statement_folder:
-            # Пробуем гибкий поиск
-            statement_folder = find_statement_folder_flexible(statement_name)
-            if statement_folder:
-                target_filename = os.path.basename([f for f in os.listdir(statement_folder) if f.endswith('.csv')][0])
+        # Ищем ведомость в открытых папках (только точное имя)
+        found, candidates = resolve_statement_for_action(statement_name, 'open')
+        if candidates:
+            await msg.reply_text(statement_candidates_text(statement_name, candidates))
+            return
+        statement_folder, target_filename = found or (None, None)
         
         if not statement_folder:
             await msg.reply_text(f'Ведомость "{statement_name}" не найдена в открытых папках.\nИспользуйте /liststatements для просмотра доступных ведомостей.')
@@ -1654,12 +2447,13 @@ async def archive_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         success = archive_statement_manually(target_filename, statement_folder)
         
         if success:
-            # Удаляем пользователей из БД
-            removed_count = remove_users_from_statement(target_filename)
+            # Переносим пользователей в архивную БД (история остаётся для /find)
+            removed_count = move_statement_to_archive(target_filename)
+            refresh_statements_snapshot()
             await msg.reply_text(
                 f'Ведомость "{statement_name}" успешно заархивирована.\n'
                 f'Папка перемещена в архив.\n'
-                f'Удалено записей из БД: {removed_count}'
+                f'Перенесено записей в архивную БД: {removed_count}'
             )
         else:
             await msg.reply_text(f'Ошибка при архивации ведомости "{statement_name}". Проверьте логи.')
@@ -1669,47 +2463,40 @@ async def archive_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text(f'Ошибка при архивации: {str(e)}')
 
 
+def resolve_statement_for_action(name: str, location: str = 'open'):
+    """Ведомость для команды, которая с ней что-то делает (рассылка, архивация, восстановление, /update).
+
+    Действуем только по точному совпадению нормализованного имени: опечатка не должна
+    разослать уведомления или восстановить другую ведомость. Возвращает
+    ((folder, filename), []) или (None, [(folder, filename), ...] - похожие ведомости).
+    """
+    found = resolve_statement(name, location, exact=True, limit=1)
+    if found:
+        return found[0], []
+    return None, resolve_statement(name, location)
+
+
+def statement_candidates_text(name: str, candidates: list) -> str:
+    """Ответ, когда точного совпадения нет: список похожих ведомостей вместо действия над первой."""
+    lines = [f'Ведомость "{name}" не найдена. Похожие ведомости:']
+    lines += [f'• {os.path.splitext(filename)[0]}' for _, filename in candidates]
+    lines.append('Повторите команду с точным названием.')
+    return '\n'.join(lines)
+
+
 def find_statement_folder(filename: str) -> str:
-    """Находит папку содержащую указанный файл ведомости."""
-    open_path = os.path.join(HOSTING_ROOT, OPEN_DIRNAME)
-    
-    if not os.path.exists(open_path):
-        return None
-    
-    for root, dirs, files in os.walk(open_path):
-        # Пропускаем папки users
-        if 'users' in root:
-            continue
-        
-        if filename in files:
-            return root
-    
-    return None
+    """Находит папку открытой ведомости по точному имени файла."""
+    found = resolve_statement(filename, 'open', exact=True)
+    for folder, name in found:
+        if name == filename:
+            return folder
+    return found[0][0] if found else None
 
 
 def find_statement_folder_flexible(statement_name: str) -> str:
-    """Гибкий поиск папки ведомости (игнорирует различия пробелов и подчеркиваний)."""
-    open_path = os.path.join(HOSTING_ROOT, OPEN_DIRNAME)
-    
-    if not os.path.exists(open_path):
-        return None
-    
-    # Нормализуем искомое название
-    normalized_search = statement_name.replace(' ', '_').replace('_', ' ').lower()
-    
-    for root, dirs, files in os.walk(open_path):
-        if 'users' in root:
-            continue
-        
-        for file in files:
-            if file.endswith('.csv'):
-                # Нормализуем найденное название
-                file_normalized = file.replace('.csv', '').replace('_', ' ').lower()
-                
-                if normalized_search in file_normalized or file_normalized in normalized_search:
-                    return root
-    
-    return None
+    """Гибкий поиск папки ведомости (игнорирует различия пробелов, подчеркиваний и регистра)."""
+    found = resolve_statement(statement_name, 'open')
+    return found[0][0] if found else None
 
 
 def count_users_in_statement(filename: str) -> int:
@@ -1726,31 +2513,155 @@ def count_users_in_statement(filename: str) -> int:
         return 0
 
 
-def archive_statement_manually(filename: str, statement_folder: str) -> bool:
-    """Архивирует ведомость вручную (перемещает всю папку в архив)."""
+# ----------------- archive containers -----------------
+# Заархивированная ведомость хранится одним zip-файлом archive/<предмет>/<тип>/<ведомость>.zip
+# вместо папки с тысячами персональных CSV. Центральный каталог zip служит индексом
+# членов: читать отдельные файлы можно без распаковки. В комментарии архива записан
+# исходный путь папки относительно open, по нему /restore возвращает ведомость на место.
+# Если ведомость с тем же именем уже лежит в архиве (её опубликовали заново и снова
+# архивировали), новый контейнер получает суффикс с временем архивации: <ведомость>~<время>.zip.
+
+ARCHIVE_CONTAINER_EXT = '.zip'
+_ARCHIVE_STAMP_RE = re.compile(r'~\d{8}-\d{6}(?:-\d+)?$')
+
+
+def archived_statement_filename(container_name: str) -> str:
+    """Имя файла ведомости по имени её контейнера: 'Русский_ОГЭ~20250101-120000.zip' -> 'Русский_ОГЭ.csv'."""
+    return _ARCHIVE_STAMP_RE.sub('', os.path.splitext(container_name)[0]) + '.csv'
+
+
+def archive_container_path(filename: str, relative_folder: str) -> str:
+    """Путь нового контейнера ведомости; существующий контейнер с тем же именем не занимается."""
+    archive_path = os.path.join(HOSTING_ROOT, ARCHIVE_DIRNAME)
+    parent = os.path.dirname(relative_folder) if relative_folder not in ('', '.') else ''
+    base = os.path.join(archive_path, parent, os.path.splitext(filename)[0])
+    path = base + ARCHIVE_CONTAINER_EXT
+    if not os.path.exists(path):
+        return path
+    stamped = base + '~' + time.strftime('%Y%m%d-%H%M%S')
+    path = stamped + ARCHIVE_CONTAINER_EXT
+    n = 1
+    while os.path.exists(path):
+        n += 1
+        path = f'{stamped}-{n}{ARCHIVE_CONTAINER_EXT}'
+    return path
+
+
+def pack_statement_folder(statement_folder: str, container_path: str, relative_folder: str) -> bool:
+    """Упаковывает папку ведомости в zip (через временный файл) и удаляет папку.
+
+    Существующий контейнер не перезаписывается: путь выбирает archive_container_path.
+    """
+    if os.path.exists(container_path):
+        log.error('Archive container %s already exists, not packing %s over it', container_path, statement_folder)
+        return False
+    tmp_path = container_path + '.tmp'
     try:
-        archive_path = os.path.join(HOSTING_ROOT, ARCHIVE_DIRNAME)
-        open_path = os.path.join(HOSTING_ROOT, OPEN_DIRNAME)
-        
-        # Создаем структуру архива
-        os.makedirs(archive_path, exist_ok=True)
-        
-        # Определяем относительный путь от open до папки с ведомостью
-        relative_path = os.path.relpath(statement_folder, open_path)
-        archive_folder = os.path.join(archive_path, relative_path)
-        
-        # Создаем родительские папки в архиве
-        os.makedirs(os.path.dirname(archive_folder), exist_ok=True)
-        
-        # Перемещаем всю папку с ведомостью в архив
-        if os.path.exists(statement_folder):
-            shutil.move(statement_folder, archive_folder)
-            log.info('Manually moved statement folder to archive: %s -> %s', statement_folder, archive_folder)
-            return True
+        os.makedirs(os.path.dirname(container_path) or '.', exist_ok=True)
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+            zf.comment = relative_folder.replace(os.sep, '/').encode('utf-8')
+            for root, dirs, files in os.walk(statement_folder):
+                dirs.sort()
+                for file in sorted(files):
+                    path = os.path.join(root, file)
+                    zf.write(path, os.path.relpath(path, statement_folder).replace(os.sep, '/'))
+        os.replace(tmp_path, container_path)
+        shutil.rmtree(statement_folder)
+        return True
+    except Exception:
+        log.exception('Failed to pack statement folder %s into %s', statement_folder, container_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def archived_statement_members(container_path: str) -> list:
+    """Имена файлов внутри архивной ведомости (без распаковки)."""
+    with zipfile.ZipFile(container_path) as zf:
+        return zf.namelist()
+
+
+def read_archived_member(container_path: str, member: str) -> bytes:
+    """Читает один файл архивной ведомости, например 'users/<файл>.csv'."""
+    with zipfile.ZipFile(container_path) as zf:
+        return zf.read(member)
+
+
+def remove_archived_statement(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def _archive_statement_folder(filename: str, statement_folder: str) -> bool:
+    """Перемещает папку открытой ведомости в архив одним zip-контейнером."""
+    open_path = os.path.join(HOSTING_ROOT, OPEN_DIRNAME)
+    if not statement_folder or not os.path.exists(statement_folder):
+        log.warning('Statement folder not found: %s', statement_folder)
+        return False
+    relative_path = os.path.relpath(statement_folder, open_path)
+    container_path = archive_container_path(filename, relative_path)
+    if not pack_statement_folder(statement_folder, container_path, relative_path):
+        return False
+    register_statement(filename, container_path, 'archive')
+    log.info('Packed statement folder into archive: %s -> %s', statement_folder, container_path)
+    return True
+
+
+def pack_legacy_archive_folders() -> int:
+    """Упаковывает архивные папки, перемещённые до появления контейнеров."""
+    archive_path = os.path.join(HOSTING_ROOT, ARCHIVE_DIRNAME)
+    if not os.path.exists(archive_path):
+        return 0
+    folders = []
+    for root, dirs, files in os.walk(archive_path):
+        if 'users' in root:
+            continue
+        csvs = [f for f in files if f.endswith('.csv')]
+        if csvs:
+            folders.append((root, csvs[0]))
+            dirs[:] = []
+    packed = 0
+    for folder, filename in folders:
+        relative_path = os.path.relpath(folder, archive_path)
+        container_path = archive_container_path(filename, relative_path)
+        if pack_statement_folder(folder, container_path, relative_path):
+            register_statement(filename, container_path, 'archive')
+            packed += 1
+    if packed:
+        log.info('Packed %d legacy archive folders into containers', packed)
+    return packed
+
+
+def restore_archived_statement(container_path: str, filename: str) -> Optional[str]:
+    """Распаковывает архивную ведомость обратно в open; возвращает папку ведомости."""
+    open_path = os.path.join(HOSTING_ROOT, OPEN_DIRNAME)
+    archive_path = os.path.join(HOSTING_ROOT, ARCHIVE_DIRNAME)
+    try:
+        if os.path.isdir(container_path):
+            # Папка, ещё не упакованная в контейнер
+            dest_folder = os.path.join(open_path, os.path.relpath(container_path, archive_path))
+            os.makedirs(os.path.dirname(dest_folder), exist_ok=True)
+            shutil.move(container_path, dest_folder)
         else:
-            log.warning('Statement folder not found: %s', statement_folder)
-            return False
-            
+            with zipfile.ZipFile(container_path) as zf:
+                relative_folder = zf.comment.decode('utf-8') or os.path.splitext(filename)[0]
+                dest_folder = os.path.join(open_path, *relative_folder.split('/'))
+                zf.extractall(dest_folder)
+            os.remove(container_path)
+        register_statement(filename, dest_folder, 'open')
+        log.info('Restored archived statement %s -> %s', container_path, dest_folder)
+        return dest_folder
+    except Exception:
+        log.exception('Failed to restore archived statement %s', container_path)
+        return None
+
+
+def archive_statement_manually(filename: str, statement_folder: str) -> bool:
+    """Архивирует ведомость вручную (упаковывает всю папку в архивный контейнер)."""
+    try:
+        return _archive_statement_folder(filename, statement_folder)
     except Exception:
         log.exception('Failed to manually archive statement %s from folder %s', filename, statement_folder)
         return False
@@ -1785,8 +2696,24 @@ def remove_users_from_statement(filename: str) -> int:
         log.exception('Failed to remove users from DB for statement %s', filename)
         return 0
 
-def update_statement_data(statement_folder: str, target_filename: str, new_csv_path: str) -> tuple[bool, list]:
-    """Обновляет данные ведомости новым CSV файлом и возвращает список пользователей с изменениями."""
+def _reset_row_keys(c, where: str, params: tuple) -> list:
+    """(vk_id, payment_uuid, id) строк, которые сбросит UPDATE с тем же условием (для vk_sessions)."""
+    return c.execute(f'SELECT vk_id, payment_uuid, id FROM vedomosti_users WHERE {where}', params).fetchall()
+
+
+# Переписанная строка ведомости: согласование сбрасывается, fio/groups/total обновляются из новой строки
+_RESET_UPDATED_ROW_SQL = """status = NULL, disagree_reason = NULL, confirmed_at = NULL, render_version = NULL,
+                             fio = CASE WHEN is_repet = 1 THEN ? ELSE ? END, groups = ?,
+                             total = CASE WHEN is_repet = 1 THEN ? ELSE ? END"""
+
+
+def update_statement_data(statement_folder: str, target_filename: str, new_csv_path: str,
+                          import_new=None) -> tuple[bool, list]:
+    """Обновляет данные ведомости новым CSV файлом и возвращает список пользователей с изменениями.
+
+    import_new - функция импорта (import_users_from_csv); если задана, строки, которых
+    не было в старом файле, импортируются ею, иначе они пропускаются, как раньше.
+    """
     try:
         def _normalize_value(val):
             if pd.isna(val) or val is None:
@@ -1936,7 +2863,7 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
             vk_id = extract_vk_id(raw_vk_id)
             if not vk_id:
                 continue
-            groups = str(row.get('groups', '')).strip()
+            groups = (row_value(row, ('groups',)) or '').strip()
             groups_normalized = normalize_groups(groups)
             if groups_normalized:
                 unique_key = f"{vk_id}_{groups_normalized}"
@@ -1954,7 +2881,7 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
             vk_id = extract_vk_id(raw_vk_id)
             if not vk_id:
                 continue
-            groups = str(row.get('groups', '')).strip()
+            groups = (row_value(row, ('groups',)) or '').strip()
             groups_normalized = normalize_groups(groups)
             if groups_normalized:
                 unique_key = f"{vk_id}_{groups_normalized}"
@@ -1972,6 +2899,7 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
         # Находим пользователей с изменениями
         updated_users = []  # Список vk_id с изменениями (может содержать дубликаты если у vk_id несколько строк)
         updated_entries = []  # Список (vk_id, groups, new_row) для обновления personal файлов
+        new_rows = []  # Строки, которых не было в старом файле
         users_dir = os.path.join(statement_folder, 'users')
             
             # Сравниваем ключевые поля (исключаем служебные поля)
@@ -1987,6 +2915,7 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
             'fines', 'total'
         ]
         
+        sample_keys = set(list(new_data.keys())[:2])
         for unique_key, new_entry in new_data.items():
             vk_id = new_entry['vk_id']
             new_row = new_entry['row']
@@ -1994,19 +2923,21 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
             
             old_entry = old_data.get(unique_key)
             
-            # Если записи нет в старом файле по unique_key, пробуем найти по vk_id
-            if not old_entry:
-                # Ищем любую запись с таким же vk_id (на случай если изменились только groups)
+            # Если записи нет в старом файле по unique_key, пробуем найти по vk_id (изменились только groups).
+            # Только в /update (import_new не задан) и только среди строк, исчезнувших из нового файла:
+            # при публикации такая строка - новая выплата куратора, а не правка существующей
+            if not old_entry and import_new is None:
                 for old_key, old_val in old_data.items():
-                    if old_val.get('vk_id') == vk_id:
+                    if old_val.get('vk_id') == vk_id and old_key not in new_data:
                         old_entry = old_val
                         log.info('Update: key=%s vk_id=%s found by vk_id match (old_key=%s, new_key=%s)', 
                                 unique_key, vk_id, old_key, unique_key)
                         break
             
-            # Если записи нет в старом файле - это новая запись, пропускаем
+            # Если записи нет в старом файле - это новая запись, пропускаем (или импортируем ниже)
             if not old_entry:
                 log.debug('Update: key=%s vk_id=%s is NEW (not in old file), skipping', unique_key, vk_id)
+                new_rows.append(new_row)
                 continue
             
             old_row = old_entry.get('row', {})
@@ -2018,7 +2949,10 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
             
             has_changes = False
             changed_field = None
-            for field in key_fields:
+            # Строка совпадает целиком (те же столбцы и значения) - поля сравнивать не нужно
+            same_row = old_row.keys() == new_row.keys() and all(
+                _normalize_value(old_row[k]) == _normalize_value(new_row[k]) for k in new_row)
+            for field in ([] if same_row else key_fields):
                 old_val = _normalize_value(_get_field(old_row, field))
                 new_val = _normalize_value(_get_field(new_row, field))
                 if old_val != new_val:
@@ -2027,7 +2961,7 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
                     log.info('Update: key=%s vk_id=%s field=%s changed: old="%s" new="%s"', unique_key, vk_id, field, old_val[:50] if old_val else '', new_val[:50] if new_val else '')
                     break
             
-            if not has_changes and unique_key in list(new_data.keys())[:2]:
+            if not has_changes and unique_key in sample_keys:
                 # Логируем первые 2 записи для отладки
                 log.info('Update: key=%s vk_id=%s NO changes detected. Sample old_row keys: %s', unique_key, vk_id, list(old_row.keys())[:10])
                 log.info('Update: key=%s vk_id=%s Sample new_row keys: %s', unique_key, vk_id, list(new_row.keys())[:10])
@@ -2049,7 +2983,7 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
         
         # Обновляем персональные файлы для каждой изменённой записи
         # Также собираем информацию о personal_path для обновления в БД
-        updated_personal_paths = []  # Список (vk_id, personal_path) для обновления в БД
+        updated_personal_paths = []  # Список (vk_id, personal_path, new_row) для обновления в БД
         
         for vk_id, groups, new_row in updated_entries:
             # Ищем персональный файл для этой конкретной записи (по vk_id и groups)
@@ -2057,19 +2991,19 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
             all_files_for_vk = []
             
             for file in os.listdir(users_dir):
-                    if file.startswith(f"{vk_id}_") and file.endswith('.csv'):
-                        file_path = os.path.join(users_dir, file)
-                        all_files_for_vk.append(file_path)
-                    # Проверяем содержимое файла чтобы найти нужную группу
-                    try:
-                        df = pd.read_csv(file_path, dtype=str)
-                        if not df.empty:
-                            file_groups = str(df.iloc[0].get('groups', '')).strip()
-                            if file_groups == groups:
-                                matched_file = file_path
-                                break
-                    except Exception:
-                        pass
+                if not (file.startswith(f"{vk_id}_") and file.endswith('.csv')):
+                    continue
+                file_path = os.path.join(users_dir, file)
+                all_files_for_vk.append(file_path)
+                # Проверяем содержимое файла чтобы найти нужную группу
+                try:
+                    row = snapshot.read_first_csv_row(file_path)
+                    if row:
+                        if (row.get('groups') or '').strip() == groups:
+                            matched_file = file_path
+                            break
+                except Exception:
+                    pass
             
             if not matched_file and all_files_for_vk:
                 # Если не нашли по группе, берём самый новый файл этого vk_id
@@ -2082,7 +3016,7 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
                     try:
                         new_personal_df.to_csv(matched_file, index=False, encoding='utf-8')
                         log.info('Updated personal file for vk_id=%s groups=%s: %s', vk_id, groups, matched_file)
-                        updated_personal_paths.append((vk_id, matched_file))
+                        updated_personal_paths.append((vk_id, matched_file, new_row))
                     except Exception as e:
                         log.exception('Failed to update personal file for vk_id=%s groups=%s', vk_id, groups)
         
@@ -2100,32 +3034,62 @@ def update_statement_data(statement_folder: str, target_filename: str, new_csv_p
             c = conn.cursor()
             
             reset_count = 0
-            for vk_id, personal_path in updated_personal_paths:
+            reset_rows = []
+            for vk_id, personal_path, new_row in updated_personal_paths:
+                # Краткие данные для списка выплат в VK берутся из новой строки (столбцы репетиторских
+                # ведомостей отличаются, поэтому значение выбирается по is_repet записи)
+                summary = (row_value(new_row, REPET_FIO_COLUMNS) or '', row_value(new_row, FIO_COLUMNS) or '',
+                           row_value(new_row, GROUPS_COLUMNS) or '',
+                           row_total(new_row, REPET_TOTAL_COLUMNS), row_total(new_row, TOTAL_COLUMNS))
                 # Сбрасываем статус только для записи с этим personal_path
-                c.execute('''UPDATE vedomosti_users 
-                             SET status = NULL, disagree_reason = NULL, confirmed_at = NULL 
-                             WHERE personal_path = ?''',
-                         (personal_path,))
+                where, params = 'personal_path = ?', (personal_path,)
+                reset_rows += _reset_row_keys(c, where, params)
+                c.execute(f'''UPDATE vedomosti_users 
+                             SET {_RESET_UPDATED_ROW_SQL}
+                             WHERE {where}''',
+                         summary + params)
                 affected = c.rowcount
                 log.info('Reset agreement status for personal_path=%s (affected rows: %d)', personal_path, affected)
                 
                 # Если не нашли по personal_path, пробуем по vk_id + original_filename + LIKE personal_path
                 if affected == 0:
-                    c.execute('''UPDATE vedomosti_users 
-                                 SET status = NULL, disagree_reason = NULL, confirmed_at = NULL 
-                                 WHERE vk_id = ? AND original_filename = ? AND personal_path LIKE ?''',
-                             (vk_id, target_filename, f'%{os.path.basename(personal_path)}%'))
+                    where = 'vk_id = ? AND original_filename = ? AND personal_path LIKE ?'
+                    params = (vk_id, target_filename, f'%{os.path.basename(personal_path)}%')
+                    reset_rows += _reset_row_keys(c, where, params)
+                    c.execute(f'''UPDATE vedomosti_users 
+                                 SET {_RESET_UPDATED_ROW_SQL}
+                                 WHERE {where}''',
+                             summary + params)
                     affected = c.rowcount
                     log.info('Second attempt: Reset for vk_id=%s path_like=%s (affected rows: %d)', vk_id, os.path.basename(personal_path), affected)
                 
                 if affected > 0:
                     reset_count += affected
             
+            # Незавершённые шаги согласования сброшенных строк в сессиях VK бота тоже сбрасываем,
+            # иначе VK бот вернёт выплате старый шаг поверх нового статуса
+            migrations.reset_session_flows(conn, reset_rows, time.time())
             conn.commit()
             conn.close()
             log.info('Reset agreement status in database for %d entries', reset_count)
         except Exception:
             log.exception('Failed to reset agreement status in database')
+
+        if import_new and new_rows:
+            # Импортируем только новые строки через временный CSV рядом с ведомостью
+            tmp_path = os.path.join(statement_folder, f'.new_rows_{os.getpid()}.csv')
+            try:
+                pd.DataFrame(new_rows, columns=new_df.columns).to_csv(tmp_path, index=False, encoding='utf-8')
+                import_new(tmp_path, original_filename=target_filename)
+                log.info('Imported %d new rows into %s', len(new_rows), target_filename)
+            except Exception:
+                log.exception('Failed to import new rows into %s', target_filename)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        # Тексты выплат: переписанные файлы (их render_version сброшен выше) и новые строки
+        prerender_statement_texts(target_filename, personal_paths=())
         
         return True, updated_users
         
@@ -2183,33 +3147,13 @@ def send_update_notifications(updated_users: list, statement_name: str):
 
 
 def find_archived_statement(statement_name: str) -> tuple:
-    """Находит архивную ведомость по названию. Возвращает (statement_folder, target_filename) или (None, None)"""
-    archive_path = os.path.join(HOSTING_ROOT, ARCHIVE_DIRNAME)
-    
-    if not os.path.exists(archive_path):
-        return None, None
-    
-    # Очищаем название от возможных символов маркера списка
-    
-            # Ищем точное совпадение
-        # Очищаем название от возможных символов маркера списка
-    statement_name = statement_name.strip().lstrip('•').strip()
-    # Убираем расширение .csv если оно есть
-    if statement_name.endswith('.csv'):
-        statement_name = statement_name[:-4]
-    
-    # Ищем только точное совпадение (без учета расширения файла и регистра)
-    for root, dirs, files in os.walk(archive_path):
-        if 'users' in root:
-            continue
-        for file in files:
-            if file.endswith('.csv'):
-                file_base = os.path.splitext(file)[0]
-                # Точное совпадение без учета регистра
-                if file_base.lower() == statement_name.lower():
-                    return root, file
+    """Находит архивную ведомость по названию. Возвращает (statement_folder, target_filename) или (None, None)
 
-    return None, None
+    Удаление необратимо, поэтому ищем только точное совпадение нормализованного имени
+    (без учёта регистра, расширения .csv и разницы между "_" и пробелом).
+    """
+    found = resolve_statement(statement_name, 'archive', exact=True, limit=1)
+    return found[0] if found else (None, None)
 
 
 async def delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2291,11 +3235,18 @@ async def delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 users_count = count_users_in_statement(target_filename)  # подсчитываем количество пользователей в БД
                 
                 # Удаляем папку с ведомостью
-                shutil.rmtree(statement_folder)
+                remove_archived_statement(statement_folder)
+                unregister_statement(target_filename, statement_folder)
                 log.info('Deleted archived statement folder: %s', statement_folder)
             
-            # Удаляем записи из БД
-                removed_count = remove_users_from_statement(target_filename)
+            # Удаляем записи из БД и из архивной истории, если других копий с этим именем не осталось:
+            # строки vedomosti_users различаются только именем файла
+                remaining = statement_locations(target_filename)
+                removed_count = 0
+                if 'open' not in remaining:
+                    removed_count += remove_users_from_statement(target_filename)
+                if 'archive' not in remaining:
+                    removed_count += purge_archived_rows(target_filename)
                 
                 results['success'].append({
                             'name': statement_name,
@@ -2347,6 +3298,50 @@ async def delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log.exception('Error in delete command')
         await msg.reply_text(f'Критическая ошибка при удалении: {str(e)}')
 
+async def restore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда для возврата архивной ведомости в открытые: /restore <название ведомости>"""
+    msg = update.message
+    from_id = msg.from_user.id
+    if not is_admin(from_id):
+        log.info('Ignoring /restore from non-admin %s', from_id)
+        await msg.reply_text('Только админы могут восстанавливать ведомости.')
+        return
+
+    if not context.args:
+        await msg.reply_text(
+            'Укажите название архивной ведомости.\n'
+            'Использование: /restore <название ведомости>\n\n'
+            'Для просмотра архивных ведомостей используйте /liststatements'
+        )
+        return
+
+    statement_name = ' '.join(context.args).strip()
+    try:
+        found, candidates = resolve_statement_for_action(statement_name, 'archive')
+        if candidates:
+            await msg.reply_text(statement_candidates_text(statement_name, candidates))
+            return
+        if not found:
+            await msg.reply_text(f'Архивная ведомость "{statement_name}" не найдена.\nИспользуйте /liststatements для просмотра доступных ведомостей.')
+            return
+        container_path, target_filename = found
+        if find_statement_folder(target_filename):
+            await msg.reply_text(f'Ведомость "{target_filename}" уже есть среди открытых.')
+            return
+        dest_folder = restore_archived_statement(container_path, target_filename)
+        if not dest_folder:
+            await msg.reply_text(f'Ошибка при восстановлении ведомости "{statement_name}". Проверьте логи.')
+            return
+        restored_count = restore_statement_rows(target_filename)
+        refresh_statements_snapshot()
+        await msg.reply_text(
+            f'Ведомость "{target_filename}" восстановлена из архива.\n'
+            f'Возвращено записей в БД: {restored_count}'
+        )
+    except Exception as e:
+        log.exception('Error in restore command')
+        await msg.reply_text(f'Ошибка при восстановлении: {str(e)}')
+
 async def update_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для обновления ведомости: /update <название ведомости>"""
     msg = update.message
@@ -2369,22 +3364,15 @@ async def update_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     statement_name = ' '.join(context.args).strip()
     
     try:
-        # Ищем ведомость в открытых папках
-        statement_folder = find_statement_folder(statement_name + '.csv')
-        if not statement_folder:
-            # Пробуем гибкий поиск
-            statement_folder = find_statement_folder_flexible(statement_name)
-            if statement_folder:
-                # Находим точное имя файла
-                for file in os.listdir(statement_folder):
-                    if file.endswith('.csv'):
-                        target_filename = file
-                        break
-            else:
-                await msg.reply_text(f'Ведомость "{statement_name}" не найдена в открытых папках.\nИспользуйте /liststatements для просмотра доступных ведомостей.')
-                return
-        else:
-            target_filename = statement_name + '.csv'
+        # Ищем ведомость в открытых папках (только точное имя)
+        found, candidates = resolve_statement_for_action(statement_name, 'open')
+        if candidates:
+            await msg.reply_text(statement_candidates_text(statement_name, candidates))
+            return
+        if not found:
+            await msg.reply_text(f'Ведомость "{statement_name}" не найдена в открытых папках.\nИспользуйте /liststatements для просмотра доступных ведомостей.')
+            return
+        statement_folder, target_filename = found
         
         # Проверяем есть ли ожидающий файл для обновления
         cur = load_current_for_user(from_id)
@@ -2399,16 +3387,17 @@ async def update_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await msg.reply_text(f'Не удалось обработать файл {file_path} (чтение/конвертация).')
             return
         
-        # Выполняем обновление
-        success, updated_users = update_statement_data(statement_folder, target_filename, csv_path)
+        # Выполняем обновление (файлы и БД - в отдельном потоке, чтобы бот отвечал остальным)
+        success, updated_users = await asyncio.to_thread(update_statement_data, statement_folder, target_filename, csv_path)
         
         if success:
             # Очищаем ожидающий файл
             save_current_for_user(from_id, file_path='', awaiting_meta=False)
+            await asyncio.to_thread(refresh_statements_snapshot)
             
             # Отправляем уведомления пользователям об обновлении
             if updated_users:
-                send_update_notifications(updated_users, statement_name)
+                await asyncio.to_thread(send_update_notifications, updated_users, statement_name)
             
             await msg.reply_text(
                 f'Ведомость "{statement_name}" успешно обновлена.\n'
@@ -2436,13 +3425,20 @@ async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text(
             'Укажите VK ID или ссылку на профиль.\n'
             'Использование: /find https://vk.com/id160898445\n'
-            'Или: /find 160898445\n\n'
+            'Или: /find 160898445\n'
+            'С архивом: /find 160898445 архив\n\n'
             'Команда выведет все ведомости пользователя с их статусами согласования.'
         )
         return
     
+    # Последний аргумент "архив"/"all" добавляет заархивированные ведомости
+    args = list(context.args)
+    include_archive = len(args) > 1 and args[-1].lower() in ('архив', 'all', '--all')
+    if include_archive:
+        args = args[:-1]
+    
     # Парсим VK ID из аргумента
-    vk_id_arg = ' '.join(context.args).strip()
+    vk_id_arg = ' '.join(args).strip()
     vk_id = None
     
     # Пробуем извлечь ID из URL
@@ -2472,15 +3468,30 @@ async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
     
     try:
-        # Получаем все ведомости пользователя из БД
-        conn = sqlite3.connect(DB_PATH, timeout=30)
-        c = conn.cursor()
-        c.execute("""
-            SELECT original_filename, status, created_at
-            FROM vedomosti_users 
-            WHERE vk_id = ? AND state LIKE 'imported:%'
-            ORDER BY created_at DESC, id DESC
-        """, (str(vk_id),))
+        # Получаем все ведомости пользователя из БД (и из архивной, если попросили)
+        if include_archive and os.path.exists(ARCHIVE_DB_PATH):
+            conn = _connect_with_archive()
+            migrations.ensure_archive_schema(conn)
+            c = conn.cursor()
+            c.execute("""
+                SELECT original_filename, status, created_at, 0 AS archived, id
+                FROM main.vedomosti_users
+                WHERE vk_id = ? AND state_kind = 'imported'
+                UNION ALL
+                SELECT original_filename, status, created_at, 1 AS archived, id
+                FROM archive.vedomosti_users
+                WHERE vk_id = ? AND state_kind = 'imported'
+                ORDER BY created_at DESC, id DESC
+            """, (str(vk_id), str(vk_id)))
+        else:
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            c = conn.cursor()
+            c.execute("""
+                SELECT original_filename, status, created_at, 0 AS archived, id
+                FROM vedomosti_users 
+                WHERE vk_id = ? AND state_kind = 'imported'
+                ORDER BY COALESCE(created_at, 0) DESC, id DESC
+            """, (str(vk_id),))
         rows = c.fetchall()
         conn.close()
         
@@ -2493,9 +3504,11 @@ async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         result_lines.append(f'Всего ведомостей: {len(rows)}\n')
         result_lines.append('─' * 40)
         
-        for idx, (original_filename, status, created_at) in enumerate(rows, 1):
+        for idx, (original_filename, status, created_at, archived, _) in enumerate(rows, 1):
             # Убираем расширение .csv из названия
             filename_display = original_filename.replace('.csv', '') if original_filename else 'Без названия'
+            if archived:
+                filename_display += ' (архив)'
             
             # Определяем статус согласования
             if status == 'agreed':
@@ -2556,7 +3569,7 @@ def get_vedomosti_to_archive():
         c.execute('''
             SELECT DISTINCT original_filename, personal_path 
             FROM vedomosti_users 
-            WHERE archive_at > 0 AND archive_at <= ? AND state LIKE 'imported:%'
+            WHERE archive_at > 0 AND archive_at <= ? AND state_kind = 'imported'
         ''', (now,))
         rows = c.fetchall()
         conn.close()
@@ -2566,59 +3579,105 @@ def get_vedomosti_to_archive():
         return []
 
 def archive_vedomosti_folder(filename: str, personal_path: str):
-    """Архивировать всю папку с ведомостью (переместить из open в archive)."""
+    """Архивировать всю папку с ведомостью (упаковать из open в архивный контейнер)."""
     try:
-        # Определяем корневую папку ведомости по personal_path
-        # personal_path выглядит как: hosting/open/Предмет/Тип/Блок/users/user_file.csv
-        # Нужно найти папку с ведомостью: hosting/open/Предмет/Тип/Блок/
-        
-        open_path = os.path.join(HOSTING_ROOT, OPEN_DIRNAME)
-        archive_path = os.path.join(HOSTING_ROOT, ARCHIVE_DIRNAME)
-        
         # Находим папку с ведомостью, которая содержит этот файл
-        vedomosti_folder = None
-        for root, dirs, files in os.walk(open_path):
-            if filename in files:
-                vedomosti_folder = root
-                break
+        vedomosti_folder = find_statement_folder(filename)
         
         if not vedomosti_folder:
             log.warning('Vedomosti folder not found for file: %s', filename)
             return False
         
-        # Создаем структуру папок в архиве
-        os.makedirs(archive_path, exist_ok=True)
-        
-        # Определяем относительный путь от open до папки с ведомостью
-        relative_path = os.path.relpath(vedomosti_folder, open_path)
-        archive_folder = os.path.join(archive_path, relative_path)
-        
-        # Перемещаем всю папку с ведомостью в архив
-        if os.path.exists(vedomosti_folder):
-            shutil.move(vedomosti_folder, archive_folder)
-            log.info('Moved entire vedomosti folder to archive: %s -> %s', vedomosti_folder, archive_folder)
-            return True
-        else:
-            log.warning('Vedomosti folder not found: %s', vedomosti_folder)
-            return False
+        return _archive_statement_folder(filename, vedomosti_folder)
             
     except Exception:
         log.exception('Failed to archive vedomosti folder for file %s', filename)
         return False
 
-def remove_vedomosti_from_db(filename: str):
-    """Удалить записи ведомости из базы данных."""
+def _connect_with_archive():
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    conn.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DB_PATH,))
+    return conn
+
+def move_statement_to_archive(filename: str) -> int:
+    """Переносит строки ведомости из vedomosti_users в archive.db одной транзакцией.
+
+    Один INSERT ... SELECT и один DELETE: горячая таблица остаётся маленькой для VK бота,
+    а история доступна /find. В режиме WAL фиксация двух файлов не атомарна, но строка
+    не теряется: при сбое между ними она останется в обеих БД, и повторный перенос
+    перезапишет её в архиве по id.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH, timeout=30)
-        c = conn.cursor()
-        c.execute('DELETE FROM vedomosti_users WHERE original_filename = ?', (filename,))
-        affected = c.rowcount
-        conn.commit()
-        conn.close()
-        log.info('Removed %d records for filename %s from database', affected, filename)
+        conn = _connect_with_archive()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            columns = ', '.join(migrations.ensure_archive_schema(conn))
+            conn.execute(
+                f'INSERT OR REPLACE INTO archive.vedomosti_users({columns}, archived_at) '
+                f'SELECT {columns}, ? FROM main.vedomosti_users WHERE original_filename = ?',
+                (int(time.time()), filename))
+            affected = conn.execute('DELETE FROM main.vedomosti_users WHERE original_filename = ?', (filename,)).rowcount
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        log.info('Moved %d records for filename %s to archive %s', affected, filename, ARCHIVE_DB_PATH)
         return affected
     except Exception:
-        log.exception('Failed to remove vedomosti from DB for filename %s', filename)
+        log.exception('Failed to move vedomosti to archive DB for filename %s', filename)
+        return 0
+
+def restore_statement_rows(filename: str) -> int:
+    """Возвращает строки ведомости из archive.db в vedomosti_users (для /restore).
+
+    archive_at сдвигается, как при публикации, иначе ведомость сразу ушла бы в архив снова.
+    """
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        return 0
+    try:
+        conn = _connect_with_archive()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            columns = migrations.ensure_archive_schema(conn)
+            cols = ', '.join(columns)
+            select_cols = ', '.join('?' if col == 'archive_at' else ('0' if col == 'warning_sent' else col) for col in columns)
+            archive_time = int(time.time()) + (36 * 3600)
+            conn.execute(
+                f'INSERT OR REPLACE INTO main.vedomosti_users({cols}) '
+                f'SELECT {select_cols} FROM archive.vedomosti_users WHERE original_filename = ?',
+                (archive_time, filename) if 'archive_at' in columns else (filename,))
+            affected = conn.execute('DELETE FROM archive.vedomosti_users WHERE original_filename = ?', (filename,)).rowcount
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        log.info('Restored %d records for filename %s from archive %s', affected, filename, ARCHIVE_DB_PATH)
+        return affected
+    except Exception:
+        log.exception('Failed to restore vedomosti rows for filename %s', filename)
+        return 0
+
+def purge_archived_rows(filename: str) -> int:
+    """Удаляет историю ведомости из archive.db (для /delete)."""
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        return 0
+    try:
+        conn = sqlite3.connect(ARCHIVE_DB_PATH, timeout=30)
+        try:
+            c = conn.execute('DELETE FROM vedomosti_users WHERE original_filename = ?', (filename,))
+            conn.commit()
+            return c.rowcount
+        finally:
+            conn.close()
+    except sqlite3.OperationalError:
+        # Архив ещё не создан (ни одной ведомости не переносили)
+        return 0
+    except Exception:
+        log.exception('Failed to purge archived rows for filename %s', filename)
         return 0
 
 def get_users_to_warn(filename: str):
@@ -2632,7 +3691,7 @@ def get_users_to_warn(filename: str):
             SELECT DISTINCT vk_id
             FROM vedomosti_users
             WHERE original_filename = ?
-              AND state LIKE 'imported:%'
+              AND state_kind = 'imported'
               AND IFNULL(status, '') <> 'agreed'
               AND IFNULL(warning_sent, 0) = 0
         ''', (filename,))
@@ -2675,16 +3734,23 @@ def process_archive():
             
         log.info('Found %d vedomosti to archive', len(vedomosti_to_archive))
         
+        seen = set()
         for filename, personal_path in vedomosti_to_archive:
+            # Строки приходят по персональным файлам; ведомость архивируется один раз
+            if filename in seen:
+                continue
+            seen.add(filename)
             log.info('Processing archive for filename: %s', filename)
             
             # 1. Архивируем всю папку с ведомостью
             if archive_vedomosti_folder(filename, personal_path):
-                # 2. Удаляем из базы данных
-                removed_count = remove_vedomosti_from_db(filename)
-                log.info('Successfully archived folder and removed %d records for filename: %s', removed_count, filename)
+                # 2. Переносим строки в архивную БД
+                removed_count = move_statement_to_archive(filename)
+                log.info('Successfully archived folder and moved %d records for filename: %s', removed_count, filename)
             else:
                 log.error('Failed to archive folder for filename: %s', filename)
+        # VK бот не должен держать в снимке строки заархивированных ведомостей
+        refresh_statements_snapshot()
                 
     except Exception:
         log.exception('Error in process_archive')
@@ -2706,7 +3772,7 @@ def process_warnings():
         c.execute('''
             SELECT DISTINCT original_filename, archive_at 
             FROM vedomosti_users 
-            WHERE archive_at >= ? AND archive_at <= ? AND state LIKE 'imported:%'
+            WHERE archive_at >= ? AND archive_at <= ? AND state_kind = 'imported'
         ''', (warning_start, warning_end))
         rows = c.fetchall()
         conn.close()
@@ -2740,6 +3806,8 @@ def archive_worker():
     log.info('Archive worker started')
     while True:
         try:
+            pack_legacy_archive_folders()  # Архивные папки старого формата -> контейнеры
+            prerender_stale_texts()  # Тексты выплат без текущей версии шаблона
             process_warnings()  # Сначала предупреждения
             process_archive()   # Потом архивация
         except Exception:
@@ -2757,7 +3825,6 @@ def run_bot():
 
     # initialize sqlite and ensure columns for statuses
     init_db()
-    ensure_vedomosti_status_columns()
 
     # Start archive worker thread
     archive_thread = threading.Thread(target=archive_worker, daemon=True)
@@ -2773,6 +3840,7 @@ def run_bot():
             BotCommand('description', 'Показать описание процесса загрузки'),
             BotCommand('send', 'Отправить файл на хостинг: /send <предмет> <тип курса> <блок>'),
             BotCommand('send_repet', 'Отправить файл репетиторов: /send_repet <предмет> <тип курса> <блок>'),
+            BotCommand('send_batch', 'Опубликовать все листы книги или файлы zip: /send_batch [repet]'),
             BotCommand('update', 'Обновить ведомость: /update <название ведомости>'),
             BotCommand('notify', 'Разослать уведомление vk_id из БД'),
             BotCommand('notify_repet', 'Разослать уведомление репетиторам (VK из столбца ВК)'),
@@ -2782,7 +3850,8 @@ def run_bot():
             BotCommand('deladmin', 'Удалить админа: /deladmin <username_or_id>'),
             BotCommand('listadmins', 'Показать список текущих админов'),
             BotCommand('archive', 'Переместить ведомость в архив: /archive <название>'),
-            BotCommand('delete', 'Удалить архивные ведомости: /delete <название1> <название2> ...')
+            BotCommand('delete', 'Удалить архивные ведомости: /delete <название1> <название2> ...'),
+            BotCommand('restore', 'Вернуть ведомость из архива: /restore <название>')
         ]
         application.bot.set_my_commands(commands)
         log.info('Bot commands (menu) set: %s', [c.command for c in commands])
@@ -2793,6 +3862,7 @@ def run_bot():
     application.add_handler(CommandHandler('description', description))
     application.add_handler(CommandHandler('send', send_command))
     application.add_handler(CommandHandler('send_repet', send_repet_command))
+    application.add_handler(CommandHandler('send_batch', send_batch_command))
     application.add_handler(CommandHandler('update', update_command))
     application.add_handler(CommandHandler('notify', notify_command))
     application.add_handler(CommandHandler('notify_repet', notify_repet_command))
@@ -2804,6 +3874,7 @@ def run_bot():
     application.add_handler(CommandHandler('listadmins', listadmins_command))
     application.add_handler(CommandHandler('archive', archive_command))
     application.add_handler(CommandHandler('delete', delete_command))
+    application.add_handler(CommandHandler('restore', restore_command))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     application.add_handler(MessageHandler(filters.COMMAND, unknown))
 
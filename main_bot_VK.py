@@ -3,144 +3,769 @@
 import json
 import logging
 import time
+_PROCESS_STARTED = time.perf_counter()
 import traceback
 import threading
 import uuid
 import re
 import os
 import sqlite3
+import sys
 import glob
 import vk_api
-import gspread
-from google.oauth2.service_account import Credentials
 from vk_api.bot_longpoll import VkBotLongPoll, VkBotEventType
 import vk_api.utils
 import config
-from collections import OrderedDict
+import migrations
+import payment_render
+import snapshot
+from payment_render import (compose_payment_sections as _compose_payment_sections, fill_missing as _fill_missing,
+                            is_meaningful_comment as _is_meaningful_comment)
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import lru_cache
 VK_TOKEN = getattr(config, 'VK_TOKEN', None)
 GROUP_ID = getattr(config, 'GROUP_ID', None)
 DB_PATH = getattr(config, 'DB_PATH', 'hosting.db')
-import pandas as pd 
+# Бинарный снимок открытых ведомостей, который пишет TG бот (см. snapshot.py)
+SNAPSHOT_PATH = getattr(config, 'SNAPSHOT_PATH', 'statements.snap')
+# 'lazy' — long-poll стартует сразу, выплаты пользователя поднимаются из БД при первом обращении;
+# 'eager' — как раньше, все импортированные ведомости загружаются в память до начала работы
+STARTUP_HYDRATION = getattr(config, 'VK_STARTUP_HYDRATION', 'lazy')
+# pandas, gspread и google-auth импортируются лениво — только в функциях, где они нужны
 MAX_MEMORY_PAYMENTS = 50000   # Максимум выплат в памяти (сервер)
 MAX_USER_CACHE_SIZE = 20000   # Максимум пользователей в кэше (сервер)
 MEMORY_CLEANUP_INTERVAL = 600  # Очистка памяти каждые 10 минут (сервер)
+HYDRATION_WORKERS = 8  # Потоки чтения персональных файлов при полной загрузке (eager)
+LIST_PAGE_SIZE = 5  # Кнопок выплат в одном сообщении списка (безопасный лимит VK)
+LIST_PARTS_PER_REQUEST = 4  # Сколько сообщений списка отправляется за одно нажатие
+CSV_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Лимит кэша строк CSV по оценке занимаемой памяти
+CSV_CACHE_REVALIDATE_INTERVAL = 30  # Как часто (сек) сверять mtime/размер закэшированного файла
+IMPORT_FLUSH_BATCH = 500  # Сколько смен state импортер записывает в БД одной транзакцией
+NOTIFY_RATE_DELAY = 0.35  # Пауза (сек) между уведомлениями о новых выплатах
+LIST_CACHE_TTL = 120  # Сколько секунд держать порцию списка выплат без обращения к БД
+VK_SESSION_FLUSH_INTERVAL = 2.0  # Как часто (сек) изменённые сессии диалогов пишутся в БД одной транзакцией
 
 def total_payments_count():
     """Подсчитывает общее количество выплат в памяти."""
-    with user_payments_lock:
-        return sum(len(payments) for payments in user_payments.values())
+    return user_payments.weight
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 log = logging.getLogger(__name__)
 vk_session = vk_api.VkApi(token=VK_TOKEN)
 vk = vk_session.get_api()
-longpoll = VkBotLongPoll(vk_session, int(GROUP_ID))
-user_payments = OrderedDict()
-user_last_opened_payment = OrderedDict()  # Хранит последнюю открытую выплату для каждого пользователя
-
-# Thread safety для многопоточного доступа
-user_payments_lock = threading.RLock()
-_csv_cache = {}
-_cache_timestamps = {}
+longpoll = None  # Подключение к Long Poll создаёт main_loop: импорт модуля не ходит в сеть
 GSHEET_ID = "16ieoQC7N1lnmdMuonO3c7qdn_zmydptFYvRGSCjeLFg"
 REPET_GSHEET_ID = "1UQMNS3yhFNCDyXS2E03y9iZX2zsHsoL3KKATo-e5c5Q"  # Таблица для репетиторов
 _gspread_client = None
 
-def ensure_db_indexes():
-    """Создает индексы для оптимизации запросов."""
-    try:
-        conn = sqlite3.connect(DB_PATH, timeout=30)
-        c = conn.cursor()
-        c.execute("PRAGMA journal_mode=WAL")  # Write-Ahead Logging для лучшей производительности
-        c.execute("PRAGMA synchronous=NORMAL")  # Баланс между скоростью и надежностью
-        c.execute("PRAGMA cache_size=10000")   # Увеличиваем кэш БД
-        c.execute("PRAGMA temp_store=MEMORY")  # Временные таблицы в памяти
-        indexes = [
-            "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_vk_id ON vedomosti_users(vk_id)",
-            "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_state ON vedomosti_users(state)",
-            "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_filename ON vedomosti_users(original_filename)",
-            "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_archive_at ON vedomosti_users(archive_at)",
-            "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_status ON vedomosti_users(status)",
-            "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_created_at ON vedomosti_users(created_at)",
-            "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_confirmed_at ON vedomosti_users(confirmed_at)"
-        ]
-        
-        for index_sql in indexes:
-            c.execute(index_sql)
-        
-        conn.commit()
-        conn.close()
-        log.info("Database indexes and optimizations created successfully")
-    except Exception:
-        log.exception("Failed to create database indexes")
+# --- Компактное хранение выплат в памяти ---
+# Каждая выплата раньше была dict с вложенным dict данных (~30 ключей), и при
+# MAX_MEMORY_PAYMENTS это сотни МБ. Теперь запись выплаты — объект на __slots__,
+# а данные хранят только кортеж значений плюс ссылку на общую для всех записей
+# одного набора столбцов "форму" (имена полей -> позиция). Пустые значения —
+# один общий объект '', повторяющиеся строки (имя ведомости, суммы, ФИО в разных
+# ведомостях одного куратора) интернируются. Для форматтеров записи ведут себя как dict.
+
+_MISSING = object()
+
+PAYMENT_MONEY_FIELDS = (
+    'total_children', 'with_tutor', 'salary_per_student', 'salary_sum', 'retention', 'retention_pay',
+    'okk', 'okk_pay', 'kpi_sum', 'checks_calc', 'checks_sum', 'extra_checks', 'support', 'webinars',
+    'chats', 'group_calls', 'individual_calls', 'orders_table', 'bonus', 'penalties', 'total',
+)
+
+
+def _intern_value(value) -> str:
+    """Возвращает общий объект для одинаковых строк ('' — всегда один и тот же объект)."""
+    if not value:
+        return ''
+    return sys.intern(value)
+
+
+# Формы кэшируются по кортежу столбцов: у ведомостей куратора и репетитора их единицы.
+# Сверх лимита (произвольные наборы ключей) форма создаётся для записи без кэша.
+PAYMENT_SHAPES_MAX = 256
+
+
+class _PaymentShape:
+    """Общая для многих PaymentData структура: позиции полей в кортеже значений."""
+    __slots__ = ('index',)
+
+    def __init__(self, keys):
+        self.index = {key: i for i, key in enumerate(keys)}
+
+
+_payment_shapes = {}
+
+
+def _get_payment_shape(keys: tuple) -> _PaymentShape:
+    shape = _payment_shapes.get(keys)
+    if shape is None:
+        shape = _PaymentShape(keys)
+        if len(_payment_shapes) < PAYMENT_SHAPES_MAX:
+            shape = _payment_shapes.setdefault(keys, shape)
+    return shape
+
+
+class PaymentData:
+    """Данные ведомости куратора или репетитора с интерфейсом dict.
+
+    Значение None означает отсутствующий ключ, '' — присутствующий пустой.
+    Изменение ключа пересобирает кортеж значений: после маппинга это редкость.
+    """
+    __slots__ = ('_shape', '_values')
+
+    def __init__(self, fields=None, **kwargs):
+        items = dict(fields or ())
+        items.update(kwargs)
+        self._assign(items)
+
+    def _assign(self, items: dict):
+        keys, values = [], []
+        for key, value in items.items():
+            if value is None:
+                continue
+            keys.append(key)
+            values.append('' if isinstance(value, str) and not value else value)
+        self._shape = _get_payment_shape(tuple(keys))
+        self._values = tuple(values)
+
+    def get(self, key, default=None):
+        i = self._shape.index.get(key)
+        return default if i is None else self._values[i]
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        items = self.to_dict()
+        items[key] = value
+        self._assign(items)
+
+    def __contains__(self, key):
+        return key in self._shape.index
+
+    def keys(self):
+        return list(self._shape.index)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self.get(key)) for key in self.keys()]
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def copy(self):
+        return PaymentData(self.to_dict())
+
+    def __repr__(self):
+        return f"PaymentData({self.to_dict()!r})"
+
+
+class PaymentRecord:
+    """Выплата пользователя: идентификатор, данные и статус согласования (интерфейс dict)."""
+    __slots__ = ('id', 'data', 'created_at', 'status', 'db_id', 'original_payment_id', 'disagree_reason')
+    _FIELDS = frozenset(__slots__)
+
+    def __init__(self, id=None, data=None, created_at=None, status=None, db_id=None,
+                 original_payment_id=None, disagree_reason=None):
+        self.id = id
+        self.data = data
+        self.created_at = created_at
+        self.status = status
+        self.db_id = db_id
+        self.original_payment_id = original_payment_id
+        self.disagree_reason = disagree_reason
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._FIELDS else default
+
+    def __getitem__(self, key):
+        if key not in self._FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        # Как у dict: поле есть всегда, даже со значением None
+        return key in self._FIELDS
+
+    def __repr__(self):
+        return f"PaymentRecord(id={self.id!r}, status={self.status!r}, db_id={self.db_id!r})"
+
+class LRUStore:
+    """Потокобезопасное LRU-хранилище, ограниченное суммарным "весом" значений.
+
+    get() поднимает ключ в конец очереди, а вставка сразу вытесняет самые давно
+    использованные ключи, пока вес не уложится в max_weight (амортизированно O(1):
+    каждый элемент вытесняется не более одного раза). Вес значения считает weigh
+    (по умолчанию 1 на ключ, для списков выплат — их длина). on_evict, если задан,
+    вызывается с ключом каждого вытесненного элемента.
+    """
+
+    def __init__(self, max_weight: int, weigh=None, on_evict=None):
+        self.max_weight = max_weight
+        self._weigh = weigh or (lambda value: 1)
+        self._on_evict = on_evict
+        self._data = OrderedDict()  # key -> (value, weight)
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """Как get(), но без изменения порядка и счётчиков."""
+        with self.lock:
+            entry = self._data.get(key)
+            return default if entry is None else entry[0]
+
+    def set(self, key, value, touch: bool = True):
+        with self.lock:
+            old = self._data.get(key)
+            if old is not None:
+                self.weight -= old[1]
+            weight = self._weigh(value)
+            self._data[key] = (value, weight)
+            self.weight += weight
+            if touch or old is None:
+                self._data.move_to_end(key)
+            self._evict()
+
+    __setitem__ = set
+
+    def append(self, key, item):
+        """Добавляет элемент в список под ключом key (создаёт список при необходимости)."""
+        with self.lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.set(key, [item])
+                return
+            value, weight = entry
+            value.append(item)
+            new_weight = self._weigh(value)
+            self._data[key] = (value, new_weight)
+            self.weight += new_weight - weight
+            self._data.move_to_end(key)
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            self.weight -= entry[1]
+            return entry[0]
+
+    def items(self):
+        """Снимок пар (ключ, значение) без изменения порядка LRU."""
+        with self.lock:
+            return [(key, entry[0]) for key, entry in self._data.items()]
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self):
+        # Самый свежий ключ не вытесняем, даже если он один превышает лимит
+        while self.weight > self.max_weight and len(self._data) > 1:
+            key, (_, weight) = self._data.popitem(last=False)
+            self.weight -= weight
+            self.evictions += 1
+            if self._on_evict is not None:
+                self._on_evict(key)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "keys": len(self._data),
+                "weight": self.weight,
+                "max_weight": self.max_weight,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+class PaymentListCache:
+    """Кэш порций списка выплат пользователя (результатов get_payment_summaries_for_user).
+
+    Хранит по пользователю словарь (limit, before, offset) -> (выплаты, время записи);
+    порция живёт LIST_CACHE_TTL секунд или до invalidate() для этого пользователя.
+    Запрос одной позиции из начала списка ("Ведомость N") отдаётся срезом уже закэшированной
+    первой порции. Результат, загруженный до инвалидации, не сохраняется: put() сверяет
+    номер эпохи, полученный в token() перед чтением БД. Порция, попавшая в кэш уже после
+    архивации, будет сброшена следующим проходом cleanup_archived_payments.
+    Изменения, записанные TG ботом, отслеживаются через счётчик vedomosti_changes:
+    sync() сбрасывает весь кэш, если счётчик изменился с прошлой сверки.
+    """
+
+    def __init__(self, max_users: int, ttl: float):
+        self.ttl = ttl
+        self._store = LRUStore(max_users)
+        self._epoch = 0
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def token(self) -> int:
+        return self._epoch
+
+    def sync(self, version):
+        """Сверяет счётчик изменений БД; при расхождении (или None - счётчик не прочитан) сбрасывает кэш."""
+        with self.lock:
+            if version is not None and version == self._version:
+                return
+            self._version = version
+            self._epoch += 1
+            if len(self._store):
+                self.invalidations += len(self._store)
+                self._store = LRUStore(self._store.max_weight)
+
+    def get(self, user_id, limit: int, before, offset: int):
+        now = time.time()
+        with self.lock:
+            pages = self._store.peek(str(user_id)) or {}
+            found = None
+            entry = pages.get((limit, before, offset))
+            if entry and now - entry[1] < self.ttl:
+                found = entry[0]
+            elif before is None:
+                # Позиции из начала списка берём из закэшированной порции с offset=0
+                for (cached_limit, cached_before, cached_offset), (payments, stored_at) in pages.items():
+                    if cached_before is not None or cached_offset or now - stored_at >= self.ttl:
+                        continue
+                    if offset + limit <= len(payments) or len(payments) < cached_limit:
+                        found = payments[offset:offset + limit]
+                        break
+            if found is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(found)
+
+    def put(self, user_id, limit: int, before, offset: int, payments, token: int):
+        with self.lock:
+            if token != self._epoch:
+                return
+            key = str(user_id)
+            now = time.time()
+            pages = {k: v for k, v in (self._store.peek(key) or {}).items() if now - v[1] < self.ttl}
+            pages[(limit, before, offset)] = (list(payments), now)
+            self._store.set(key, pages)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self._epoch += 1
+            if self._store.pop(str(user_id)) is not None:
+                self.invalidations += 1
+
+    def invalidate_missing(self, active_filenames) -> int:
+        """Сбрасывает пользователей, в чьих порциях есть ведомость вне active_filenames."""
+        with self.lock:
+            stale = [
+                key for key, pages in self._store.items()
+                if any(p["data"].get("original_filename") not in active_filenames
+                       for payments, _ in pages.values() for p in payments)
+            ]
+            if stale:
+                self._epoch += 1
+            for key in stale:
+                self._store.pop(key)
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "users": len(self._store),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+# Статусы, которые пишутся в vedomosti_users: после них незавершённого шага согласования нет
+FINAL_PAYMENT_STATUSES = frozenset({"agreed", "disagreed"})
+
+
+class SessionStore:
+    """Сессии диалогов VK: последняя открытая выплата и незавершённый шаг согласования.
+
+    Сессия - кортеж (last_payment_id, flow_payment_id, flow_status, flow_reason). Изменение
+    сразу видно в памяти и помечает пользователя; фоновый поток раз в flush_interval секунд
+    пишет изменённые столбцы накопленных сессий в vk_sessions одной транзакцией (write-behind).
+    Шаг согласования, выбранный раньше сброса из TG (flow_reset_at), в БД не пишется. Сессия
+    пользователя поднимается из БД лениво - одним запросом по ключу при первом обращении
+    после старта или вытеснения из LRU, поэтому перезапуск бота для пользователя незаметен.
+    """
+
+    EMPTY = (None, None, None, None)
+
+    def __init__(self, max_users: int, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._cache = LRUStore(max_users)
+        self._checked = LRUStore(max_users)  # vk_id -> счётчик vedomosti_changes последней сверки шага с БД
+        self._dirty = {}  # vk_id -> сессия, ещё не записанная в БД
+        self._changes = {}  # vk_id -> (изменённые части сессии: 'last'/'flow', время выбора шага)
+        self.lock = threading.Lock()
+        self._thread = None
+        self.loads = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def _read(self, key: str):
+        """Сессия из БД; None - прочитать не удалось (такую не кэшируем, чтобы не затереть запись)."""
+        if not os.path.exists(DB_PATH):
+            return self.EMPTY
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            try:
+                row = conn.execute("SELECT last_payment_id, flow_payment_id, flow_status, flow_reason "
+                                   "FROM vk_sessions WHERE vk_id = ?", (key,)).fetchone()
+            finally:
+                conn.close()
+        except Exception:
+            log.exception("Failed to load VK session for %s", key)
+            return None
+        self.loads += 1
+        return tuple(row) if row else self.EMPTY
+
+    def get(self, user_id):
+        key = str(user_id)
+        session = self._cache.get(key)
+        if session is not None:
+            return session
+        with self.lock:
+            session = self._dirty.get(key)
+        if session is None:
+            session = self._read(key)
+            if session is None:
+                return self.EMPTY
+        with self.lock:
+            # Пока читали БД, сессию мог изменить другой поток
+            current = self._cache.peek(key) or self._dirty.get(key)
+            if current is not None:
+                return current
+            self._cache.set(key, session)
+        return session
+
+    def _update(self, user_id, **changes):
+        key = str(user_id)
+        last_payment_id, flow_payment_id, flow_status, flow_reason = self.get(key)
+        with self.lock:
+            current = self._cache.peek(key) or self._dirty.get(key)
+            if current is not None:
+                last_payment_id, flow_payment_id, flow_status, flow_reason = current
+            session = (
+                changes.get("last_payment_id", last_payment_id),
+                changes.get("flow_payment_id", flow_payment_id),
+                changes.get("flow_status", flow_status),
+                changes.get("flow_reason", flow_reason),
+            )
+            self._cache.set(key, session)
+            self._dirty[key] = session
+            fields, flow_set_at = self._changes.get(key, (frozenset(), None))
+            if "last_payment_id" in changes:
+                fields |= {"last"}
+            if "flow_payment_id" in changes:
+                fields |= {"flow"}
+                flow_set_at = time.time()
+            self._changes[key] = (fields, flow_set_at)
+
+    def last_opened(self, user_id):
+        return self.get(user_id)[0]
+
+    def set_last_opened(self, user_id, payment_id: str):
+        """Открытие ведомости начинает диалог заново: статус берётся из БД, шаг сбрасывается."""
+        self._update(user_id, last_payment_id=payment_id, flow_payment_id=None, flow_status=None, flow_reason=None)
+
+    def set_flow(self, user_id, payment_id: str, status: str, reason: str = None):
+        if status in FINAL_PAYMENT_STATUSES:
+            self._update(user_id, flow_payment_id=None, flow_status=None, flow_reason=None)
+        else:
+            self._update(user_id, flow_payment_id=payment_id, flow_status=status, flow_reason=reason)
+
+    def _recheck_flow(self, key: str):
+        """Перечитывает сессию из vk_sessions, если vedomosti_users менялась после прошлой сверки.
+
+        TG бот при /update сбрасывает там шаги переписанных строк. Несохранённая сессия
+        новее записи в БД и остаётся как есть.
+        """
+        version = _read_vedomosti_version()
+        if version is None or self._checked.peek(key) == version:
+            return
+        session = self._read(key)
+        if session is None:
+            return
+        with self.lock:
+            if key not in self._dirty:
+                self._cache.set(key, session)
+        self._checked.set(key, version)
+
+    def apply_flow(self, user_id, payment):
+        """Возвращает выплате незавершённый шаг согласования (после перезапуска или из БД).
+
+        Шаг, которого в сессии больше нет (сброшен /update или открытием ведомости), снимается
+        и с выплаты в памяти: статус перечитывается из БД.
+        """
+        _, flow_payment_id, flow_status, flow_reason = self.get(user_id)
+        if flow_payment_id and flow_payment_id == payment["id"]:
+            self._recheck_flow(str(user_id))
+            _, flow_payment_id, flow_status, flow_reason = self.get(user_id)
+        if not flow_payment_id or flow_payment_id != payment["id"]:
+            if payment.get("status") not in FINAL_PAYMENT_STATUSES and payment.get("status") not in ("new", "", None):
+                refresh_payment_status_from_db(payment, user_id)
+            return
+        if payment.get("status") in FINAL_PAYMENT_STATUSES:
+            return
+        payment["status"] = flow_status
+        if flow_reason is not None:
+            payment["disagree_reason"] = flow_reason
+
+    def flush(self) -> int:
+        """Пишет изменённые столбцы накопленных сессий в БД одной транзакцией; возвращает число сессий.
+
+        Шаг согласования пишется, только если TG бот не сбрасывал шаги пользователя после его
+        выбора (flow_reset_at): иначе запись вернула бы шаг строки, переписанной /update.
+        Такой шаг отбрасывается и из памяти - сессия перечитается из БД.
+        """
+        with self.lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            changes, self._changes = self._changes, {}
+        now = time.time()
+        rejected = []
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            try:
+                for key, session in batch.items():
+                    fields, flow_set_at = changes.get(key, (frozenset(), None))
+                    conn.execute("INSERT OR IGNORE INTO vk_sessions(vk_id) VALUES (?)", (key,))
+                    if "last" in fields:
+                        conn.execute("UPDATE vk_sessions SET last_payment_id = ?, updated_at = ? WHERE vk_id = ?",
+                                     (session[0], now, key))
+                    if "flow" in fields:
+                        cur = conn.execute(
+                            "UPDATE vk_sessions SET flow_payment_id = ?, flow_status = ?, flow_reason = ?, updated_at = ? "
+                            "WHERE vk_id = ? AND (? IS NULL OR COALESCE(flow_reset_at, 0) < ?)",
+                            session[1:] + (now, key, session[1], flow_set_at))
+                        if cur.rowcount == 0:
+                            rejected.append(key)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception:
+            log.exception("Failed to flush %d VK sessions, will retry", len(batch))
+            with self.lock:
+                # Более новые изменения, сделанные во время записи, важнее
+                for key, session in batch.items():
+                    fields, flow_set_at = changes.get(key, (frozenset(), None))
+                    if key in self._dirty:
+                        newer_fields, newer_set_at = self._changes.get(key, (frozenset(), None))
+                        self._changes[key] = (fields | newer_fields, newer_set_at or flow_set_at)
+                    else:
+                        self._dirty[key] = session
+                        self._changes[key] = (fields, flow_set_at)
+            return 0
+        if rejected:
+            log.info("Dropped %d VK agreement steps reset by TG /update: %s", len(rejected), rejected)
+            with self.lock:
+                for key in rejected:
+                    if key not in self._dirty:
+                        self._cache.pop(key)
+        self.flushes += 1
+        self.flushed_rows += len(batch)
+        return len(batch)
+
+    def _run(self):
+        log.info("VK session writer started (interval=%.1fs)", self.flush_interval)
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="vk-sessions", daemon=True)
+            self._thread.start()
+
+    def stats(self) -> dict:
+        with self.lock:
+            pending = len(self._dirty)
+        return {
+            "cached": len(self._cache),
+            "pending": pending,
+            "loads": self.loads,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+        }
+
+
+class _CsvCacheEntry:
+    __slots__ = ('row', 'mtime_ns', 'size', 'checked_at', 'nbytes')
+
+    def __init__(self, row, mtime_ns, size, checked_at, nbytes):
+        self.row = row
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.checked_at = checked_at
+        self.nbytes = nbytes
+
+
+def _estimate_row_bytes(row: dict) -> int:
+    """Грубая оценка памяти, занимаемой строкой CSV в виде dict."""
+    return sys.getsizeof(row) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in row.items())
+
+
+# Пользователи, чьи выплаты уже подняты из БД (в том числе те, у кого выплат нет).
+# Вытеснение из user_payments снимает отметку, и следующее обращение загрузит пользователя заново.
+hydrated_users = LRUStore(MAX_USER_CACHE_SIZE)
+user_payments = LRUStore(MAX_MEMORY_PAYMENTS, weigh=len, on_evict=hydrated_users.pop)
+vk_sessions = SessionStore(MAX_USER_CACHE_SIZE, VK_SESSION_FLUSH_INTERVAL)  # Последняя открытая выплата и шаг согласования
+
+# Thread safety для многопоточного доступа
+user_payments_lock = user_payments.lock
+csv_row_cache = LRUStore(CSV_CACHE_MAX_BYTES, weigh=lambda entry: entry.nbytes)
+_csv_encodings = LRUStore(MAX_USER_CACHE_SIZE)  # file_path -> кодировка, которой файл удалось прочитать
+payment_list_cache = PaymentListCache(MAX_USER_CACHE_SIZE, LIST_CACHE_TTL)
+statement_snapshot = snapshot.SnapshotHandle(SNAPSHOT_PATH)
+# personal_path -> (mtime_ns, size, checked_at, совпал ли файл) последней сверки записи снимка с файлом
+_snapshot_checks = LRUStore(MAX_MEMORY_PAYMENTS)
+
 
 def cleanup_memory():
     try:
-        # Ограничиваем общее количество выплат
-        total = total_payments_count()
-        if total > MAX_MEMORY_PAYMENTS:
-            to_remove = total - MAX_MEMORY_PAYMENTS
-            log.info("Need to remove %d old payments to respect MAX_MEMORY_PAYMENTS", to_remove)
-            # Удаляем старые выплаты по пользователям (FIFO)
-            for uid in list(user_payments.keys()):
-                while user_payments[uid] and to_remove > 0:
-                    user_payments[uid].pop(0)  # Удаляем самую старую выплату
-                    to_remove -= 1
-                if not user_payments[uid]:
-                    del user_payments[uid]
-                if to_remove <= 0:
-                    break
-            log.info("Cleaned up old payments from memory")
-        
-        if len(user_last_opened_payment) > MAX_USER_CACHE_SIZE:
-            excess = len(user_last_opened_payment) - MAX_USER_CACHE_SIZE
-            for _ in range(excess):
-                user_last_opened_payment.popitem(last=False)
-            log.info("Cleaned up %d old user cache entries", excess)
-        
-        current_time = time.time()
-        expired_keys = [k for k, v in _cache_timestamps.items() if current_time - v > 3600]
-        for key in expired_keys:
-            _csv_cache.pop(key, None)
-            _cache_timestamps.pop(key, None)
-        
-        if expired_keys:
-            log.info("Cleaned up %d expired CSV cache entries", len(expired_keys))
-            
+        # Лимиты user_payments и vk_sessions соблюдаются при вставке (LRU),
+        # здесь только отчитываемся о состоянии кэшей
+        log.info("Payments cache stats: %s", user_payments.stats())
+        log.info("VK sessions stats: %s", vk_sessions.stats())
+        log.info("CSV row cache stats: %s", csv_row_cache.stats())
+        log.info("Payment list cache stats: %s", payment_list_cache.stats())
+        log.info("Statements snapshot stats: %s", statement_snapshot.stats())
     except Exception:
         log.exception("Failed to cleanup memory")
 
-def get_cached_csv_data(file_path: str, ttl: int = 300):
-    """Кэширует данные CSV файлов для ускорения доступа с проверкой mtime."""
-    try:
-        if not os.path.exists(file_path):
+def _decode_csv_bytes(file_path: str, raw: bytes) -> str:
+    """Декодирует CSV: сначала кодировкой, запомненной для файла, затем utf-8 и cp1251."""
+    known = _csv_encodings.peek(file_path)
+    encodings = [known] if known else []
+    encodings += [enc for enc in ('utf-8-sig', 'cp1251') if enc != known]
+    for encoding in encodings:
+        try:
+            text = raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        if encoding != known:
+            _csv_encodings.set(file_path, encoding)
+        return text
+    raise ValueError(f"Unsupported CSV encoding: {file_path}")
+
+
+def read_csv_rows(file_path: str, limit: int = None) -> list:
+    """Читает CSV модулем csv (без pandas) в список dict.
+
+    Результат совпадает с pd.read_csv(dtype=str): пустые и NA-значения -> None,
+    безымянные столбцы -> 'Unnamed: N', повторяющиеся -> 'name.1'.
+    """
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+    return snapshot.csv_rows_from_text(_decode_csv_bytes(file_path, raw), limit=limit)
+
+
+def _find_csv_row_for_vk(csv_path: str, vk_id_str: str, personal_path: str = None):
+    """Строка CSV пользователя: персональный файл берётся из кэша, общий читается целиком."""
+    if csv_path == personal_path:
+        row = get_cached_csv_row(csv_path)
+        rows = [row] if row else []
+    else:
+        rows = read_csv_rows(csv_path)
+    for row in rows:
+        if 'vk_id' not in row:
             return None
-        
-        mtime = os.path.getmtime(file_path)
-        cache_key = file_path
-        current_time = time.time()
-        
-        # Проверяем кэш с учетом mtime файла
-        entry = _csv_cache.get(cache_key)
-        if entry:
-            df, cached_mtime, cache_time = entry
-            if cached_mtime == mtime and (current_time - cache_time) < ttl:
-                return df
-        
-        # Читаем файл
+        if _extract_numeric_vk(row['vk_id'] or '') == vk_id_str:
+            return row
+    return None
+
+
+def get_cached_csv_row(file_path: str):
+    """Возвращает первую строку CSV (персональный файл — одна строка) как dict.
+
+    Сначала строка ищется в снимке открытых ведомостей (mmap, без открытия файла).
+    Файлы, которых в снимке нет или которые изменились после сборки снимка, читаются
+    и хранятся в LRU-кэше, ограниченном по оценке занимаемых байт. mtime и размер
+    файла (и для записи снимка, и для кэша) сверяются не чаще раза в
+    CSV_CACHE_REVALIDATE_INTERVAL секунд. Возвращаемый dict общий — не изменять.
+    """
+    try:
+        now = time.time()
+        record = statement_snapshot.get_record(file_path)
+        if record is not None:
+            _, rec_mtime_ns, rec_size, row = record
+            check = _snapshot_checks.get(file_path)
+            if (check is None or check[0] != rec_mtime_ns or check[1] != rec_size
+                    or now - check[2] >= CSV_CACHE_REVALIDATE_INTERVAL):
+                try:
+                    st = os.stat(file_path)
+                    fresh = st.st_mtime_ns == rec_mtime_ns and st.st_size == rec_size
+                except FileNotFoundError:
+                    fresh = False
+                check = (rec_mtime_ns, rec_size, now, fresh)
+                _snapshot_checks.set(file_path, check)
+            if check[3]:
+                return row
+            # Файл переписан (или удалён) после сборки снимка — читаем его сам
+
+        entry = csv_row_cache.get(file_path)
+        if entry is not None and now - entry.checked_at < CSV_CACHE_REVALIDATE_INTERVAL:
+            return entry.row
+
         try:
-            df = pd.read_csv(file_path, dtype=str)
-        except Exception:
-            df = pd.read_csv(file_path, encoding='cp1251', dtype=str)
-        
-        if isinstance(df, pd.DataFrame) and not df.empty:
-            # Кэшируем данные с mtime
-            _csv_cache[cache_key] = (df, mtime, current_time)
-            _cache_timestamps[cache_key] = current_time
-            return df
-        
-        return None
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            csv_row_cache.pop(file_path)
+            return None
+        if entry is not None and entry.mtime_ns == st.st_mtime_ns and entry.size == st.st_size:
+            entry.checked_at = now
+            return entry.row
+
+        rows = read_csv_rows(file_path, limit=1)
+        if not rows:
+            csv_row_cache.pop(file_path)
+            return None
+
+        row = rows[0]
+        csv_row_cache.set(file_path, _CsvCacheEntry(row, st.st_mtime_ns, st.st_size, now, _estimate_row_bytes(row)))
+        return row
     except Exception:
         log.exception("Failed to cache CSV data for %s", file_path)
         return None
@@ -197,6 +822,8 @@ def get_gspread_client():
         return _gspread_client
     try:
         log.info("Initializing gspread client")
+        import gspread
+        from google.oauth2.service_account import Credentials
         with open(os.path.join(os.path.dirname(__file__), 'isu_groups.json'), 'r', encoding='utf-8') as f:
             info = json.load(f)
         scopes = [
@@ -225,7 +852,7 @@ def log_complaint_to_sheet(vk_id: int, reason: str, filename: str = "", filepath
                 if pays:
                     fio_val = pays[0].get("data", {}).get("fio") or pays[0].get("data", {}).get("curator") or ""
                 if not fio_val:
-                    allp = get_all_payments_for_user_from_db(vk_id, limit=1)
+                    allp = get_payment_summaries_for_user(vk_id, limit=1)
                     if allp:
                         fio_val = allp[0].get("data", {}).get("fio") or allp[0].get("data", {}).get("curator") or ""
             except Exception:
@@ -272,66 +899,6 @@ def log_repet_complaint_to_sheet(vk_id: int, reason: str, filename: str = "", fi
         log.exception("Failed to log repet complaint to sheet for vk_id=%s reason=%s error=%s", vk_id, reason, str(e))
 
 
-def ensure_vedomosti_status_columns():
-    try:
-        conn = sqlite3.connect(DB_PATH, timeout=30)
-        c = conn.cursor()
-        c.execute("PRAGMA table_info(vedomosti_users)")
-        cols = [r[1] for r in c.fetchall()]
-        if 'status' not in cols:
-            c.execute("ALTER TABLE vedomosti_users ADD COLUMN status TEXT DEFAULT ''")
-        if 'disagree_reason' not in cols:
-            c.execute("ALTER TABLE vedomosti_users ADD COLUMN disagree_reason TEXT DEFAULT ''")
-        if 'confirmed_at' not in cols:
-            c.execute("ALTER TABLE vedomosti_users ADD COLUMN confirmed_at INTEGER")
-        conn.commit()
-        conn.close()
-        log.info("ensure_vedomosti_status_columns done")
-    except Exception:
-        log.exception("Failed to ensure vedomosti status columns")
-
-
-def ensure_unique_import_states():
-    """Миграция: заменяет общие состояния вида 'imported:<suffix>' на уникальные UUID.
-    Если суффикс не является UUID (например, это имя файла), генерируем новый UUID на КАЖДУЮ запись.
-    Это предотвращает ситуацию, когда одно состояние разделяется несколькими пользователями.
-    """
-    try:
-        if not os.path.exists(DB_PATH):
-            return
-        conn = sqlite3.connect(DB_PATH, timeout=30)
-        c = conn.cursor()
-        c.execute("PRAGMA journal_mode=WAL")
-        c.execute("SELECT id, state FROM vedomosti_users WHERE state LIKE 'imported:%'")
-        rows = c.fetchall()
-        updated = 0
-        for db_id, state_val in rows:
-            try:
-                if not state_val:
-                    continue
-                parts = str(state_val).split(':', 1)
-                if len(parts) != 2:
-                    continue
-                suffix = parts[1]
-                try:
-                    uuid.UUID(str(suffix))
-                    is_uuid = True
-                except Exception:
-                    is_uuid = False
-                if not is_uuid:
-                    new_state = f"imported:{uuid.uuid4()}"
-                    c.execute("UPDATE vedomosti_users SET state = ? WHERE id = ?", (new_state, db_id))
-                    updated += 1
-            except Exception:
-                log.debug("Failed to migrate state for id=%s", db_id, exc_info=True)
-        if updated:
-            conn.commit()
-            log.info("Migrated %d vedomosti states to unique UUID-based values", updated)
-        conn.close()
-    except Exception:
-        log.exception("Failed to ensure unique import states")
-
-
 def update_vedomosti_status_by_payment(payment_id: str, status: str, reason: str = None):
     try:
         conn = sqlite3.connect(DB_PATH, timeout=30)
@@ -368,21 +935,21 @@ def update_vedomosti_status_by_payment(payment_id: str, status: str, reason: str
                     
                     # Обновляем и в памяти
                     update_payment_in_memory(payment_id, status, reason)
+                    payment_list_cache.invalidate(existing_record[1])
                     return
                     
             except (ValueError, IndexError):
                 # Если не удалось извлечь db_id, используем старый способ
                 pass
         
-        # Старый способ поиска по state (fallback)
+        # Старый способ поиска по payment_uuid (fallback)
         original_payment_id = payment_id.split('_')[0] if '_' in payment_id else payment_id
-        state_val = f"imported:{original_payment_id}"
         
-        c.execute("SELECT id, vk_id, original_filename FROM vedomosti_users WHERE state = ?", (state_val,))
+        c.execute("SELECT id, vk_id, original_filename FROM vedomosti_users WHERE payment_uuid = ?", (original_payment_id,))
         existing_record = c.fetchone()
         
         if not existing_record:
-            log.error("No record found for payment_id=%s with state=%s", payment_id, state_val)
+            log.error("No record found for payment_id=%s with payment_uuid=%s", payment_id, original_payment_id)
             conn.close()
             return
         
@@ -391,13 +958,13 @@ def update_vedomosti_status_by_payment(payment_id: str, status: str, reason: str
         
         if reason is not None:
             c.execute(
-                "UPDATE vedomosti_users SET status = ?, disagree_reason = ?, confirmed_at = ? WHERE state = ?",
-                (status, str(reason), now, state_val)
+                "UPDATE vedomosti_users SET status = ?, disagree_reason = ?, confirmed_at = ? WHERE payment_uuid = ?",
+                (status, str(reason), now, original_payment_id)
             )
         else:
             c.execute(
-                "UPDATE vedomosti_users SET status = ?, confirmed_at = ? WHERE state = ?",
-                (status, now, state_val)
+                "UPDATE vedomosti_users SET status = ?, confirmed_at = ? WHERE payment_uuid = ?",
+                (status, now, original_payment_id)
             )
         conn.commit()
         affected = c.rowcount
@@ -406,17 +973,26 @@ def update_vedomosti_status_by_payment(payment_id: str, status: str, reason: str
         
         # Обновляем в памяти
         update_payment_in_memory(payment_id, status, reason)
+        payment_list_cache.invalidate(existing_record[1])
         
     except Exception:
         log.exception("Failed to update vedomosti status for payment %s", payment_id)
 
 
+def set_payment_flow_status(user_id: int, payment, status: str, reason: str = None):
+    """Ставит выплате статус шага согласования и запоминает его в сессии пользователя."""
+    payment["status"] = status
+    if reason is not None:
+        payment["disagree_reason"] = reason
+    vk_sessions.set_flow(user_id, payment["id"], status, reason)
+
+
 def update_payment_in_memory(payment_id: str, status: str, reason: str = None):
     """Обновляет статус платежа в памяти."""
     try:
         updated_count = 0
         for user_id, payments in user_payments.items():
-            for payment in payments:
+            for payment in list(payments):
                 # Проверяем и исходный payment_id и уникальный
                 if payment["id"] == payment_id or payment.get("original_payment_id") == payment_id:
                     old_status = payment.get("status", "unknown")
@@ -440,6 +1016,14 @@ def fetch_unprocessed_vedomosti():
     try:
         conn = sqlite3.connect(DB_PATH, timeout=30)
         c = conn.cursor()
+        # Строки, чей итог при публикации разобран как 0, помечаем пачкой без чтения персональных файлов
+        c.execute("""
+            UPDATE vedomosti_users SET state = 'skip_zero_total', state_kind = 'skip_zero_total'
+            WHERE (state IS NULL OR state = '') AND total = 0
+        """)
+        if c.rowcount > 0:
+            log.info("Marked %d zero-total vedomosti rows as skip_zero_total", c.rowcount)
+        conn.commit()
         c.execute("SELECT id, vk_id, personal_path, original_filename, state FROM vedomosti_users WHERE state IS NULL OR state = ''")
         rows = c.fetchall()
         conn.close()
@@ -448,39 +1032,61 @@ def fetch_unprocessed_vedomosti():
     return rows
 
 
-def mark_vedomosti_state(db_id, new_state):
+SUMMARY_UPDATE_SQL = "UPDATE vedomosti_users SET fio = ?, groups = ?, total = COALESCE(total, ?), is_repet = ? WHERE id = ?"
+
+
+def mark_vedomosti_states(transitions, summaries=None) -> bool:
+    """Записывает пачку переходов [(db_id, new_state), ...] одной транзакцией.
+
+    summaries - кортежи (fio, groups, total, is_repet, db_id) для столбцов списка выплат,
+    пишутся в той же транзакции.
+    """
+    if not transitions:
+        return True
+    params = []
+    for db_id, new_state in transitions:
+        state_kind, payment_uuid = migrations.split_vedomosti_state(new_state)
+        params.append((new_state, state_kind, payment_uuid, db_id))
     try:
         conn = sqlite3.connect(DB_PATH, timeout=30)
         c = conn.cursor()
-        c.execute("UPDATE vedomosti_users SET state = ? WHERE id = ?", (new_state, db_id))
+        c.executemany("UPDATE vedomosti_users SET state = ?, state_kind = ?, payment_uuid = ? WHERE id = ?", params)
+        if summaries:
+            c.executemany(SUMMARY_UPDATE_SQL, summaries)
         conn.commit()
         conn.close()
+        return True
     except Exception:
-        log.exception("Failed to update vedomosti state for id=%s", db_id)
+        log.exception("Failed to update vedomosti states for %d rows (first id=%s)", len(params), params[0][3])
+        return False
+
+
+def mark_vedomosti_state(db_id, new_state):
+    mark_vedomosti_states([(db_id, new_state)])
 
 def _map_row_to_payment_data(row_dict, vk_id, original_filename):
     def pick(*keys):
         for k in keys:
             if k is None:
                 continue
-            if k in row_dict and pd.notna(row_dict[k]):
-                return str(row_dict[k])
+            value = row_dict.get(k)
+            if value is not None and value == value:  # None и NaN — пусто
+                return _intern_value(str(value))
         return ''
     data = {}
     data['fio'] = pick('ФИО', 'fio', 'name', 'full_name', 'FIO')
     data['phone'] = pick('Телефон', 'phone', 'Phone', 'telephone')
     data['console'] = pick('console', 'Console')
     data['curator'] = pick('Куратор', 'curator', 'manager', 'curator_name')
-    data['vk_id'] = str(vk_id)
+    data['vk_id'] = _intern_value(str(vk_id))
     data['mail'] = pick('Почта', 'mail', 'email', 'Email')
     data['groups'] = pick('Группы', 'groups', 'group', 'groups_list')
-    for k in ['total_children','with_tutor','salary_per_student','salary_sum','retention','retention_pay',
-              'okk','okk_pay','kpi_sum','checks_calc','checks_sum','extra_checks','support','webinars',
-              'chats','group_calls','individual_calls','orders_table','bonus','penalties','total']:
+    for k in PAYMENT_MONEY_FIELDS:
         data[k] = pick(k, k.capitalize(), k.upper(), k.replace('_',' ').capitalize())
     data['total'] = data.get('total') or pick('Итого', 'Total', 'total')
-    data['original_filename'] = os.path.basename(original_filename) if original_filename else ''
-    return data
+    data['total_amount'] = payment_render.parse_amount(data['total'])
+    data['original_filename'] = _intern_value(os.path.basename(original_filename)) if original_filename else ''
+    return PaymentData(data)
 
 
 def _map_row_to_repet_payment_data(row_dict, vk_id, original_filename):
@@ -489,15 +1095,16 @@ def _map_row_to_repet_payment_data(row_dict, vk_id, original_filename):
         for k in keys:
             if k is None:
                 continue
-            if k in row_dict and pd.notna(row_dict[k]):
-                return str(row_dict[k])
+            value = row_dict.get(k)
+            if value is not None and value == value:  # None и NaN — пусто
+                return _intern_value(str(value))
         return ''
     data = {}
     data['fio'] = pick('Репетитор', 'ФИО', 'fio', 'name', 'full_name', 'FIO')
     data['phone'] = pick('Номер', 'Телефон', 'phone', 'Phone', 'telephone')
     data['console'] = pick('console', 'Console')
     data['curator'] = pick('Репетитор', 'Куратор', 'curator', 'manager', 'curator_name')
-    data['vk_id'] = str(vk_id)
+    data['vk_id'] = _intern_value(str(vk_id))
     data['mail'] = pick('Почта', 'mail', 'email', 'Email')
     data['groups'] = pick('Группы', 'groups', 'group', 'groups_list')
     # Маппинг полей для репетиторов
@@ -511,45 +1118,150 @@ def _map_row_to_repet_payment_data(row_dict, vk_id, original_filename):
     data['preparation'] = pick('Подготовка к занятиям')
     data['penalties'] = pick('Штраф')
     data['total'] = pick('ИТОГ', 'Итого', 'Total', 'total')
-    data['original_filename'] = os.path.basename(original_filename) if original_filename else ''
-    return data
+    data['total_amount'] = payment_render.parse_amount(data['total'])
+    data['original_filename'] = _intern_value(os.path.basename(original_filename)) if original_filename else ''
+    return PaymentData(data)
+
+
+class NotificationDispatcher:
+    """Очередь уведомлений о новых выплатах с отдельным потоком отправки.
+
+    Уведомления раскладываются по очередям ведомостей и отправляются по кругу: строки
+    только что опубликованной ведомости чередуются со строками большой предыдущей,
+    а не ждут её окончания. Между отправками выдерживается пауза rate_limit_delay.
+    """
+
+    def __init__(self, rate_limit_delay=NOTIFY_RATE_DELAY):
+        self.rate_limit_delay = rate_limit_delay
+        self._queues = OrderedDict()  # ведомость -> deque[(vk_uid, payment_id)]
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def enqueue(self, statement, vk_uid, payment_id):
+        with self._cond:
+            queue = self._queues.get(statement)
+            if queue is None:
+                queue = self._queues[statement] = deque()
+            queue.append((vk_uid, payment_id))
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return {statement: len(queue) for statement, queue in self._queues.items()}
+
+    def _next(self):
+        """Берёт уведомление из ведомости в начале круга и переставляет её в конец."""
+        with self._cond:
+            while not self._queues:
+                self._cond.wait()
+            statement, queue = next(iter(self._queues.items()))
+            item = queue.popleft()
+            if queue:
+                self._queues.move_to_end(statement)
+            else:
+                del self._queues[statement]
+            return statement, item
+
+    def _send(self, statement, vk_uid, payment_id):
+        payment = find_payment(vk_uid, payment_id)
+        if payment is None:
+            log.warning("Payment %s for vk=%s (file=%s) not found, notification dropped", payment_id, vk_uid, statement)
+            return
+        # Пока уведомление ждало в очереди, пользователь мог открыть выплату из списка и ответить
+        if (payment.get("status") or "new") != "new":
+            log.info("Payment %s for vk=%s already %s, notification skipped", payment_id, vk_uid, payment.get("status"))
+            return
+        send_payment_message(vk_uid, payment)
+
+    def _run(self):
+        log.info("Notification dispatcher started (delay=%.2fs)", self.rate_limit_delay)
+        while True:
+            statement, (vk_uid, payment_id) = self._next()
+            started = time.monotonic()
+            try:
+                self._send(statement, vk_uid, payment_id)
+            except Exception:
+                log.exception("Failed to send VK notification for payment %s vk=%s", payment_id, vk_uid)
+            delay = self.rate_limit_delay - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
 
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="vk-notify", daemon=True)
+            self._thread.start()
 
-def import_vedomosti_into_memory(send_immediately: bool = False, rate_limit_delay: float = 0.35):
+
+notification_dispatcher = NotificationDispatcher()
+
+
+def _publish_imported_payments(entries):
+    """Кладёт записанные в БД выплаты в память.
+
+    В ленивом режиме пользователь, которого ещё не загружали, не добавляется: при первом
+    обращении hydrate_user_payments поднимет из БД все его выплаты, включая эти.
+    """
+    with user_payments_lock:
+        for vk_uid, entry in entries:
+            if STARTUP_HYDRATION == 'lazy' and vk_uid not in hydrated_users:
+                continue
+            user_payments.append(vk_uid, entry)
+
+
+def import_vedomosti_into_memory(send_immediately: bool = False):
+    """Импортирует новые строки vedomosti_users в память.
+
+    Смены state копятся и пишутся в БД пачками по IMPORT_FLUSH_BATCH одной транзакцией;
+    выплата попадает в память и в очередь уведомлений только после записи своей пачки.
+    Если запись не удалась, строки пачки остаются необработанными до следующего прохода.
+    Сами уведомления отправляет notification_dispatcher, импорт их не ждёт.
+    """
     rows = fetch_unprocessed_vedomosti()
     if not rows:
         return 0
     processed = 0
+    transitions = []  # (db_id, new_state)
+    summaries = []    # (fio, groups, total, is_repet, db_id)
+    imported = []     # (vk_uid, PaymentRecord, db_id, original_filename, is_repet)
+
+    def flush():
+        nonlocal processed
+        if not transitions:
+            return
+        ok = mark_vedomosti_states(transitions, summaries)
+        batch = list(imported)
+        transitions.clear()
+        summaries.clear()
+        imported.clear()
+        if not ok:
+            return
+        _publish_imported_payments([(vk_uid, entry) for vk_uid, entry, _, _, _ in batch])
+        for vk_uid in {item[0] for item in batch}:
+            payment_list_cache.invalidate(vk_uid)
+        for vk_uid, entry, db_id, original_filename, is_repet in batch:
+            processed += 1
+            pid = entry["id"]
+            log.info("Imported vedomosti id=%s -> payment %s for vk=%s (file=%s, is_repet=%s)", db_id, pid, vk_uid, original_filename, is_repet)
+            if send_immediately:
+                notification_dispatcher.enqueue(original_filename, vk_uid, pid)
+
     for db_row in rows:
         try:
             db_id, vk_id_raw, personal_path, original_filename, state = db_row
             vk_id_raw = (vk_id_raw or '').strip()
             if not vk_id_raw:
-                mark_vedomosti_state(db_id, 'no_vk')
+                transitions.append((db_id, 'no_vk'))
                 log.info("vedomosti id=%s has empty vk_id -> marked no_vk", db_id)
                 continue
-            try:
-                vk_uid = int(vk_id_raw)
-            except Exception:
-                m = re.search(r'(\d{5,})', vk_id_raw)
-                if m:
-                    vk_uid = int(m.group(1))
-                else:
-                    mark_vedomosti_state(db_id, 'invalid_vk')
-                    log.info("vedomosti id=%s has invalid vk_id=%s -> marked invalid_vk", db_id, vk_id_raw)
-                    continue
-            row_dict = {}
-            if personal_path and os.path.exists(personal_path):
-                try:
-                    df = get_cached_csv_data(personal_path)
-                    if isinstance(df, pd.DataFrame) and not df.empty:
-                        row_dict = df.iloc[0].to_dict()
-                    else:
-                        row_dict = {}
-                except Exception:
-                    log.warning("personal_path not found or empty for id=%s path=%s", db_id, personal_path)
-            else:
+            vk_uid = _parse_vk_uid(vk_id_raw)
+            if vk_uid is None:
+                transitions.append((db_id, 'invalid_vk'))
+                log.info("vedomosti id=%s has invalid vk_id=%s -> marked invalid_vk", db_id, vk_id_raw)
+                continue
+            row_dict = get_cached_csv_row(personal_path) if personal_path else None
+            if row_dict is None:
                 log.warning("personal_path not found or empty for id=%s path=%s", db_id, personal_path)
+                row_dict = {}
             
             # Проверяем, является ли это выплатой репетитора (по наличию столбца "Репетитор" или "Номер" или по state)
             is_repet = False
@@ -563,49 +1275,30 @@ def import_vedomosti_into_memory(send_immediately: bool = False, rate_limit_dela
             else:
                 payment_data = _map_row_to_payment_data(row_dict, vk_uid, original_filename)
 
-            # Пропускаем записи с total == 0 (не записываем в память и не отправляем уведомления)
-            def _is_zero_total(val) -> bool:
-                if val is None:
-                    return True
-                s = str(val).strip()
-                if s == "":
-                    return True
-                # заменяем запятую для float
-                s_norm = s.replace(",", ".")
-                try:
-                    num = float(s_norm)
-                    return abs(num) < 1e-9
-                except Exception:
-                    return False
-
-            if _is_zero_total(payment_data.get('total')):
-                mark_vedomosti_state(db_id, 'skip_zero_total')
+            # Пропускаем записи с total == 0 (не записываем в память и не отправляем уведомления).
+            # Сумма уже разобрана маппером: '' -> 0.0, нечисловое значение -> None (не ноль)
+            total_amount = payment_data.get('total_amount')
+            if total_amount is not None and abs(total_amount) < 1e-9:
+                transitions.append((db_id, 'skip_zero_total'))
                 log.info("Skipped vedomosti id=%s for vk=%s (total=0)", db_id, vk_uid)
                 continue
 
             # Сохраняем информацию о типе выплаты в данных
-            if is_repet:
-                payment_data['is_repet'] = True
-            else:
-                payment_data['is_repet'] = False
-
-            pid = add_payment_for_user(vk_uid, payment_data)
-            
-            if is_repet:
-                mark_vedomosti_state(db_id, f"repet_imported:{pid}")
-            else:
-                mark_vedomosti_state(db_id, f"imported:{pid}")
-            
-            processed += 1
-            log.info("Imported vedomosti id=%s -> payment %s for vk=%s (file=%s, is_repet=%s)", db_id, pid, vk_uid, original_filename, is_repet)
-            if send_immediately:
-                try:
-                    send_payment_message(vk_uid, find_payment(vk_uid, pid))
-                    time.sleep(rate_limit_delay)
-                except Exception:
-                    log.exception("Failed to send immediate VK notification for payment %s vk=%s", pid, vk_uid)
+            payment_data['is_repet'] = is_repet
+
+            entry = new_payment_record(payment_data)
+            pid = entry["id"]
+            transitions.append((db_id, f"repet_imported:{pid}" if is_repet else f"imported:{pid}"))
+            # В памяти выплата хранится под тем же id, что в списке и кнопках
+            entry.id, entry.db_id, entry.original_payment_id = _payment_record_id(pid, db_id), db_id, pid
+            summaries.append((payment_data.get('fio', ''), payment_data.get('groups', ''), total_amount, int(is_repet), db_id))
+            imported.append((vk_uid, entry, db_id, original_filename, is_repet))
         except Exception:
             log.exception("Failed to import vedomosti row %s", db_row)
+        finally:
+            if len(transitions) >= IMPORT_FLUSH_BATCH:
+                flush()
+    flush()
     return processed
 
 
@@ -615,10 +1308,13 @@ def background_importer(poll_interval=5.0):
     
     while True:
         try:
+            # TG бот подменяет файл снимка после изменений ведомостей; подхватываем новую версию
+            statement_snapshot.check()
             # Import new reports and send notifications immediately to VK users
             imported = import_vedomosti_into_memory(send_immediately=True)
             if imported:
-                log.info("Imported %d vedomosti into in-memory payments and sent VK notifications", imported)
+                log.info("Imported %d vedomosti into in-memory payments, notifications queued: %s",
+                         imported, notification_dispatcher.pending())
             cleanup_archived_payments()
             current_time = time.time()
             if current_time - last_cleanup > MEMORY_CLEANUP_INTERVAL:
@@ -629,104 +1325,198 @@ def background_importer(poll_interval=5.0):
             log.exception("Background importer exception")
         time.sleep(poll_interval)
 
-def load_imported_vedomosti_into_memory(send_notifications: bool = False, rate_limit_delay: float = 0.35) -> int:
+def _parse_vk_uid(vk_id_raw):
+    """Числовой VK ID из значения столбца vk_id или None."""
+    vk_id_raw = (vk_id_raw or '').strip()
+    if not vk_id_raw:
+        return None
+    try:
+        return int(vk_id_raw)
+    except ValueError:
+        m = re.search(r'(\d{5,})', vk_id_raw)
+        return int(m.group(1)) if m else None
+
+
+def _payment_record_id(payment_uuid: str, db_id) -> str:
+    """id выплаты в памяти, в списке и в кнопках: uuid импорта и id строки vedomosti_users."""
+    return f"{payment_uuid}_{db_id}"
+
+
+def _imported_payment_record(db_id, vk_uid, personal_path, original_filename, state, status_db, disagree_reason_db, confirmed_at_db):
+    """Собирает PaymentRecord для строки vedomosti_users с состоянием imported/repet_imported."""
+    if not state or (not state.startswith('imported:') and not state.startswith('repet_imported:')):
+        return None
+    is_repet = state.startswith('repet_imported:')
+    payment_id = state.split(':', 1)[1]
+    if not payment_id:
+        return None
+    row_dict = (get_cached_csv_row(personal_path) if personal_path else None) or {}
+    if is_repet:
+        payment_data = _map_row_to_repet_payment_data(row_dict, vk_uid, original_filename)
+    else:
+        payment_data = _map_row_to_payment_data(row_dict, vk_uid, original_filename)
+    payment_data['is_repet'] = is_repet
+    return PaymentRecord(
+        id=_payment_record_id(payment_id, db_id),
+        data=payment_data,
+        created_at=float(confirmed_at_db) if confirmed_at_db else time.time(),
+        status=status_db or "new",
+        db_id=db_id,
+        original_payment_id=payment_id,
+        disagree_reason=disagree_reason_db or None,
+    )
+
+
+def _load_statement_records(statement_rows):
+    """Читает персональные файлы одной ведомости и собирает записи (выполняется в пуле потоков)."""
+    records = []
+    for db_row in statement_rows:
+        db_id, vk_uid, personal_path, original_filename, state, status_db, disagree_reason_db, confirmed_at_db = db_row
+        try:
+            record = _imported_payment_record(db_id, vk_uid, personal_path, original_filename, state,
+                                              status_db, disagree_reason_db, confirmed_at_db)
+            if record is not None:
+                records.append((vk_uid, record))
+        except Exception:
+            log.exception("Error while loading imported vedomosti row %s", db_row)
+    return records
+
+
+def load_imported_vedomosti_into_memory(send_notifications: bool = False) -> int:
+    """Полная загрузка импортированных ведомостей в память (режим eager).
+
+    Строки группируются по ведомости, персональные файлы читаются в пуле из
+    HYDRATION_WORKERS потоков, а готовые записи вставляются одной пачкой под
+    блокировкой хранилища.
+    """
     if not os.path.exists(DB_PATH):
         log.warning("DB file not found: %s", DB_PATH)
         return 0
-    loaded = 0
+    started = time.perf_counter()
     try:
         conn = sqlite3.connect(DB_PATH, timeout=30)
         c = conn.cursor()
-        c.execute("SELECT id, vk_id, personal_path, original_filename, state, status, disagree_reason, confirmed_at FROM vedomosti_users WHERE state LIKE 'imported:%' OR state LIKE 'repet_imported:%'")
+        c.execute("SELECT id, vk_id, personal_path, original_filename, state, status, disagree_reason, confirmed_at FROM vedomosti_users WHERE state_kind IN ('imported', 'repet_imported')")
         rows = c.fetchall()
         conn.close()
     except Exception:
         log.exception("Failed to query imported vedomosti from sqlite")
         return 0
 
+    # Уже загруженные выплаты собираем один раз, а не ищем по каждой строке
+    known = {(uid, p["id"]) for uid, payments in user_payments.items() for p in payments}
+    by_statement = {}
     for db_row in rows:
-        try:
-            db_id, vk_id_raw, personal_path, original_filename, state, status_db, disagree_reason_db, confirmed_at_db = db_row
-            if not state or (not state.startswith('imported:') and not state.startswith('repet_imported:')):
-                continue
-            
-            is_repet = state.startswith('repet_imported:')
-            prefix = 'repet_imported:' if is_repet else 'imported:'
-            parts = state.split(prefix, 1)
-            if len(parts) != 2 or not parts[1]:
-                continue
-            payment_id = parts[1]
-            vk_id_raw = (vk_id_raw or '').strip()
-            if not vk_id_raw:
-                log.info("Skipping imported row %s because vk_id empty", db_id)
-                continue
+        db_id, vk_id_raw, personal_path, original_filename, state, status_db, disagree_reason_db, confirmed_at_db = db_row
+        vk_uid = _parse_vk_uid(vk_id_raw)
+        if vk_uid is None:
+            log.info("Skipping imported row %s due invalid vk_id=%s", db_id, vk_id_raw)
+            continue
+        if (vk_uid, _payment_record_id((state or '').split(':', 1)[-1], db_id)) in known:
+            continue
+        by_statement.setdefault(original_filename, []).append(
+            (db_id, vk_uid, personal_path, original_filename, state, status_db, disagree_reason_db, confirmed_at_db))
+
+    loaded_records = []
+    done = 0
+    with ThreadPoolExecutor(max_workers=HYDRATION_WORKERS) as executor:
+        futures = [executor.submit(_load_statement_records, statement_rows) for statement_rows in by_statement.values()]
+        for future in as_completed(futures):
             try:
-                vk_uid = int(vk_id_raw)
+                loaded_records.extend(future.result())
             except Exception:
-                m = re.search(r'(\d{5,})', vk_id_raw)
-                if m:
-                    vk_uid = int(m.group(1))
-                else:
-                    log.info("Skipping imported row %s due invalid vk_id=%s", db_id, vk_id_raw)
-                    continue
-            if find_payment(vk_uid, payment_id):
-                log.debug("Payment %s already loaded for user %s, skipping", payment_id, vk_uid)
-                continue
-            row_dict = {}
-            if personal_path and os.path.exists(personal_path):
-                try:
-                    df = get_cached_csv_data(personal_path)
-                    if isinstance(df, pd.DataFrame) and not df.empty:
-                        row_dict = df.iloc[0].to_dict()
-                except Exception:
-                    pass
-            
-            if is_repet:
-                payment_data = _map_row_to_repet_payment_data(row_dict, vk_uid, original_filename)
-                payment_data['is_repet'] = True
-            else:
-                payment_data = _map_row_to_payment_data(row_dict, vk_uid, original_filename)
-                payment_data['is_repet'] = False
-            entry = {
-                "id": payment_id,
-                "data": payment_data,
-                "created_at": float(confirmed_at_db) if confirmed_at_db else time.time(),
-                "status": status_db or "new",
-            }
-            if disagree_reason_db:
-                entry["disagree_reason"] = disagree_reason_db
-            user_payments.setdefault(vk_uid, []).append(entry)
-            loaded += 1
-            log.info("Loaded imported vedomosti db_id=%s -> payment %s for vk=%s (file=%s) status=%s is_repet=%s", db_id, payment_id, vk_uid, original_filename, status_db, is_repet)
-            if send_notifications:
-                try:
-                    send_payment_message(vk_uid, find_payment(vk_uid, payment_id))
-                    time.sleep(rate_limit_delay)
-                except Exception:
-                    log.exception("Failed to send startup notification for payment %s vk=%s", payment_id, vk_uid)
-        except Exception:
-            log.exception("Error while loading imported vedomosti row %s", db_row)
+                log.exception("Failed to load statement records")
+            done += 1
+            if done % 20 == 0 or done == len(futures):
+                log.info("Startup hydration: %d/%d statements, %d payments", done, len(futures), len(loaded_records))
 
-    log.info("Loaded %d imported vedomosti into memory", loaded)
+    with user_payments_lock:
+        for vk_uid, record in loaded_records:
+            user_payments.append(vk_uid, record)
+    loaded = len(loaded_records)
+    elapsed = time.perf_counter() - started
+    log.info("Loaded %d imported vedomosti into memory from %d statements in %.2fs (%.0f rows/s)",
+             loaded, len(by_statement), elapsed, loaded / elapsed if elapsed > 0 else 0.0)
+
+    if send_notifications:
+        for vk_uid, record in loaded_records:
+            notification_dispatcher.enqueue(record.data.get('original_filename', ''), vk_uid, record["id"])
     return loaded
 
+def hydrate_user_payments(user_id: int) -> int:
+    """Лениво поднимает в память импортированные ведомости одного пользователя.
+
+    Загруженные пользователи отмечаются в hydrated_users, в том числе те, у кого выплат
+    нет, — повторные обращения к ним в БД не ходят. Отметка ставится до чтения БД:
+    выплату, импортированную во время загрузки, импортер сам положит в память, а здесь
+    она будет слита по id. При вытеснении из user_payments отметка снимается.
+    """
+    if user_id in hydrated_users or not os.path.exists(DB_PATH):
+        return 0
+    hydrated_users.set(user_id, True)
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        c = conn.cursor()
+        c.execute("""
+            SELECT id, personal_path, original_filename, state, status, disagree_reason, confirmed_at
+            FROM vedomosti_users
+            WHERE vk_id = ?
+              AND state_kind IN ('imported', 'repet_imported')
+            ORDER BY COALESCE(created_at, 0), id
+        """, (str(user_id),))
+        rows = c.fetchall()
+        conn.close()
+    except Exception:
+        log.exception("Failed to hydrate payments for user %s", user_id)
+        hydrated_users.pop(user_id)
+        return 0
+
+    records = []
+    for db_id, personal_path, original_filename, state, status_db, disagree_reason_db, confirmed_at_db in rows:
+        try:
+            record = _imported_payment_record(db_id, user_id, personal_path, original_filename, state,
+                                              status_db, disagree_reason_db, confirmed_at_db)
+            if record is not None:
+                records.append(record)
+        except Exception:
+            log.exception("Error while hydrating vedomosti row %s for user %s", db_id, user_id)
+    if not records:
+        return 0
+    with user_payments_lock:
+        # Пока читали файлы, импортер мог добавить пользователю новую выплату
+        existing = user_payments.peek(user_id)
+        if existing is not None:
+            known_ids = {p["id"] for p in existing}
+            records = [r for r in records if r["id"] not in known_ids] + existing
+        user_payments.set(user_id, records)
+    log.debug("Hydrated %d payments for user %s", len(records), user_id)
+    return len(records)
+
+
 def cleanup_archived_payments():
     try:
         conn = sqlite3.connect(DB_PATH, timeout=30)
         c = conn.cursor()
-        c.execute("SELECT DISTINCT original_filename FROM vedomosti_users WHERE state LIKE 'imported:%' OR state LIKE 'repet_imported:%'")
+        c.execute("SELECT DISTINCT original_filename FROM vedomosti_users WHERE state_kind IN ('imported', 'repet_imported')")
         active_files = {row[0] for row in c.fetchall()}
         conn.close()
+        # Ведомость заархивирована или удалена в TG: сбрасываем закэшированные списки, где она есть
+        dropped = payment_list_cache.invalidate_missing({os.path.basename(f) for f in active_files if f})
+        if dropped:
+            log.info("Invalidated cached payment lists of %d users after archive cleanup", dropped)
         
         removed_count = 0
-        for user_id, payments in list(user_payments.items()):
-            original_payments = payments.copy()
-            payments[:] = [p for p in original_payments if p["data"].get("original_filename") in active_files]
-            removed_count += len(original_payments) - len(payments)
+        for user_id, payments in user_payments.items():
+            kept = [p for p in payments if p["data"].get("original_filename") in active_files]
+            if len(kept) == len(payments):
+                continue
+            removed_count += len(payments) - len(kept)
             
-            # Если у пользователя не осталось выплат, удаляем его из словаря
-            if not payments:
-                del user_payments[user_id]
+            # Если у пользователя не осталось выплат, удаляем его из хранилища
+            if kept:
+                user_payments.set(user_id, kept, touch=False)
+            else:
+                user_payments.pop(user_id)
         
         if removed_count > 0:
             log.info("Cleaned up %d archived payments from memory", removed_count)
@@ -873,14 +1663,14 @@ def payments_list_keyboard(statements, page: int = 0, page_size: int = 6):
     return json.dumps(kb, ensure_ascii=False)
 
 
-def payments_list_keyboard_for_user(user_payments_list, page: int = 0, page_size: int = 5, add_more: bool = True):
-    """Клавиатура списка выплат для конкретного пользователя с учетом его статусов."""
-    total = len(user_payments_list)
-    start = page * page_size
-    end = start + page_size
-    page_items = user_payments_list[start:end]
+def payments_list_keyboard_for_user(entries, start_index: int = 1, more_cursor=None):
+    """Клавиатура части списка выплат пользователя с учетом его статусов.
+
+    entries - выплаты одной части (не больше LIST_PAGE_SIZE), start_index - номер первой
+    из них в общем списке. Если передан more_cursor, добавляется кнопка "Ещё" с этим курсором.
+    """
     rows = []
-    for idx, entry in enumerate(page_items, start=1 + start):
+    for idx, entry in enumerate(entries, start=start_index):
         sid = entry.get("id")
         status = entry.get("status")
         
@@ -921,13 +1711,12 @@ def payments_list_keyboard_for_user(user_payments_list, page: int = 0, page_size
                 "color": button_color
             }
         ])
-    if add_more and end < total:
-        next_page = page + 1
+    if more_cursor is not None:
         rows.append([
             {
                 "action": {
                     "type": "text",
-                    "payload": json.dumps({"cmd": "payments_page", "page": next_page}, ensure_ascii=False),
+                    "payload": json.dumps(dict(more_cursor, cmd="payments_page"), ensure_ascii=False),
                     "label": "Ещё"
                 },
                 "color": "secondary"
@@ -936,118 +1725,72 @@ def payments_list_keyboard_for_user(user_payments_list, page: int = 0, page_size
     kb = {"inline": True, "buttons": rows}
     return json.dumps(kb, ensure_ascii=False)
 
-def send_payments_list_multiple(user_id: int, payments: list, page: int = 0, use_vk_direct: bool = False):
-    """Отправляет список выплат, разбивая на несколько сообщений если кнопок больше 5.
+def send_payments_list_multiple(user_id: int, payments: list, start_index: int = 1, more_cursor=None, use_vk_direct: bool = False):
+    """Отправляет порцию списка выплат, разбивая её на сообщения по LIST_PAGE_SIZE кнопок.
     
     Args:
         user_id: ID пользователя VK
-        payments: Список выплат
-        page: Номер страницы (0 для первой)
+        payments: Выплаты порции (уже ограниченные запросом)
+        start_index: Номер первой выплаты порции в общем списке
+        more_cursor: Курсор следующей порции; кнопка "Ещё" добавляется к последнему сообщению
         use_vk_direct: Если True, использует vk.messages.send напрямую, иначе safe_vk_send
     """
-    if not payments:
-        if use_vk_direct:
-            vk.messages.send(user_id=user_id, random_id=vk_api.utils.get_random_id(), 
-                           message="У Вас нет выплат.", keyboard=chat_bottom_keyboard())
-        else:
-            safe_vk_send(user_id, "У Вас нет выплат.", chat_bottom_keyboard())
-        return
-    
-    total = len(payments)
-    page_size = 5  # Безопасный лимит для VK API
-    
-    # Если выплат <= 5, отправляем одним сообщением
-    if total <= page_size:
-        if page == 0:
-            message = "Список ведомостей (выберите):"
-        else:
-            message = f"Список ведомостей (страница {page+1}):"
-        keyboard = payments_list_keyboard_for_user(payments, page=page, page_size=page_size)
+    def send(message, keyboard):
         if use_vk_direct:
             vk.messages.send(user_id=user_id, random_id=vk_api.utils.get_random_id(), 
                            message=message, keyboard=keyboard)
         else:
             safe_vk_send(user_id, message, keyboard)
+
+    if not payments:
+        if start_index == 1:
+            send("У Вас нет выплат.", chat_bottom_keyboard())
+        else:
+            send("Больше ведомостей нет.", chat_bottom_keyboard())
         return
     
-    # Если выплат больше 5 и это первая страница, отправляем несколько сообщений сразу
-    if page == 0:
-        # Отправляем первое сообщение с первыми 5 кнопками, без кнопки "Ещё"
-        keyboard = payments_list_keyboard_for_user(payments, page=0, page_size=page_size, add_more=False)
-        if use_vk_direct:
-            vk.messages.send(user_id=user_id, random_id=vk_api.utils.get_random_id(), 
-                           message="Список ведомостей (выберите):", keyboard=keyboard)
-        else:
-            safe_vk_send(user_id, "Список ведомостей (выберите):", keyboard)
-        
-        # Отправляем оставшиеся части
-        remaining_payments = payments[page_size:]
-        part_num = 2
-        
-        for i in range(0, len(remaining_payments), page_size):
-            part_payments = remaining_payments[i:i+page_size]
-            start_idx = page_size + i + 1  # Начальный индекс для нумерации
-            
-            # Создаем клавиатуру для этой части
-            rows = []
-            for idx, entry in enumerate(part_payments, start=start_idx):
-                sid = entry.get("id")
-                status = entry.get("status")
-                
-                if status == "agreed":
-                    max_label_length = 37
-                    base_label = _format_payment_label(
-                        entry.get("data", {}).get('original_filename'), 
-                        idx, 
-                        max_label_length,
-                        entry.get("created_at"),
-                        entry.get("db_id"),
-                        entry.get("data", {}).get("groups")
-                    )
-                    button_label = f"{base_label} "
-                    button_color = "positive"
-                else:
-                    base_label = _format_payment_label(
-                        entry.get("data", {}).get('original_filename'), 
-                        idx, 
-                        40,
-                        entry.get("created_at"),
-                        entry.get("db_id"),
-                        entry.get("data", {}).get("groups")
-                    )
-                    button_label = base_label
-                    button_color = "primary"
-                
-                rows.append([
-                    {
-                        "action": {
-                            "type": "text",
-                            "payload": json.dumps({"cmd": "open_statement", "statement_id": sid}, ensure_ascii=False),
-                            "label": button_label
-                        },
-                        "color": button_color
-                    }
-                ])
-            
-            kb = {"inline": True, "buttons": rows}
-            keyboard_json = json.dumps(kb, ensure_ascii=False)
-            
-            part_message = f"Список ведомостей (часть {part_num}):"
-            if use_vk_direct:
-                vk.messages.send(user_id=user_id, random_id=vk_api.utils.get_random_id(), 
-                               message=part_message, keyboard=keyboard_json)
-            else:
-                safe_vk_send(user_id, part_message, keyboard_json)
-            part_num += 1
-    else:
-        # Для страниц > 0 используем обычную пагинацию
-        message = f"Список ведомостей (страница {page+1}):"
-        keyboard = payments_list_keyboard_for_user(payments, page=page, page_size=page_size)
-        if use_vk_direct:
-            vk.messages.send(user_id=user_id, random_id=vk_api.utils.get_random_id(), 
-                           message=message, keyboard=keyboard)
+    for offset in range(0, len(payments), LIST_PAGE_SIZE):
+        part = payments[offset:offset + LIST_PAGE_SIZE]
+        part_start = start_index + offset
+        is_last = offset + LIST_PAGE_SIZE >= len(payments)
+        if part_start == 1:
+            message = "Список ведомостей (выберите):"
         else:
-            safe_vk_send(user_id, message, keyboard)
+            message = f"Список ведомостей (часть {(part_start - 1) // LIST_PAGE_SIZE + 1}):"
+        keyboard = payments_list_keyboard_for_user(part, start_index=part_start,
+                                                   more_cursor=more_cursor if is_last else None)
+        send(message, keyboard)
+
+
+def send_payments_list(user_id: int, payload: dict = None, use_vk_direct: bool = False):
+    """Отправляет список выплат: первую порцию (to_list) или следующую по кнопке "Ещё".
+
+    Порция - до LIST_PARTS_PER_REQUEST сообщений по LIST_PAGE_SIZE кнопок. Следующая
+    порция выбирается по курсору (created_at, id) последней показанной выплаты, поэтому
+    стоимость нажатия не зависит от длины истории. Кнопки "Ещё" старого формата
+    ({"page": N}) обрабатываются через смещение.
+    """
+    payload = payload or {}
+    limit = LIST_PAGE_SIZE * LIST_PARTS_PER_REQUEST
+    before = None
+    offset = 0
+    start_index = 1
+    if isinstance(payload.get("before"), (list, tuple)) and len(payload["before"]) == 2:
+        before = (int(payload["before"][0]), int(payload["before"][1]))
+        start_index = int(payload.get("n", 1))
+    elif "page" in payload:
+        offset = int(payload.get("page", 0)) * LIST_PAGE_SIZE
+        start_index = offset + 1
+    # Лишняя строка показывает, есть ли продолжение
+    payments = get_payment_summaries_for_user(user_id, limit=limit + 1, before=before, offset=offset)
+    more_cursor = None
+    if len(payments) > limit:
+        payments = payments[:limit]
+        last = payments[-1]
+        more_cursor = {"before": [int(last.get("created_at") or 0), last.get("db_id")],
+                       "n": start_index + len(payments)}
+    send_payments_list_multiple(user_id, payments, start_index=start_index,
+                                more_cursor=more_cursor, use_vk_direct=use_vk_direct)
 
 
 def payments_disagree_keyboard(payment_id: str):
@@ -1154,139 +1897,15 @@ def format_payment_text(data: dict) -> str:
             if not csv_path:
                 return format_payment_text_fallback(data)
         
-        # Читаем CSV
+        # Читаем CSV и находим строку пользователя
         try:
-            df = pd.read_csv(csv_path, dtype=str)
+            row = _find_csv_row_for_vk(csv_path, vk_id_str, personal_path)
         except Exception:
-            try:
-                df = pd.read_csv(csv_path, encoding='cp1251', dtype=str)
-            except Exception:
-                return format_payment_text_fallback(data)
-        
-        if df is None or df.empty or 'vk_id' not in df.columns:
             return format_payment_text_fallback(data)
-        
-        # Находим строку пользователя
-        vk_series = df['vk_id'].fillna('').astype(str).apply(_extract_numeric_vk)
-        row = df[vk_series == vk_id_str]
-        if row.empty:
+        if row is None:
             return format_payment_text_fallback(data)
         
-        p = row.fillna('0').iloc[0]
-        
-        # Современный формат с учётом новых столбцов
-        sections = _compose_payment_sections(p)
-        checks_block = sections["checks"]
-        if checks_block:
-            checks_block = "\n[Проверки]" + checks_block
-        extras_block = sections["extras"]
-        if extras_block.startswith("\n[Иная деятельность]"):
-            extras_block = "\n[ Иная деятельность]" + extras_block[len("\n[Иная деятельность]"):]
-        fines_block = sections["fines"]
-        if fines_block.startswith("\n\n→ Штрафы"):
-            fines_block = "\n\n" + fines_block[len("\n\n→ "):]
-        total_block = sections["total"]
-        if total_block.startswith("\n\n→ ИТОГО"):
-            total_block = "\n\n" + total_block[len("\n\n→ "):]
-        
-        groups_str = str(p.get('groups', '')).strip()
-        groups_line = f"\nГруппы: {groups_str}" if groups_str else ""
-        
-        base = (f"=== Согласование выплаты ==="
-                f"\nВедомость: {original_filename.replace('.csv', '').replace('_', ' ')}"
-                f"\nКуратор: {p.get('name', '')}"
-                f"\nТип куратора: {p.get('type', '')}"
-                f"\nПочта на платформе: {p.get('email', '')}"
-                f"{groups_line}\n")
-
-        final = ("\n\nНажмите «Согласен», если у Вас нет разногласий с выставленными цифрами"
-                 "\nНажмите «Не согласен», если Вы не согласны с каким-либо из пунктов"
-                 "\nПросмотр ведомости возможен в течение 36 часов")
-
-        msg = (base
-               + sections["studs"]
-               + sections["retention"]
-               + sections["okk"]
-               + checks_block
-               + extras_block
-               + fines_block
-               + total_block
-               + final)
-        return msg
-        
-        # Используем красивое форматирование как в format_message
-        base = (f"=== Согласование выплаты ==="
-                f"\nВедомость: {original_filename.replace('.csv', '').replace('_', ' ')}"
-                f"\nКуратор: {p.get('name', '')}"
-                f"\nТип куратора: {p.get('type', '')}"
-                f"\nПочта на платформе: {p.get('email', '')}\n")
-
-        studs_section = ""
-        stud_all = _to_int_safe(p.get('stud_all'))
-        if stud_all > 0:
-            studs_section = (f"\n[Сопровождение учеников]"
-                             f"\nВсего учеников в группах: {stud_all}"
-                             f"\nСтавка за ученика: {_to_int_safe(p.get('base'))}₽")
-            stud_rep = _to_int_safe(p.get('stud_rep'))
-            if stud_rep > 0:
-                studs_section += (f"\nИз них с репетитором: {stud_rep}"
-                                  f"\nДоплата за учеников с репетитором: 50₽ / чел")
-            studs_section += f"\n→ Всего за сопровождение: {_to_int_safe(p.get('stud_salary'))}₽\n"
-            studs_section += (f"\nПоказатель RR: {p.get('rr','')} | KPI за RR: {_to_float_str_money(p.get('rr_salary'))}₽"
-                              f"\nПоказатель ОКК: {p.get('okk','')} | KPI за ОКК: {_to_float_str_money(p.get('okk_salary'))}₽"
-                              f"\n→ Всего KPI (RR+OKK): {_to_float_str_money(p.get('kpi_total'))}₽\n")
-
-        checks_section = ""
-        checks_salary = _to_int_safe(p.get('checks_salary'))
-        dop_checks = _to_int_safe(p.get('dop_checks'))
-        if checks_salary > 0 or dop_checks > 0:
-            checks_section = f"\n[Проверки]"
-            if checks_salary > 0:
-                checks_section += f"\n→ Проверка домашних работ: {checks_salary}₽"
-            if dop_checks > 0:
-                checks_section += f"\n→ Дополнительно – за проверки (данные СК): {dop_checks}₽"
-            checks_section += "\n"
-
-        # Дополнительная деятельность
-        extras_keys = ['up','chats','webs','meth','dop_sk','callsg','callsp']
-        extras_names = {
-            'up': 'За учебную поддержку',
-            'chats': 'Модерация чатов',
-            'webs': 'Модерация вебинаров',
-            'callsg': 'Групповые созвоны',
-            'callsp': 'Индивидуальные созвоны',
-            'dop_sk': 'Доп. суммы, начисленные СК',
-            'meth': 'Стол заказов',
-        }
-        extras_total = sum(_to_int_safe(p.get(k)) for k in extras_keys)
-        dops_section = ""
-        if extras_total > 0:
-            dops_section = "\n[ Иная деятельность]"
-            for k in extras_keys:
-                v = _to_int_safe(p.get(k))
-                if v > 0:
-                    dops_section += f"\n{extras_names[k]}: {v}₽"
-            dops_section += f"\n→ Всего в категории: {extras_total}₽"
-
-        # Штрафы
-        fines_val = _to_int_safe(p.get('fines'))
-        fines_section = f"\n\nШтрафы: -{fines_val}₽" if fines_val > 0 else f"\n\nШтрафы: отсутствуют"
-
-        # Итого
-        total_section = f"\n\nИТОГО К ВЫПЛАТЕ: {_to_float_str_money(p.get('total'))}₽"
-        
-        # Добавляем комментарий, если он осмысленный
-        comment = p.get('comment', '')
-        if _is_meaningful_comment(comment):
-            total_section += f"\n[!!!] Комментарий: {str(comment).strip()}"
-        
-        # Финальная информация
-        final = ("\n\nНажмите «Согласен», если у Вас нет разногласий с выставленными цифрами"
-                 "\nНажмите «Не согласен», если Вы не согласны с каким-либо из пунктов"
-                 "\nПросмотр ведомости возможен в течение 36 часов")
-
-        msg = base + studs_section + checks_section + dops_section + fines_section + total_section + final
-        return msg
+        return payment_render.render_payment_text(row, original_filename)
         
     except Exception:
         log.exception("Failed to format payment text with enhanced format, using fallback")
@@ -1307,21 +1926,9 @@ def format_payment_text_fallback(data: dict) -> str:
         lines.append(f"Комментарий: {str(data.get('comment')).strip()}")
     lines.append(f"Группы: {data.get('groups','')}")
 
-    sections = _compose_payment_sections(data)
-    fallback_order = ["studs", "retention", "okk", "checks", "extras", "fines", "total"]
-    for key in fallback_order:
-        block = sections.get(key, "")
-        if not block:
-            continue
-        if key == "checks":
-            block = "\n[Проверки]" + block
-        if key == "extras" and block.startswith("\n[Иная деятельность]"):
-            block = "\n[ Иная деятельность]" + block[len("\n[Иная деятельность]"):]
-        if key == "fines" and block.startswith("\n\n→ Штрафы"):
-            block = "\n\n" + block[len("\n\n→ "):]
-        if key == "total" and block.startswith("\n\n→ ИТОГО"):
-            block = "\n\n" + block[len("\n\n→ "):]
-        lines.append(block)
+    # Разделы в оформлении ведомости: заголовок проверок, штрафы и итог без стрелки
+    sections = payment_render.compose_statement_sections(data)
+    lines.extend(block for block in sections.values() if block)
 
     lines.append("\nПросмотр ведомости возможен в течение 36 часов")
     return "\n".join(lines)
@@ -1348,45 +1955,11 @@ def format_repet_payment_text(data: dict) -> str:
             if not csv_path:
                 return format_repet_payment_text_fallback(data)
         
-        # Читаем CSV
-        try:
-            df = pd.read_csv(csv_path, dtype=str)
-        except Exception:
-            try:
-                df = pd.read_csv(csv_path, encoding='cp1251', dtype=str)
-            except Exception:
-                return format_repet_payment_text_fallback(data)
-        
-        if df is None or df.empty:
-            return format_repet_payment_text_fallback(data)
-        
         # Берём первую строку (персональный файл должен содержать одну строку)
-        p = df.fillna('0').iloc[0]
-        
-        # Форматируем сообщение по новому шаблону
-        msg = "Открыта ведомость\n\n"
-        msg += "=== Согласование выплаты ===\n"
-        msg += f"ФИО: {p.get('Репетитор', '') or data.get('fio', '')}\n"
-        msg += f"Предмет: {p.get('Предмет', '') or data.get('subject', '')}\n"
-        msg += f"Кол-во проведенных занятий: {p.get('Кол-во состоявшихся занятий', '') or data.get('lessons_held', '')}\n"
-        msg += f"Уроки без подключения ученика: {p.get('Кол-во занятий, на которые не явился ученик', '') or data.get('lessons_no_student', '')}\n"
-        msg += f"Оплата за занятия: {p.get('Базовое вознаграждение за проведенные занятия', '') or data.get('base_payment', '')}\n"
-        msg += f"Оценка контроля качества: {p.get('OKK', '') or p.get('ОКК', '') or data.get('okk', '')}\n"
-        msg += f"Критерий удержания учеников: {p.get('RR', '') or data.get('rr', '')}\n"
-        msg += f"Дополнительное вознаграждение за качество: {p.get('KPI', '') or data.get('kpi', '')}\n"
-        # Приоритет: data['preparation'] (из маппинга), затем из CSV напрямую
-        prep_val = data.get('preparation', '') or ''
-        if not str(prep_val).strip() or str(prep_val).strip() == '0':
-            prep_val = p.get('Подготовка к занятиям', '')
-        prep_str = str(prep_val).strip() if prep_val else '0'
-        msg += f"Доп. вознаграждение за подготовку: {prep_str}\n"
-        msg += f"Штрафы: {p.get('Штраф', '') or data.get('penalties', '')}\n"
-        msg += f"Итоговая сумма: {p.get('ИТОГ', '') or data.get('total', '')}\n\n"
-        msg += "Нажмите «Согласен», если у Вас нет разногласий с выставленными цифрами\n"
-        msg += "Нажмите «Не согласен», если Вы не согласны с каким-либо из пунктов\n"
-        msg += "Просмотр ведомости возможен в течение 36 часов"
-        
-        return msg
+        row = get_cached_csv_row(csv_path)
+        if not row:
+            return format_repet_payment_text_fallback(data)
+        return payment_render.render_repet_payment_text(row, data)
         
     except Exception:
         log.exception("Failed to format repet payment text, using fallback")
@@ -1431,6 +2004,7 @@ def map_reason_to_type(reason_label: str) -> str:
     return mapping.get(reason_label, "")
 
 def format_conflict(file_name, uid, conflict_type, personal_path=None):
+    import pandas as pd  # нужен только для разборов спорных пунктов
     if conflict_type == "students":
             reply = (f"Количество учеников взято из журнала оплат с последних продлений (листы «Статистика по группам», «Статистика по кураторам»). "
                      f"Результат просуммирован за все группы"
@@ -2120,39 +2694,6 @@ def _find_curator_csv(base_name: str, vk_uid: int):
     return None
 
 
-def _to_int_safe(value) -> int:
-    try:
-        if value is None:
-            return 0
-        s = str(value).replace('\u00A0', '').replace('\xa0', '').replace(' ', '').replace(',', '.')
-        if s == '' or s.lower() == 'nan':
-            return 0
-        return int(float(s))
-    except Exception:
-        return 0
-
-def _to_float_safe(value) -> float:
-    try:
-        if value is None:
-            return 0.0
-        s = str(value).replace('\u00A0', '').replace('\xa0', '').replace(' ', '').replace(',', '.')
-        if s == '' or s.lower() == 'nan':
-            return 0.0
-        return float(s)
-    except Exception:
-        return 0.0
-
-def _to_float_str_money(value) -> str:
-    try:
-        if value is None:
-            return '0'
-        s = str(value).replace('\u00A0', '').replace('\xa0', '').replace(' ', '').replace(',', '.')
-        if s == '' or s.lower() == 'nan':
-            return '0'
-        return str(round(float(s), 2))
-    except Exception:
-        return '0'
-
 def _format_payment_label(original_filename: str, idx: int, max_length: int = 30, created_at: float = None, db_id: int = None, groups: str = None) -> str:
     """Форматирует название выплаты для кнопки, убирая расширение .csv и ограничивая длину"""
     if original_filename:
@@ -2212,269 +2753,13 @@ def _extract_numeric_vk(value: str) -> str:
         return match.group(1)
     return s
 
-def _is_meaningful_comment(comment) -> bool:
-    """Проверяет, содержит ли комментарий полезный текст (не '0', '-', 'nan' и т.п.)."""
-    if comment is None:
-        return False
-    comment_str = str(comment).strip()
-    if not comment_str:
-        return False
-    lowered = comment_str.lower()
-    meaningless_values = {
-        '0', '0.0', '0,0', 'nan', 'none', 'нет', 'no', 'none', 'пусто', 'n/a', 'н/д', '—', '-', '––'
-    }
-    if lowered in meaningless_values:
-        return False
-    if re.fullmatch(r'0+(\.0+)?', lowered):
-        return False
-    stripped = comment_str.strip('-').strip('—').strip()
-    if not stripped:
-        return False
-    return True
-
-def _compose_payment_sections(p: dict) -> dict:
-    """Строит текстовые блоки для разных разделов выплаты."""
-    sections = {
-        "studs": "",
-        "retention": "",
-        "okk": "",
-        "checks": "",
-        "extras": "",
-        "fines": "",
-        "total": ""
-    }
+def _fetch_payment_row(payment_entry, user_id: int = None, columns: str = "status"):
+    """Одна выборка строки выплаты по db_id (или payment_uuid); обновляет status и db_id записи.
 
-    def _as_money(value) -> str:
-        return _to_float_str_money(value)
-
-    def _format_percent(value) -> str:
-        if value is None:
-            return ''
-        s = str(value).strip()
-        if not s or s.lower() in ('nan', 'none', '-', '—'):
-            return ''
-        try:
-            has_pct = s.endswith('%')
-            num = float(s.replace('%', '').replace(',', '.'))
-            if not has_pct and abs(num) <= 1:
-                num *= 100
-            num = round(num, 2)
-            if num.is_integer():
-                return f"{int(num)}%"
-            return f"{num}%"
-        except Exception:
-                return s
-
-    # Сопровождение ГК / ГК+
-    stud_gk = _to_int_safe(p.get('stud_gk'))
-    stud_gkp = _to_int_safe(p.get('stud_gkp'))
-    stud_all = _to_int_safe(p.get('stud_all'))
-    stud_rep = _to_int_safe(p.get('stud_rep'))
-    rep_salary = _to_float_str_money(p.get('rep_salary'))
-    base_val = _to_int_safe(p.get('base'))
-    stud_salary_total = _to_int_safe(p.get('stud_salary'))
-    raw_stud_salary_gk = p.get('stud_salary_gk')
-    raw_stud_salary_gkp = p.get('stud_salary_gkp')
-    stud_salary_gk_val = _to_int_safe(raw_stud_salary_gk)
-    stud_salary_gkp_val = _to_int_safe(raw_stud_salary_gkp)
-
-    slivs_gk = _to_int_safe(p.get('slivs_gk'))
-    rr_gk = _format_percent(p.get('rr_gk'))
-    rr_salary_gk = _as_money(p.get('rr_salary_gk'))
-    okk_gk = _format_percent(p.get('okk_gk'))
-    okk_salary_gk = _as_money(p.get('okk_salary_gk'))
-
-    slivs_gkp = _to_int_safe(p.get('slivs_gkp'))
-    rr_gkp = _format_percent(p.get('rr_gkp'))
-    rr_salary_gkp = _as_money(p.get('rr_salary_gkp'))
-    okk_gkp = _format_percent(p.get('okk_gkp'))
-    okk_salary_gkp = _as_money(p.get('okk_salary_gkp'))
-
-    kpi_total_val = _to_float_str_money(p.get('kpi_total'))
-    splitted_blocks = []
-
-    def _append_block(title: str, lines) -> None:
-        if lines:
-            splitted_blocks.append(f"\n{title}\n" + ''.join(lines) + "\n")
-
-    def _has_explicit(value) -> bool:
-        if value is None:
-            return False
-        if isinstance(value, str):
-            return value.strip() != ''
-        return True
-
-    gk_lines = []
-    if stud_gk > 0:
-        gk_lines.append(f"\nВсего учеников - ГК: {stud_gk}")
-    if base_val > 0:
-        gk_lines.append(f"\nОклад за ученика: {base_val}₽")
-    if stud_salary_gk_val > 0 or _has_explicit(raw_stud_salary_gk):
-        gk_lines.append(f"\n→ Сумма оклада: {stud_salary_gk_val}₽")
-    elif stud_salary_total > 0:
-        gk_lines.append(f"\n→ Сумма оклада: {stud_salary_total}₽")
-        if stud_rep > 0:
-            gk_lines.append(f"\nКол-во учеников с тарифом с репетитором: {stud_rep}")
-    if rep_salary != '0' and _to_float_safe(rep_salary) > 0:
-        gk_lines.append(f"\nДоплата за учеников с репетитором: {rep_salary}₽")
-    if rr_gk:
-        gk_lines.append(f"\nRetention ГК: {rr_gk}")
-    if rr_salary_gk != '0':
-        gk_lines.append(f"\n→ Оплата за retention ГК: {rr_salary_gk}₽")
-    if okk_gk:
-        gk_lines.append(f"\nOKK ГК: {okk_gk}")
-    if okk_salary_gk != '0':
-        gk_lines.append(f"\n→ Оплата за OKK ГК: {okk_salary_gk}₽")
-    
-    # Calculate KPI for GK - выводим всегда, если есть хотя бы одна из строк оплаты
-    if rr_salary_gk != '0' or okk_salary_gk != '0':
-        kpi_gk = _to_float_safe(rr_salary_gk) + _to_float_safe(okk_salary_gk)
-        kpi_gk_str = _to_float_str_money(kpi_gk)
-        gk_lines.append(f"\n→ Сумма KPI (OKK+Retention): {kpi_gk_str}₽")
-    
-    # Append block only if there are students (stud_gk > 0)
-    if stud_gk > 0:
-        _append_block('[Сопровождение ГК]', gk_lines)
-
-    gkp_lines = []
-    if stud_gkp > 0:
-        gkp_lines.append(f"\nВсего учеников - ГК+: {stud_gkp}")
-    if base_val > 0:
-        gkp_lines.append(f"\nОклад за ученика: {base_val}₽")
-    if stud_salary_gkp_val > 0 or _has_explicit(raw_stud_salary_gkp):
-        gkp_lines.append(f"\n→ Сумма оклада: {stud_salary_gkp_val}₽")
-    if rr_gkp:
-        gkp_lines.append(f"\nRetention ГК+: {rr_gkp}")
-    if rr_salary_gkp != '0':
-        gkp_lines.append(f"\n→ Оплата за retention ГК+: {rr_salary_gkp}₽")
-    if okk_gkp:
-        gkp_lines.append(f"\nOKK ГК+: {okk_gkp}")
-    if okk_salary_gkp != '0':
-        gkp_lines.append(f"\n→ Оплата за OKK ГК+: {okk_salary_gkp}₽")
-    
-    # Calculate KPI for GK+ - выводим всегда, если есть хотя бы одна из строк оплаты
-    if rr_salary_gkp != '0' or okk_salary_gkp != '0':
-        kpi_gkp = _to_float_safe(rr_salary_gkp) + _to_float_safe(okk_salary_gkp)
-        kpi_gkp_str = _to_float_str_money(kpi_gkp)
-        gkp_lines.append(f"\n→ Сумма KPI (OKK+Retention): {kpi_gkp_str}₽")
-    
-    # Append block only if there are students (stud_gkp > 0)
-    if stud_gkp > 0:
-        _append_block('[Сопровождение ГК+]', gkp_lines)
-
-    if splitted_blocks:
-        studs_combined = ''.join(splitted_blocks)
-        sections['studs'] = studs_combined
-    elif any(value > 0 for value in (stud_all, stud_rep, stud_salary_total)) or (rep_salary != '0' and _to_float_safe(rep_salary) > 0):
-        # Проверяем, есть ли хотя бы одно ненулевое значение (кроме base_val и kpi_total_val)
-        has_meaningful_data = any(value > 0 for value in (stud_all, stud_rep, stud_salary_total)) or (rep_salary != '0' and _to_float_safe(rep_salary) > 0)
-        if has_meaningful_data:
-            studs_section = "\n[Сопровождение учеников]"
-            if stud_all > 0:
-                studs_section += f"\nВсего учеников в группах: {stud_all}"
-            if stud_rep > 0:
-                studs_section += f"\nКол-во учеников с тарифом с репетитором: {stud_rep}"
-            if base_val > 0:
-                studs_section += f"\nОклад за ученика: {base_val}₽"
-            if rep_salary != '0' and _to_float_safe(rep_salary) > 0:
-                studs_section += f"\nДоплата за учеников с репетитором: {rep_salary}₽"
-            if stud_salary_total > 0:
-                studs_section += f"\n→ Сумма оклада: {stud_salary_total}₽"
-            if kpi_total_val != '0' and _to_float_safe(kpi_total_val) > 0:
-                studs_section += f"\n→ Сумма KPI (OKK+Retention): {kpi_total_val}₽"
-            sections['studs'] = studs_section
-
-    # Retention и OKK (общие блоки показываем только если нет отдельных секций)
-    if not splitted_blocks:
-        # Проверяем, есть ли хотя бы одно ненулевое значение в retention
-        has_retention_data = (
-            (rr_salary_gk != '0' and _to_float_safe(rr_salary_gk) > 0) or
-            (rr_salary_gkp != '0' and _to_float_safe(rr_salary_gkp) > 0)
-        )
-        if has_retention_data:
-            retention_section = "\n[Retention]"
-            if rr_gk:
-                retention_section += f"\nRetention ГК: {rr_gk}"
-            if rr_salary_gk != '0':
-                retention_section += f"\nОплата за retention ГК: {rr_salary_gk}₽"
-            if rr_gkp:
-                retention_section += f"\nRetention ГК+: {rr_gkp}"
-            if rr_salary_gkp != '0':
-                retention_section += f"\nОплата за retention ГК+: {rr_salary_gkp}₽"
-            sections['retention'] = retention_section
-
-        # Проверяем, есть ли хотя бы одно ненулевое значение в OKK
-        has_okk_data = (
-            (okk_salary_gk != '0' and _to_float_safe(okk_salary_gk) > 0) or
-            (okk_salary_gkp != '0' and _to_float_safe(okk_salary_gkp) > 0) or
-            (kpi_total_val != '0' and _to_float_safe(kpi_total_val) > 0)
-        )
-        if has_okk_data:
-            okk_section = "\n[Показатели ОКК]"
-            if okk_gk:
-                okk_section += f"\nOKK ГК: {okk_gk}"
-            if okk_salary_gk != '0':
-                okk_section += f"\nОплата за OKK ГК: {okk_salary_gk}₽"
-            if okk_gkp:
-                okk_section += f"\nOKK ГК+: {okk_gkp}"
-            if okk_salary_gkp != '0':
-                okk_section += f"\nОплата за OKK ГК+: {okk_salary_gkp}₽"
-            if kpi_total_val != '0' and _to_float_safe(kpi_total_val) > 0:
-                okk_section += f"\n→ Сумма KPI (OKK+Retention): {kpi_total_val}₽"
-            sections['okk'] = okk_section
-
-    # Проверки (существующий блок)
-    checks_section = ""
-    checks_salary = _to_int_safe(p.get('checks_salary'))
-    dop_checks = _to_int_safe(p.get('dop_checks'))
-    if checks_salary > 0 or dop_checks > 0:
-        if checks_salary > 0:
-            checks_section += f"\n→ Проверка домашних работ: {checks_salary}₽"
-        if dop_checks > 0:
-            checks_section += f"\n→ Дополнительно – за проверки (данные СК): {dop_checks}₽"
-        checks_section += "\n"
-    sections["checks"] = checks_section
-
-    # Дополнительная деятельность (существующий блок)
-    extras_keys = ['up','chats','webs','meth','dop_sk','callsg','callsp']
-    extras_names = {
-        'up': 'За учебную поддержку',
-        'chats': 'Модерация чатов',
-        'webs': 'Модерация вебинаров',
-        'callsg': 'Групповые созвоны',
-        'callsp': 'Индивидуальные созвоны',
-        'dop_sk': 'Доп. суммы, начисленные СК',
-        'meth': 'Стол заказов',
-    }
-    extras_total = sum(_to_int_safe(p.get(k)) for k in extras_keys)
-    dops_section = ""
-    if extras_total > 0:
-        dops_section = "\n\n[Иная деятельность]"
-        for k in extras_keys:
-            v = _to_int_safe(p.get(k))
-            if v > 0:
-                dops_section += f"\n{extras_names[k]}: {v}₽"
-        dops_section += f"\n→ Всего в категории: {extras_total}₽"
-    sections["extras"] = dops_section
-
-    # Штрафы (существующий блок)
-    fines_val = _to_int_safe(p.get('fines'))
-    fines_section = f"\n\n→ Штрафы: -{fines_val}₽" if fines_val > 0 else f"\n\nШтрафы: отсутствуют"
-    sections["fines"] = fines_section
-
-    # Итого + комментарий
-    total_section = f"\n\n→ ИТОГО К ВЫПЛАТЕ: {_to_float_str_money(p.get('total'))}₽"
-    comment = p.get('comment', '')
-    if _is_meaningful_comment(comment):
-        total_section += f"\n[!!!] Комментарий: {str(comment).strip()}"
-    sections["total"] = total_section
-
-    return sections
-
-def refresh_payment_status_from_db(payment_entry, user_id: int = None):
-    """Обновляет статус выплаты из базы данных и возвращает актуальное значение."""
+    Возвращает значения columns (первый столбец всегда status) или None.
+    """
     if not os.path.exists(DB_PATH):
-        return payment_entry.get("status")
+        return None
     payment_id = payment_entry.get("id") or ""
     original_payment_id = payment_entry.get("original_payment_id") or ""
     db_id = payment_entry.get("db_id")
@@ -2483,52 +2768,73 @@ def refresh_payment_status_from_db(payment_entry, user_id: int = None):
         c = conn.cursor()
         row = None
         if db_id:
-            c.execute("SELECT status FROM vedomosti_users WHERE id = ?", (int(db_id),))
+            c.execute(f"SELECT {columns}, id FROM vedomosti_users WHERE id = ?", (int(db_id),))
             row = c.fetchone()
         else:
-            state_value = None
+            payment_uuid = None
             if original_payment_id:
-                state_value = f"imported:{original_payment_id}"
+                payment_uuid = original_payment_id
             elif '_' in payment_id:
-                state_value = f"imported:{payment_id.split('_')[0]}"
+                payment_uuid = payment_id.split('_')[0]
             elif payment_id:
-                state_value = f"imported:{payment_id}"
-            if state_value:
+                payment_uuid = payment_id
+            if payment_uuid:
                 if user_id is not None:
-                    c.execute("SELECT status, id FROM vedomosti_users WHERE vk_id = ? AND state = ?", (str(user_id), state_value))
+                    c.execute(f"SELECT {columns}, id FROM vedomosti_users WHERE payment_uuid = ? AND vk_id = ?", (payment_uuid, str(user_id)))
                 else:
-                    c.execute("SELECT status, id FROM vedomosti_users WHERE state = ?", (state_value,))
+                    c.execute(f"SELECT {columns}, id FROM vedomosti_users WHERE payment_uuid = ?", (payment_uuid,))
                 row = c.fetchone()
         conn.close()
-        if row:
-            if len(row) == 2 and not db_id:
-                payment_entry["db_id"] = row[1]
-                payment_entry["status"] = row[0] or ''
-            else:
-                payment_entry["status"] = row[0] or ''
-        return payment_entry.get("status")
+        if not row:
+            return None
+        if not db_id:
+            payment_entry["db_id"] = row[-1]
+        payment_entry["status"] = row[0] or ''
+        return row[:-1]
     except Exception:
         log.exception("Failed to refresh payment status from DB for payment_id=%s", payment_id)
-        return payment_entry.get("status")
+        return None
+
+
+def refresh_payment_status_from_db(payment_entry, user_id: int = None):
+    """Обновляет статус выплаты из базы данных и возвращает актуальное значение."""
+    _fetch_payment_row(payment_entry, user_id)
+    return payment_entry.get("status")
+
+
+def payment_body_text(payment_entry) -> str:
+    """Текст выплаты, отрендеренный на месте (куратор / репетитор)."""
+    data = payment_entry.get("data", {})
+    if data.get("is_repet"):
+        return format_repet_payment_text(data)
+    return format_payment_text(data)
+
+
+def load_payment_view(payment_entry, user_id: int = None):
+    """Статус и текст выплаты для открытия ведомости одной выборкой по id.
+
+    Текст берётся из rendered_text, если TG бот отрендерил его текущей версией шаблона,
+    иначе рендерится на месте. Возвращает (status, text).
+    """
+    row = _fetch_payment_row(payment_entry, user_id, "status, rendered_text, render_version")
+    if row and row[1] and row[2] == payment_render.TEMPLATE_VERSION:
+        return payment_entry.get("status"), row[1]
+    return payment_entry.get("status"), payment_body_text(payment_entry)
 
 def format_message(file_name, uid, course_type, deadline):
     csv_path = _find_curator_csv(file_name, uid)
     if not csv_path:
         raise FileNotFoundError("CSV for curator not found")
-    try:
-        df = pd.read_csv(csv_path, dtype=str)
-    except Exception:
-        df = pd.read_csv(csv_path, encoding='cp1251', dtype=str)
-    if df is None or df.empty:
+    rows = read_csv_rows(csv_path)
+    if not rows:
         raise ValueError("CSV is empty")
-    if 'vk_id' not in df.columns:
+    if 'vk_id' not in rows[0]:
         raise ValueError("CSV missing vk_id column")
     uid_str = str(uid).strip()
-    vk_series = df['vk_id'].fillna('').astype(str).apply(_extract_numeric_vk)
-    row = df[vk_series == uid_str]
-    if row.empty:
+    row = next((r for r in rows if _extract_numeric_vk(r['vk_id'] or '') == uid_str), None)
+    if row is None:
         raise ValueError("Curator vk_id not found in CSV")
-    p = row.fillna('0').iloc[0]
+    p = _fill_missing(row, '0')
 
     base = (f"=== Согласование выплаты ==="
             f"\nКурс: {course_type}"
@@ -2555,122 +2861,149 @@ def format_message(file_name, uid, course_type, deadline):
     console = p.get('console', '')
     return (msg, phone, console)
 
+def new_payment_record(payment_data) -> PaymentRecord:
+    """Создаёт запись новой выплаты с новым payment_id (в память не добавляет)."""
+    if not isinstance(payment_data, PaymentData):
+        payment_data = PaymentData(payment_data)
+    return PaymentRecord(id=str(uuid.uuid4()), data=payment_data, created_at=time.time(), status="new")
+
+
 def add_payment_for_user(user_id: int, payment_data: dict) -> str:
     """Добавляет выплату в память и возвращает payment_id"""
-    pid = str(uuid.uuid4())
-    entry = {"id": pid, "data": payment_data, "created_at": time.time(), "status": "new"}
-    with user_payments_lock:
-        user_payments.setdefault(user_id, []).append(entry)
-    log.info("Добавлена выплата %s для user %s (fio=%s file=%s)", pid, user_id, payment_data.get('fio',''), payment_data.get('original_filename',''))
-    return pid
+    entry = new_payment_record(payment_data)
+    user_payments.append(user_id, entry)
+    log.info("Добавлена выплата %s для user %s (fio=%s file=%s)", entry["id"], user_id, entry.data.get('fio',''), entry.data.get('original_filename',''))
+    return entry["id"]
 
 
 def get_payments_for_user(user_id: int):
     with user_payments_lock:
-        return user_payments.get(user_id, []).copy()  # Возвращаем копию для безопасности
+        return list(user_payments.get(user_id, []))  # Возвращаем копию для безопасности
 
 
-def get_all_payments_for_user_from_db(user_id: int, limit: int = 100):
-    """Загружает ВСЕ ведомости пользователя из базы данных, не только те что в памяти.
-    Возвращает список в том же формате что и get_payments_for_user."""
+def _read_vedomosti_version():
+    """Счётчик изменений vedomosti_users (см. migrations.py); None - прочитать не удалось."""
     if not os.path.exists(DB_PATH):
-        log.warning("DB file not found: %s", DB_PATH)
+        return None
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            return migrations.read_vedomosti_version(conn)
+        finally:
+            conn.close()
+    except Exception:
+        log.exception("Failed to read vedomosti change counter")
+        return None
+
+
+def get_payment_summaries_for_user(user_id: int, limit: int = 100, before=None, offset: int = 0):
+    """Список выплат пользователя для кнопок; повторная навигация обслуживается payment_list_cache."""
+    before = tuple(before) if before is not None else None
+    payment_list_cache.sync(_read_vedomosti_version())
+    cached = payment_list_cache.get(user_id, limit, before, offset)
+    if cached is not None:
+        return cached
+    token = payment_list_cache.token()
+    payments = _load_payment_summaries(user_id, limit, before, offset)
+    if payments is None:
         return []
-    
+    payment_list_cache.put(user_id, limit, before, offset, payments, token)
+    return payments
+
+
+def _load_payment_summaries(user_id: int, limit: int, before=None, offset: int = 0):
+    """Список выплат пользователя из БД: одна выборка по индексу, без чтения файлов.
+
+    Возвращает PaymentRecord (новые сначала) с краткими данными: original_filename, groups,
+    fio, total, is_repet. Полные данные выплаты загружаются через find_payment при открытии.
+    Строки без заполненных столбцов (импортированные до их появления) один раз дочитываются
+    из персонального файла, и результат записывается обратно в БД.
+    before=(created_at, db_id) - курсор: вернуть выплаты строго старше него (см. migrations.select_payment_page).
+    None - БД недоступна (такой результат не кэшируется).
+    """
+    if not os.path.exists(DB_PATH):
+        log.warning("DB file not found: %s", DB_PATH)
+        return None
     try:
         conn = sqlite3.connect(DB_PATH, timeout=30)
-        c = conn.cursor()
-        # Получаем все ведомости пользователя, отсортированные по времени создания (новые сначала)
-        c.execute("""
-            SELECT id, vk_id, personal_path, original_filename, state, status, disagree_reason, confirmed_at, created_at 
-            FROM vedomosti_users 
-            WHERE vk_id = ?
-              AND (state LIKE 'imported:%' OR state LIKE 'repet_imported:%')
-            ORDER BY created_at DESC, id DESC
-            LIMIT ?
-        """, (str(user_id), limit))
-        rows = c.fetchall()
+        rows = migrations.select_payment_page(
+            conn, user_id,
+            """id, payment_uuid, state_kind, original_filename, personal_path, status, disagree_reason,
+               COALESCE(created_at, 0), fio, groups, total, is_repet""",
+            limit, before, offset)
         conn.close()
-        
-        payments = []
-        for db_row in rows:
-            try:
-                db_id, vk_id_raw, personal_path, original_filename, state, status_db, disagree_reason_db, confirmed_at_db, created_at_db = db_row
-                
-                if not state or (not state.startswith('imported:') and not state.startswith('repet_imported:')):
-                    continue
-                
-                # Определяем тип выплаты
-                is_repet = state.startswith('repet_imported:')
-                prefix = 'repet_imported:' if is_repet else 'imported:'
-                
-                parts = state.split(prefix, 1)
-                if len(parts) != 2 or not parts[1]:
-                    continue
-                
-                payment_id = parts[1]
-                
-                # Создаем уникальный payment_id на основе db_id для старых записей с дублирующимися payment_id
-                unique_payment_id = f"{payment_id}_{db_id}" if payment_id else f"payment_{db_id}"
-                
-                # ВСЕГДА загружаем данные из CSV файла для каждой записи БД
-                # Не используем кэш памяти, так как у одного пользователя могут быть разные ведомости
-                row_dict = {}
-                if personal_path and os.path.exists(personal_path):
-                    try:
-                        df = get_cached_csv_data(personal_path)
-                        if isinstance(df, pd.DataFrame) and not df.empty:
-                            row_dict = df.iloc[0].to_dict()
-                        log.debug("Loaded CSV data for payment %s from %s", unique_payment_id, personal_path)
-                    except Exception:
-                        log.warning("Failed to read CSV for payment %s path=%s", unique_payment_id, personal_path)
-                else:
-                    log.warning("Personal path not found for payment %s: %s", unique_payment_id, personal_path)
-                
-                # Для репетиторов используем отдельный маппер
+    except Exception:
+        log.exception("Failed to load payment summaries for user %s from DB", user_id)
+        return None
+
+    payments = []
+    backfill = []
+    for db_row in rows:
+        try:
+            (db_id, payment_id, state_kind, original_filename, personal_path, status_db, disagree_reason_db,
+             created_at_db, fio, groups, total, is_repet) = db_row
+            if not payment_id:
+                continue
+            if fio is None:
+                # Строка из старого импорта: берём краткие данные из персонального файла
+                row_dict = (get_cached_csv_row(personal_path) if personal_path else None) or {}
+                is_repet = state_kind == 'repet_imported'
                 if is_repet:
-                    payment_data = _map_row_to_repet_payment_data(row_dict, user_id, original_filename)
-                    payment_data['is_repet'] = True
+                    full = _map_row_to_repet_payment_data(row_dict, user_id, original_filename)
                 else:
-                    payment_data = _map_row_to_payment_data(row_dict, user_id, original_filename)
-                    payment_data['is_repet'] = False
-                
-                # ВАЖНО: Добавляем personal_path в данные, чтобы форматтер знал источник
-                payment_data['personal_path'] = personal_path
-                
-                entry = {
-                    "id": unique_payment_id,
-                    "data": payment_data,
-                    "created_at": float(created_at_db) if created_at_db else time.time(),
-                    "status": status_db or "new",
-                    "db_id": db_id,  # Сохраняем db_id для отладки
-                    "original_payment_id": payment_id  # Сохраняем исходный payment_id
-                }
-                
-                if disagree_reason_db:
-                    entry["disagree_reason"] = disagree_reason_db
-                    
-                payments.append(entry)
-                    
-            except Exception:
-                log.exception("Error loading payment from DB row %s", db_row)
-        
-        log.info("Loaded %d total payments for user %s from DB (limit=%d)", len(payments), user_id, limit)
-        return payments
-        
-    except Exception:
-        log.exception("Failed to load all payments for user %s from DB", user_id)
-        return []
+                    full = _map_row_to_payment_data(row_dict, user_id, original_filename)
+                fio, groups = full.get('fio', ''), full.get('groups', '')
+                total = total if total is not None else full.get('total_amount')
+                backfill.append((fio, groups, total, int(is_repet), db_id))
+            data = {
+                'original_filename': _intern_value(os.path.basename(original_filename)) if original_filename else '',
+                'groups': _intern_value(groups or ''),
+                'fio': _intern_value(fio or ''),
+                'total_amount': total,
+                'is_repet': bool(is_repet),
+                'personal_path': personal_path,
+            }
+            payments.append(PaymentRecord(
+                id=_payment_record_id(payment_id, db_id),
+                data=PaymentData(data),
+                # Значение из БД как есть: по нему строится курсор кнопки "Ещё"
+                created_at=created_at_db,
+                status=status_db or "new",
+                db_id=db_id,
+                original_payment_id=payment_id,
+                disagree_reason=disagree_reason_db or None,
+            ))
+        except Exception:
+            log.exception("Error building payment summary from DB row %s", db_row)
+
+    if backfill:
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            conn.executemany(SUMMARY_UPDATE_SQL, backfill)
+            conn.commit()
+            conn.close()
+            log.info("Backfilled summary columns for %d vedomosti rows of user %s", len(backfill), user_id)
+        except Exception:
+            log.exception("Failed to backfill summary columns for user %s", user_id)
+    log.debug("Loaded %d payment summaries for user %s (limit=%d)", len(payments), user_id, limit)
+    return payments
 
 
 def find_payment(user_id: int, payment_id: str):
     log.debug("find_payment called: user_id=%s, payment_id=%s", user_id, payment_id)
+    if STARTUP_HYDRATION == 'lazy':
+        hydrate_user_payments(user_id)
     # Сначала ищем в памяти (быстрее и актуальнее)
     with user_payments_lock:
         for p in user_payments.get(user_id, []):
             if p["id"] == payment_id:
                 log.debug("Found payment %s in memory for user %s", payment_id, user_id)
-                return p
+                break
+        else:
+            p = None
+    if p is not None:
+        vk_sessions.apply_flow(user_id, p)
+        return p
     
     # Если не нашли в памяти, ищем в базе данных
     try:
@@ -2695,18 +3028,18 @@ def find_payment(user_id: int, payment_id: str):
                 c.execute("""
                     SELECT id, vk_id, personal_path, original_filename, state, status, disagree_reason, confirmed_at, created_at 
                     FROM vedomosti_users 
-                    WHERE vk_id = ?
-                      AND (state = ? OR state = ?)
-                """, (str(user_id), f"imported:{payment_id}", f"repet_imported:{payment_id}"))
+                    WHERE payment_uuid = ? AND vk_id = ?
+                      AND state_kind IN ('imported', 'repet_imported')
+                """, (payment_id, str(user_id)))
         else:
             # Старый формат payment_id (поддерживаем и imported, и repet_imported)
             c.execute("""
                 SELECT id, vk_id, personal_path, original_filename, state, status, disagree_reason, confirmed_at, created_at 
                 FROM vedomosti_users 
-                WHERE vk_id = ?
-                  AND (state = ? OR state = ?)
+                WHERE payment_uuid = ? AND vk_id = ?
+                  AND state_kind IN ('imported', 'repet_imported')
                 LIMIT 1
-            """, (str(user_id), f"imported:{payment_id}", f"repet_imported:{payment_id}"))
+            """, (payment_id, str(user_id)))
         
         row = c.fetchone()
         conn.close()
@@ -2719,14 +3052,10 @@ def find_payment(user_id: int, payment_id: str):
         db_id, vk_id_raw, personal_path, original_filename, state, status_db, disagree_reason_db, confirmed_at_db, created_at_db = row
         
         # Загружаем данные из CSV файла
-        row_dict = {}
-        if personal_path and os.path.exists(personal_path):
-            try:
-                df = get_cached_csv_data(personal_path)
-                if isinstance(df, pd.DataFrame) and not df.empty:
-                    row_dict = df.iloc[0].to_dict()
-            except Exception:
-                log.warning("Failed to read CSV for find_payment %s path=%s", payment_id, personal_path)
+        row_dict = get_cached_csv_row(personal_path) if personal_path else None
+        if row_dict is None:
+            log.warning("Failed to read CSV for find_payment %s path=%s", payment_id, personal_path)
+            row_dict = {}
         
         # Определяем, является ли выплата репетиторской
         is_repet = False
@@ -2746,20 +3075,19 @@ def find_payment(user_id: int, payment_id: str):
         
         # Используем уникальный payment_id
         original_payment_id = state.split(':', 1)[1] if ':' in state else payment_id
-        unique_payment_id = f"{original_payment_id}_{db_id}"
-        
-        entry = {
-            "id": unique_payment_id,
-            "data": payment_data,
-            "created_at": float(created_at_db) if created_at_db else time.time(),
-            "status": status_db or "new",
-            "db_id": db_id,
-            "original_payment_id": original_payment_id
-        }
+        unique_payment_id = _payment_record_id(original_payment_id, db_id)
         
-        if disagree_reason_db:
-            entry["disagree_reason"] = disagree_reason_db
+        entry = PaymentRecord(
+            id=unique_payment_id,
+            data=payment_data,
+            created_at=float(created_at_db) if created_at_db else time.time(),
+            status=status_db or "new",
+            db_id=db_id,
+            original_payment_id=original_payment_id,
+            disagree_reason=disagree_reason_db or None,
+        )
             
+        vk_sessions.apply_flow(user_id, entry)
         log.info("Found payment %s for user %s in DB", payment_id, user_id)
         return entry
         
@@ -2844,7 +3172,7 @@ def handle_message_event(event):
             is_repet = p.get("data", {}).get('is_repet', False) if p else False
             if choice == "agree":
                 if p:
-                    p["status"] = "agree_pending_verify"
+                    set_payment_flow_status(user_id, p, "agree_pending_verify")
                     data = p.get("data", {})
                     phone = data.get("phone", "-")
                     
@@ -2881,7 +3209,7 @@ def handle_message_event(event):
                 if is_repet:
                     # Для репетиторов сразу фиксируем несогласие и логируем в отдельную таблицу
                     if p:
-                        p["status"] = "disagreed"
+                        set_payment_flow_status(user_id, p, "disagreed")
                     try:
                         update_vedomosti_status_by_payment(payment_id, "disagreed", reason="Данные выплаты")
                     except Exception:
@@ -2895,7 +3223,7 @@ def handle_message_event(event):
                     log.info("User %s disagreed repet payment %s -> logged to repet sheet", user_id, payment_id)
                 else:
                     if p:
-                        p["status"] = "disagree_select_point"
+                        set_payment_flow_status(user_id, p, "disagree_select_point")
                     safe_vk_send(user_id, "С каким пунктом вы не согласны:", payments_disagree_keyboard(payment_id=payment_id))
                     log.info("User %s disagreed payment %s -> asking for point (no persist)", user_id, payment_id)
         elif cmd == "agree_verify":
@@ -2905,11 +3233,11 @@ def handle_message_event(event):
             if not p:
                 return
             if choice == "yes":
-                p["status"] = "agree_pending_pro"
+                set_payment_flow_status(user_id, p, "agree_pending_pro")
                 safe_vk_send(user_id, "Подписан ли у Вас договор в приложении Консоль Про? Краткая справка, как проверить: Консоль Про ->  раздел компании. Если там есть компания ООО '100балльный репетитор', то договор подписан.", yes_no_keyboard("agree_pro", payment_id))
                 log.info("User %s verified data for payment %s", user_id, payment_id)
             else:
-                p["status"] = "agree_data_mismatch"
+                set_payment_flow_status(user_id, p, "agree_data_mismatch")
                 safe_vk_send(user_id, "С Вами свяжется оператор. Пожалуйста, напишите в сообщении ниже корректные данные.")
                 log.info("User %s reported data mismatch for payment %s", user_id, payment_id)
                 p = find_payment(user_id, payment_id)
@@ -2932,7 +3260,7 @@ def handle_message_event(event):
             if not p:
                 return
             if choice == "yes":
-                p["status"] = "agreed"
+                set_payment_flow_status(user_id, p, "agreed")
                 try:
                     update_vedomosti_status_by_payment(payment_id, "agreed")
                 except Exception:
@@ -2940,7 +3268,7 @@ def handle_message_event(event):
                 safe_vk_send(user_id, " Вы согласовали выплату. Спасибо! В течение 10 дней в приложении Консоль Вам придет акт, который необходимо подписать. После этого в течение n количества времени на реквизиты Вашего банковского счета придет выплата.")
                 log.info("User %s agreed payment %s after PRO confirmation", user_id, payment_id)
             else:
-                p["status"] = "agree_pro_pending"
+                set_payment_flow_status(user_id, p, "agree_pro_pending")
                 safe_vk_send(user_id, "Прими приглашение в Консоль ПРО, затем повторно подтвердите выплату.")
                 # Логируем отказ принять приглашение в Консоль ПРО в таблицу, чтобы оператор увидел
                 filename = p.get("data", {}).get("original_filename", "") if p else ""
@@ -2962,7 +3290,7 @@ def handle_message_event(event):
             p = find_payment(user_id, sid)
             if reason == "Иная причина (связаться с оператором)":
                 if p:
-                    p["status"] = "disagreed"
+                    set_payment_flow_status(user_id, p, "disagreed")
                 try:
                     update_vedomosti_status_by_payment(sid, "disagreed", reason=reason)
                 except Exception:
@@ -2983,7 +3311,7 @@ def handle_message_event(event):
                 log.info("User %s chose other reason for %s -> operator handoff", user_id, sid)
                 return
             if p:
-                p["disagree_reason"] = reason
+                set_payment_flow_status(user_id, p, p.get("status"), reason)
             filename = p.get("data", {}).get("original_filename", "") if p else ""
             filepath = f"hosting/open/{filename}" if filename else ""
             is_repet = False
@@ -3025,7 +3353,7 @@ def handle_message_event(event):
                 safe_vk_send(user_id, "С каким пунктом вы не согласны:", payments_disagree_keyboard(payment_id=sid))
                 log.info("User %s decided agree_point for %s -> redirect to general list", user_id, sid)
             elif choice == "disagree_point":
-                p["status"] = "disagreed"
+                set_payment_flow_status(user_id, p, "disagreed")
                 try:
                     update_vedomosti_status_by_payment(sid, "disagreed", reason=reason)
                 except Exception:
@@ -3057,7 +3385,7 @@ def handle_message_event(event):
             if not p:
                 return
             if choice == "yes":
-                p["status"] = "agree_pending_verify"
+                set_payment_flow_status(user_id, p, "agree_pending_verify")
                 data = p.get("data", {})
                 phone = data.get("phone", "-")
                 is_repet = data.get('is_repet', False)
@@ -3100,32 +3428,23 @@ def handle_message_event(event):
             p = find_payment(user_id, sid)
             if p:
                 log.info("User %s trying to open statement %s with status: %s", user_id, sid, p.get("status"))
-                current_status = refresh_payment_status_from_db(p, user_id)
+                current_status, statement_text = load_payment_view(p, user_id)
                 if current_status == "agreed":
                     safe_vk_send(user_id, "Вы уже согласовали ведомость!")
                     log.info("User %s tried to open already confirmed statement %s", user_id, sid)
                     return
                 
-                # Выбираем форматирование в зависимости от типа выплаты (куратор / репетитор)
-                if p.get("data", {}).get("is_repet"):
-                    body = format_repet_payment_text(p["data"])
-                else:
-                    body = format_payment_text(p["data"])
-                statement_text = body
                 safe_vk_send(user_id, statement_text, inline_confirm_keyboard(payment_id=sid))
-                user_last_opened_payment[user_id] = sid  # Запоминаем последнюю открытую выплату
+                vk_sessions.set_last_opened(user_id, sid)  # Запоминаем последнюю открытую выплату
                 log.info("User %s opened statement %s (unique_payment_id=%s)", user_id, sid, sid)
             else:
                 safe_vk_send(user_id, "Ведомость не найдена (возможно устарела).")
         elif cmd == "to_list":
-            payments = get_all_payments_for_user_from_db(user_id)
-            send_payments_list_multiple(user_id, payments, page=0)
+            send_payments_list(user_id)
             log.info("Sent payments list to %s", user_id)
             return
         elif cmd == "payments_page":
-            page = int(payload.get("page", 0))
-            payments = get_all_payments_for_user_from_db(user_id)
-            send_payments_list_multiple(user_id, payments, page=page)
+            send_payments_list(user_id, payload)
             return
         else:
             safe_vk_send(user_id, f"Нажата inline-кнопка. Payload: {json.dumps(payload, ensure_ascii=False)}")
@@ -3145,7 +3464,7 @@ def handle_message_new(event):
         log.info("MESSAGE_NEW from=%s text=%s payload=%s", from_id, text, bool(payload_str))
         if text in ("Согласен с выплатой", "Не согласен с выплатой"):
             # Используем последнюю открытую выплату
-            last_payment_id = user_last_opened_payment.get(from_id)
+            last_payment_id = vk_sessions.last_opened(from_id)
             log.info("User %s using button agreement, last_payment_id=%s", from_id, last_payment_id)
             if not last_payment_id:
                 safe_vk_send(from_id, "Сначала откройте ведомость из списка выплат.")
@@ -3161,7 +3480,7 @@ def handle_message_new(event):
             pid = p["id"]
             is_repet = p.get("data", {}).get('is_repet', False)
             if text == "Согласен с выплатой":
-                p["status"] = "agree_pending_verify"
+                set_payment_flow_status(from_id, p, "agree_pending_verify")
                 data = p.get("data", {})
                 phone = data.get("phone", "-")
                 if phone != "-":
@@ -3194,7 +3513,7 @@ def handle_message_new(event):
             else:
                 if is_repet:
                     # Для репетиторов сразу фиксируем несогласие и логируем в отдельную таблицу
-                    p["status"] = "disagreed"
+                    set_payment_flow_status(from_id, p, "disagreed")
                     try:
                         update_vedomosti_status_by_payment(pid, "disagreed", reason="Данные выплаты")
                     except Exception:
@@ -3207,7 +3526,7 @@ def handle_message_new(event):
                     safe_vk_send(from_id, "В сообщении ниже опишите причину несогласия. В течение n количества времени с Вами свяжется оператор.")
                     log.info("User %s disagreed repet payment %s via text-button -> logged to repet sheet", from_id, pid)
                 else:
-                    p["status"] = "disagree_select_point"
+                    set_payment_flow_status(from_id, p, "disagree_select_point")
                     safe_vk_send(from_id, "С каким пунктом вы не согласны:", payments_disagree_keyboard(payment_id=pid))
                     log.info("User %s disagreed payment %s via text-button -> asking for point (no persist)", from_id, pid)
                     return
@@ -3222,7 +3541,7 @@ def handle_message_new(event):
                 p = find_payment(from_id, sid)
                 if p:
                     log.info("User %s trying to open statement %s via payload with status: %s", from_id, sid, p.get("status"))
-                    current_status = refresh_payment_status_from_db(p, from_id)
+                    current_status, statement_text = load_payment_view(p, from_id)
                     if current_status == "agreed":
                         vk.messages.send(
                             user_id=from_id,
@@ -3232,18 +3551,13 @@ def handle_message_new(event):
                         log.info("User %s tried to open already confirmed statement %s via payload", from_id, sid)
                         return
                     
-                    if p.get("data", {}).get("is_repet"):
-                        body = format_repet_payment_text(p["data"])
-                    else:
-                        body = format_payment_text(p["data"])
-                    statement_text = body
                     vk.messages.send(
                         user_id=from_id,
                         random_id=vk_api.utils.get_random_id(),
                         message=statement_text,
                         keyboard=inline_confirm_keyboard(payment_id=sid)
                     )
-                    user_last_opened_payment[from_id] = sid  # Запоминаем последнюю открытую выплату
+                    vk_sessions.set_last_opened(from_id, sid)  # Запоминаем последнюю открытую выплату
                     log.info("User %s opened statement %s via payload (unique_payment_id=%s)", from_id, sid, sid)
                     return
                 else:
@@ -3259,7 +3573,7 @@ def handle_message_new(event):
                 p = find_payment(from_id, sid)
                 if reason == "Иная причина (связаться с оператором)":
                     if p:
-                        p["status"] = "disagreed"
+                        set_payment_flow_status(from_id, p, "disagreed")
                     try:
                         update_vedomosti_status_by_payment(sid, "disagreed", reason=reason)
                     except Exception:
@@ -3279,7 +3593,7 @@ def handle_message_new(event):
                     )
                     return
                 if p:
-                    p["disagree_reason"] = reason
+                    set_payment_flow_status(from_id, p, p.get("status"), reason)
                 conflict_type = map_reason_to_type(reason)
                 if conflict_type:
                     file_base = None
@@ -3322,7 +3636,7 @@ def handle_message_new(event):
                         keyboard=payments_disagree_keyboard(payment_id=sid)
                     )
                 elif choice == "disagree_point":
-                    p["status"] = "disagreed"
+                    set_payment_flow_status(from_id, p, "disagreed")
                     try:
                         update_vedomosti_status_by_payment(sid, "disagreed", reason=reason)
                     except Exception:
@@ -3363,7 +3677,7 @@ def handle_message_new(event):
                 if not p:
                     return
                 if choice == "yes":
-                    p["status"] = "agree_pending_verify"
+                    set_payment_flow_status(from_id, p, "agree_pending_verify")
                     data = p.get("data", {})
                     phone = data.get("phone", "-")
                     is_repet = data.get('is_repet', False)
@@ -3411,33 +3725,11 @@ def handle_message_new(event):
                     )
                 return
             if cmd == "to_list":
-                payments = get_all_payments_for_user_from_db(from_id)
-                if not payments:
-                    vk.messages.send(
-                        user_id=from_id,
-                        random_id=vk_api.utils.get_random_id(),
-                        message="У Вас нет выплат.",
-                        keyboard=chat_bottom_keyboard()
-                    )
-                    return
-                statements = []
-                for idx, p in enumerate(payments, start=1):
-                    label = _format_payment_label(
-                        p["data"].get('original_filename'), 
-                        idx,
-                        30,
-                        p.get("created_at"),
-                        p.get("db_id"),
-                        p.get("data", {}).get("groups")  # Передаем информацию о группах
-                    )
-                    statements.append((p["id"], label))
-                send_payments_list_multiple(from_id, payments, page=0, use_vk_direct=True)
+                send_payments_list(from_id, use_vk_direct=True)
                 log.info("Sent payments list to %s", from_id)
                 return
             if cmd == "payments_page":
-                page = int(payload.get("page", 0))
-                payments = get_all_payments_for_user_from_db(from_id)
-                send_payments_list_multiple(from_id, payments, page=page, use_vk_direct=True)
+                send_payments_list(from_id, payload, use_vk_direct=True)
                 return
             if cmd == "agree_verify":
                 sid = payload.get("payment_id")
@@ -3446,7 +3738,7 @@ def handle_message_new(event):
                 if not p:
                     return
                 if choice == "yes":
-                    p["status"] = "agree_pending_pro"
+                    set_payment_flow_status(from_id, p, "agree_pending_pro")
                     vk.messages.send(
                         user_id=from_id,
                         random_id=vk_api.utils.get_random_id(),
@@ -3454,7 +3746,7 @@ def handle_message_new(event):
                         keyboard=yes_no_keyboard("agree_pro", sid)
                     )
                 else:
-                    p["status"] = "agree_data_mismatch"
+                    set_payment_flow_status(from_id, p, "agree_data_mismatch")
                     vk.messages.send(
                         user_id=from_id,
                         random_id=vk_api.utils.get_random_id(),
@@ -3476,7 +3768,7 @@ def handle_message_new(event):
                 if not p:
                     return
                 if choice == "yes":
-                    p["status"] = "agreed"
+                    set_payment_flow_status(from_id, p, "agreed")
                     try:
                         update_vedomosti_status_by_payment(sid, "agreed")
                     except Exception:
@@ -3487,7 +3779,7 @@ def handle_message_new(event):
                         message=" Вы согласовали выплату. Спасибо! В течение 10 дней в приложении Консоль Вам придет акт, который необходимо подписать. После этого в течение n количества времени на реквизиты Вашего банковского счета придет выплата."
                     )
                 else:
-                    p["status"] = "agree_pro_pending"
+                    set_payment_flow_status(from_id, p, "agree_pro_pending")
                     vk.messages.send(
                         user_id=from_id,
                         random_id=vk_api.utils.get_random_id(),
@@ -3504,30 +3796,19 @@ def handle_message_new(event):
                         log_complaint_to_sheet(from_id, "Не подписал договор", filename, filepath)
                 return
         if text.lower() == "к списку выплат" or text == "К списку выплат":
-            payments = get_all_payments_for_user_from_db(from_id)
-            if not payments:
-                vk.messages.send(
-                    user_id=from_id,
-                    random_id=vk_api.utils.get_random_id(),
-                    message="У Вас нет выплат.",
-                    keyboard=chat_bottom_keyboard()
-                )
-                return
-            statements = []
-            for idx, p in enumerate(payments, start=1):
-                label = _format_payment_label(p["data"].get('original_filename'), idx)
-                statements.append((p["id"], label))
-            send_payments_list_multiple(from_id, payments, page=0, use_vk_direct=True)
+            send_payments_list(from_id, use_vk_direct=True)
             log.info("Sent payments list to %s", from_id)
             return
         m = re.match(r"^\s*Ведомость\s+(\d+)\s*$", text, flags=re.IGNORECASE)
         if m:
             idx = int(m.group(1)) - 1
-            payments = get_all_payments_for_user_from_db(from_id)
-            if 0 <= idx < len(payments):
-                p = payments[idx]
+            # Читаем только нужную позицию списка, а не всю историю
+            payments = get_payment_summaries_for_user(from_id, limit=1, offset=idx) if idx >= 0 else []
+            if payments:
+                # В списке только краткие данные; полная выплата читается при открытии
+                p = find_payment(from_id, payments[0]["id"]) or payments[0]
                 log.info("User %s trying to open statement %s by text with status: %s", from_id, p["id"], p.get("status"))
-                current_status = refresh_payment_status_from_db(p, from_id)
+                current_status, statement_text = load_payment_view(p, from_id)
                 if current_status == "agreed":
                     vk.messages.send(
                         user_id=from_id,
@@ -3536,17 +3817,12 @@ def handle_message_new(event):
                     )
                     log.info("User %s tried to open already confirmed statement %s by text", from_id, p["id"])
                     return
-                if p.get("data", {}).get("is_repet"):
-                    body = format_repet_payment_text(p["data"])
-                else:
-                    body = format_payment_text(p["data"])
-                statement_text = body
                 vk.messages.send(
                     user_id=from_id,
                     random_id=vk_api.utils.get_random_id(),
                     message=statement_text,
                     keyboard=inline_confirm_keyboard(payment_id=p["id"]) )
-                user_last_opened_payment[from_id] = p["id"]  # Запоминаем последнюю открытую выплату
+                vk_sessions.set_last_opened(from_id, p["id"])  # Запоминаем последнюю открытую выплату
                 log.info("User %s opened statement %s by text click", from_id, p["id"]) 
                 return
             else:
@@ -3569,16 +3845,22 @@ def handle_message_new(event):
 
 def main_loop():
     log.info("Бот запущен. Ожидание событий...")
-    ensure_vedomosti_status_columns()
-    ensure_unique_import_states()
-    ensure_db_indexes()  # Создаем индексы для оптимизации
-    try:
-        loaded = load_imported_vedomosti_into_memory(send_notifications=False)
-        log.info("Startup: loaded %d existing imported vedomosti into memory", loaded)
-    except Exception:
-        log.exception("Failed during startup loading of imported vedomosti")
+    migrations.apply_migrations(DB_PATH)
+    notification_dispatcher.start()
+    vk_sessions.start()
+    statement_snapshot.check()
+    if STARTUP_HYDRATION == 'eager':
+        try:
+            loaded = load_imported_vedomosti_into_memory(send_notifications=False)
+            log.info("Startup: loaded %d existing imported vedomosti into memory", loaded)
+        except Exception:
+            log.exception("Failed during startup loading of imported vedomosti")
     importer_thread = threading.Thread(target=background_importer, args=(5.0,), daemon=True)
     importer_thread.start()
+    log.info("Startup finished in %.2fs (hydration=%s), listening for events",
+             time.perf_counter() - _PROCESS_STARTED, STARTUP_HYDRATION)
+    global longpoll
+    longpoll = VkBotLongPoll(vk_session, int(GROUP_ID))
     for event in longpoll.listen():
         try:
             if event.type == VkBotEventType.MESSAGE_EVENT:
@@ -3598,3 +3880,5 @@ if __name__ == "__main__":
         log.info("Выключение по Ctrl+C")
     except Exception:
         log.exception("Критическая ошибка")
+    finally:
+        vk_sessions.flush()  # Не теряем сессии, изменённые после последней записи
@@ -0,0 +1,588 @@
+"""Версионированные миграции схемы hosting.db, общие для TG и VK ботов.
+
+Номер последней применённой миграции хранится в PRAGMA user_version, поэтому при
+обычном старте выполняется одно чтение прагмы вместо PRAGMA table_info и полных
+проходов по vedomosti_users. Каждая миграция применяется один раз: версия
+перепроверяется под BEGIN IMMEDIATE, так что боты, стартующие одновременно,
+не выполнят её дважды. Заполнение данных идёт короткими транзакциями по
+диапазонам id, чтобы не держать блокировку записи и не тормозить второй бот.
+"""
+
+import logging
+import sqlite3
+import time
+import uuid
+
+log = logging.getLogger('migrations')
+
+# Сколько строк vedomosti_users обрабатывается в одной транзакции заполнения
+BACKFILL_CHUNK_SIZE = 2000
+# Пауза между порциями: даёт второму боту захватить блокировку записи (busy handler sqlite
+# ждёт с нарастающим интервалом и иначе проигрывает циклу, сразу берущему BEGIN IMMEDIATE)
+BACKFILL_CHUNK_PAUSE = 0.005
+
+# Разбор state ('imported:<uuid>') на state_kind ('imported') и payment_uuid ('<uuid>')
+STATE_SPLIT_BACKFILL_SQL = """
+    UPDATE vedomosti_users SET
+        state_kind = CASE WHEN instr(IFNULL(state, ''), ':') > 0
+                          THEN substr(state, 1, instr(state, ':') - 1)
+                          ELSE IFNULL(state, '') END,
+        payment_uuid = CASE WHEN instr(IFNULL(state, ''), ':') > 0
+                            THEN substr(state, instr(state, ':') + 1)
+                            ELSE NULL END
+    WHERE state_kind IS NULL
+"""
+
+VEDOMOSTI_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_vk_id ON vedomosti_users(vk_id)",
+    "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_state ON vedomosti_users(state)",
+    "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_filename ON vedomosti_users(original_filename)",
+    "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_archive_at ON vedomosti_users(archive_at)",
+    "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_status ON vedomosti_users(status)",
+    "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_created_at ON vedomosti_users(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_confirmed_at ON vedomosti_users(confirmed_at)",
+    "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_vk_kind_created ON vedomosti_users(vk_id, state_kind, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_filename_kind ON vedomosti_users(original_filename, state_kind)",
+    "CREATE INDEX IF NOT EXISTS idx_vedomosti_users_payment_uuid ON vedomosti_users(payment_uuid)",
+]
+
+
+def split_vedomosti_state(state):
+    """Разбивает state на (state_kind, payment_uuid): 'imported:<uuid>' -> ('imported', '<uuid>')."""
+    kind, sep, rest = str(state or '').partition(':')
+    return kind, (rest if sep else None)
+
+
+def select_payment_page(conn, vk_id, columns, limit, before=None, offset=0):
+    """Порция списка импортированных выплат пользователя, новые сначала.
+
+    before=(created_at, id) - курсор: строки строго старше него. created_at NULL у строк
+    старых импортов считается нулём и в условии курсора, и в сортировке, поэтому курсор
+    по значению из БД листает и такие строки; порядок отдаёт индекс idx_vedomosti_users_vk_list.
+    """
+    cursor_sql = ""
+    params = [str(vk_id)]
+    if before is not None:
+        # Отдельное диапазонное условие, чтобы поиск начинался с курсора в индексе
+        cursor_sql = "AND COALESCE(created_at, 0) <= ? AND (COALESCE(created_at, 0) < ? OR id < ?)"
+        params += [before[0], before[0], before[1]]
+    return conn.execute(f"""
+        SELECT {columns}
+        FROM vedomosti_users
+        WHERE vk_id = ?
+          AND state_kind IN ('imported', 'repet_imported')
+          {cursor_sql}
+        ORDER BY COALESCE(created_at, 0) DESC, id DESC
+        LIMIT ? OFFSET ?
+    """, params + [limit, offset]).fetchall()
+
+
+def select_stale_render_files(conn, keep_versions):
+    """Ведомости, в которых есть строки с render_version вне keep_versions (или NULL).
+
+    Условие разбито на диапазоны вокруг keep_versions, чтобы каждая часть искала по
+    индексу idx_vedomosti_users_render_version, а не сканировала таблицу.
+    """
+    kept = sorted(set(keep_versions))
+    ranges = ["render_version IS NULL"]
+    params = []
+    if kept:
+        ranges.append("render_version < ?")
+        params.append(kept[0])
+        for low, high in zip(kept, kept[1:]):
+            ranges.append("render_version > ? AND render_version < ?")
+            params += [low, high]
+        ranges.append("render_version > ?")
+        params.append(kept[-1])
+    else:
+        ranges.append("render_version IS NOT NULL")
+    sql = " UNION ".join(
+        f"SELECT original_filename FROM vedomosti_users WHERE personal_path != '' AND {cond}" for cond in ranges)
+    return [row[0] for row in conn.execute(sql, params)]
+
+
+def reset_session_flows(conn, rows, now):
+    """Сбрасывает шаги согласования VK для строк vedomosti_users, переписанных /update.
+
+    rows - (vk_id, payment_uuid, id) сброшенных строк. Шаги этих выплат удаляются из
+    vk_sessions, а пользователю ставится flow_reset_at = now: VK бот не записывает шаг,
+    выбранный раньше этого момента, даже если он ещё не успел попасть в БД.
+    """
+    flow_ids = []
+    for _, payment_uuid, db_id in rows:
+        if payment_uuid:
+            # VK бот хранит выплату под uuid (полная загрузка) или uuid_id (список)
+            flow_ids += [(payment_uuid,), (f"{payment_uuid}_{db_id}",)]
+    conn.executemany("UPDATE vk_sessions SET flow_payment_id = NULL, flow_status = NULL, flow_reason = NULL "
+                     "WHERE flow_payment_id = ?", flow_ids)
+    conn.executemany("""
+        INSERT INTO vk_sessions(vk_id, flow_reset_at) VALUES (?, ?)
+        ON CONFLICT(vk_id) DO UPDATE SET flow_reset_at = excluded.flow_reset_at
+    """, [(str(vk_id), now) for vk_id in {row[0] for row in rows if row[0]}])
+
+
+def read_vedomosti_version(conn):
+    """Текущее значение счётчика vedomosti_changes (None, если таблицы ещё нет)."""
+    try:
+        row = conn.execute("SELECT version FROM vedomosti_changes WHERE id = 1").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+# Каноническая запись UUID (8-4-4-4-12 шестнадцатеричных цифр) для отсева в SQL
+_HEX = '[0-9a-fA-F]'
+_UUID_GLOB = '-'.join(_HEX * n for n in (8, 4, 4, 4, 12))
+
+
+def _columns(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_columns(conn, table, columns):
+    existing = _columns(conn, table)
+    for name, decl in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def _next_chunk_bound(conn, last_id, chunk_size):
+    """Верхняя граница id для следующего диапазона (last_id, bound] или None, если строк больше нет."""
+    row = conn.execute(
+        "SELECT MAX(id) FROM (SELECT id FROM vedomosti_users WHERE id > ? ORDER BY id LIMIT ?)",
+        (last_id, chunk_size),
+    ).fetchone()
+    return row[0] if row else None
+
+
+# ----------------- migrations -----------------
+
+def _create_vedomosti_users(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS vedomosti_users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            vk_id TEXT,
+            personal_path TEXT,
+            original_filename TEXT,
+            state TEXT DEFAULT ''
+        )
+    ''')
+
+
+def _add_status_columns(conn):
+    _add_columns(conn, 'vedomosti_users', [
+        ('status', "TEXT DEFAULT ''"),
+        ('disagree_reason', "TEXT DEFAULT ''"),
+        ('confirmed_at', "INTEGER"),
+        ('created_at', "INTEGER DEFAULT 0"),
+        ('archive_at', "INTEGER DEFAULT 0"),
+        ('warning_sent', "INTEGER DEFAULT 0"),
+        ('warning_sent_at', "INTEGER DEFAULT 0"),
+    ])
+
+
+def _add_state_split_columns(conn):
+    # state хранит '<kind>:<payment_id>'; части держим в отдельных столбцах для индексных выборок
+    _add_columns(conn, 'vedomosti_users', [
+        ('state_kind', "TEXT"),
+        ('payment_uuid', "TEXT"),
+    ])
+
+
+def _backfill_state_split(conn, last_id, chunk_size):
+    bound = _next_chunk_bound(conn, last_id, chunk_size)
+    if bound is None:
+        return None
+    conn.execute(STATE_SPLIT_BACKFILL_SQL + " AND id > ? AND id <= ?", (last_id, bound))
+    return bound
+
+
+def _unique_import_states(conn, last_id, chunk_size):
+    """Заменяет общие состояния 'imported:<suffix>' и 'repet_imported:<suffix>' на уникальные UUID.
+
+    Если суффикс не UUID (например, имя файла), каждой записи выдаётся свой UUID,
+    чтобы одно состояние не разделялось несколькими пользователями. Строки, уже
+    похожие на UUID по форме, отсеиваются в SQL; в Python проверяются только остальные.
+    """
+    bound = _next_chunk_bound(conn, last_id, chunk_size)
+    if bound is None:
+        return None
+    rows = conn.execute(
+        "SELECT id, state_kind, payment_uuid FROM vedomosti_users WHERE id > ? AND id <= ?"
+        " AND state_kind IN ('imported', 'repet_imported')"
+        " AND NOT (length(payment_uuid) = 36 AND payment_uuid GLOB ?)",
+        (last_id, bound, _UUID_GLOB),
+    ).fetchall()
+    updates = []
+    for db_id, kind, suffix in rows:
+        try:
+            uuid.UUID(str(suffix))
+        except ValueError:
+            new_uuid = str(uuid.uuid4())
+            updates.append((f"{kind}:{new_uuid}", new_uuid, db_id))
+    if updates:
+        conn.executemany("UPDATE vedomosti_users SET state = ?, payment_uuid = ? WHERE id = ?", updates)
+        log.debug("Migrated %d vedomosti states to unique UUID-based values", len(updates))
+    return bound
+
+
+def _add_total_column(conn):
+    # Итоговая сумма строки, разобранная при публикации; NULL - неизвестна (старые строки) или нечисловая
+    _add_columns(conn, 'vedomosti_users', [('total', "REAL")])
+
+
+def _add_summary_columns(conn):
+    # Краткие данные выплаты для списка в VK без чтения персональных файлов; NULL в fio - ещё не заполнено
+    _add_columns(conn, 'vedomosti_users', [
+        ('fio', "TEXT"),
+        ('groups', "TEXT"),
+        ('is_repet', "INTEGER"),
+    ])
+
+
+def _create_list_index(conn):
+    # Список выплат в VK листается по (created_at, id) с курсором: индекс отдаёт строки уже в нужном
+    # порядке, и выборка страницы останавливается на LIMIT без сортировки всей истории пользователя
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vedomosti_users_vk_created ON vedomosti_users(vk_id, created_at)")
+
+
+def _create_tg_state_tables(conn):
+    # Пользователи TG и текущая загрузка админа вместо users.json / current_sheets.json:
+    # каждая запись - upsert одной строки вместо перезаписи всего файла
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tg_users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL DEFAULT '',
+            updated_at INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tg_users_username ON tg_users(username)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tg_current_sheets (
+            user_id INTEGER PRIMARY KEY,
+            file_path TEXT NOT NULL DEFAULT '',
+            awaiting_meta INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER
+        )
+    """)
+    # Отметка однократного переноса JSON хранится здесь же
+    _ensure_checkpoints_table(conn)
+
+
+def _create_statements_registry(conn):
+    # Реестр опубликованных ведомостей: имя файла, папка и нормализованное имя для поиска по названию
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS statements (
+            id INTEGER PRIMARY KEY,
+            filename TEXT NOT NULL UNIQUE,
+            normalized_name TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            location TEXT NOT NULL DEFAULT 'open',
+            updated_at INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_statements_location_name ON statements(location, normalized_name)")
+    # Триграммный индекс для поиска подстроки; без FTS5/trigram (SQLite < 3.34) поиск идёт перебором реестра
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS statements_fts
+            USING fts5(normalized_name, content='statements', content_rowid='id', tokenize='trigram')
+        """)
+    except sqlite3.OperationalError:
+        log.warning("FTS5 trigram tokenizer is unavailable, statement search will scan the registry")
+        return
+    _create_statements_fts_triggers(conn)
+
+
+def _create_statements_fts_triggers(conn):
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS statements_fts_ai AFTER INSERT ON statements BEGIN
+            INSERT INTO statements_fts(rowid, normalized_name) VALUES (new.id, new.normalized_name);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS statements_fts_ad AFTER DELETE ON statements BEGIN
+            INSERT INTO statements_fts(statements_fts, rowid, normalized_name) VALUES ('delete', old.id, old.normalized_name);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS statements_fts_au AFTER UPDATE OF normalized_name ON statements BEGIN
+            INSERT INTO statements_fts(statements_fts, rowid, normalized_name) VALUES ('delete', old.id, old.normalized_name);
+            INSERT INTO statements_fts(rowid, normalized_name) VALUES (new.id, new.normalized_name);
+        END
+    """)
+
+
+def _statements_registry_by_folder(conn):
+    # Одно имя может быть сразу у открытой ведомости и у её архивных копий: запись реестра
+    # определяет папка (для архива - путь к контейнеру), а не имя файла. Таблица пересоздаётся
+    # с теми же id, поэтому содержимое statements_fts остаётся верным
+    conn.execute("""
+        CREATE TABLE statements_by_folder (
+            id INTEGER PRIMARY KEY,
+            filename TEXT NOT NULL,
+            normalized_name TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            location TEXT NOT NULL DEFAULT 'open',
+            updated_at INTEGER,
+            UNIQUE (folder, filename)
+        )
+    """)
+    conn.execute("""
+        INSERT INTO statements_by_folder(id, filename, normalized_name, folder, location, updated_at)
+        SELECT id, filename, normalized_name, folder, location, updated_at FROM statements
+    """)
+    conn.execute("DROP TABLE statements")
+    conn.execute("ALTER TABLE statements_by_folder RENAME TO statements")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_statements_location_name ON statements(location, normalized_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_statements_filename ON statements(filename)")
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'statements_fts'").fetchone():
+        _create_statements_fts_triggers(conn)
+
+
+def _add_rendered_text_columns(conn):
+    # Текст сообщения о выплате, отрендеренный TG ботом при публикации (см. payment_render.py)
+    _add_columns(conn, 'vedomosti_users', [
+        ('rendered_text', "TEXT"),
+        ('render_version', "INTEGER"),
+    ])
+
+
+def _create_vk_sessions(conn):
+    # Состояние диалога VK бота (последняя открытая выплата и незавершённый шаг согласования),
+    # чтобы перезапуск бота не обрывал начатое согласование
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS vk_sessions (
+            vk_id TEXT PRIMARY KEY,
+            last_payment_id TEXT,
+            flow_payment_id TEXT,
+            flow_status TEXT,
+            flow_reason TEXT,
+            updated_at REAL
+        )
+    """)
+
+
+def _drop_redundant_indexes(conn):
+    # (vk_id, state_kind, created_at) не даёт порядка (created_at, id) для списка выплат и выборок
+    # hydrate: их обслуживает idx_vedomosti_users_vk_created, а этот индекс только замедлял вставки
+    conn.execute("DROP INDEX IF EXISTS idx_vedomosti_users_vk_kind_created")
+
+
+def _create_list_cursor_index(conn):
+    # Список выплат сортируется по COALESCE(created_at, 0): индекс по тому же выражению отдаёт
+    # строки в этом порядке, и курсор работает и для строк с created_at NULL
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_vedomosti_users_vk_list
+        ON vedomosti_users(vk_id, COALESCE(created_at, 0))
+    """)
+
+
+def _create_vedomosti_changes(conn):
+    # Счётчик изменений vedomosti_users, видимых в списке выплат VK. Триггеры увеличивают его
+    # при любой записи (в том числе из TG бота), и VK бот по одному чтению строки узнаёт,
+    # что закэшированные порции списка устарели
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS vedomosti_changes (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO vedomosti_changes(id, version) VALUES (1, 0)")
+    bump = "UPDATE vedomosti_changes SET version = version + 1 WHERE id = 1;"
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS vedomosti_changes_ai AFTER INSERT ON vedomosti_users BEGIN {bump} END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS vedomosti_changes_ad AFTER DELETE ON vedomosti_users BEGIN {bump} END
+    """)
+    # Только столбцы, которые показывает список: rendered_text, warning_sent и т.п. кэш не сбрасывают
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS vedomosti_changes_au
+        AFTER UPDATE OF vk_id, original_filename, state, status, disagree_reason, created_at, fio, groups, total, is_repet
+        ON vedomosti_users BEGIN {bump} END
+    """)
+
+
+def _create_render_version_index(conn):
+    # Поиск строк без текста текущей версии шаблона (prerender_stale_texts) идёт по этому
+    # индексу: почти все строки имеют текущую версию, и полный обход таблицы не нужен
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_vedomosti_users_render_version
+        ON vedomosti_users(render_version, original_filename) WHERE personal_path != ''
+    """)
+
+
+def _create_vk_sessions_flow_index(conn):
+    # TG бот при /update сбрасывает шаги согласования переписанных строк по flow_payment_id
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vk_sessions_flow_payment ON vk_sessions(flow_payment_id)")
+
+
+def _add_session_flow_reset_column(conn):
+    # Момент последнего сброса шагов пользователя из TG (/update): более ранний шаг VK бот не пишет
+    _add_columns(conn, 'vk_sessions', [('flow_reset_at', "REAL")])
+
+
+def _drop_prefix_duplicate_indexes(conn):
+    # (vk_id) и (vk_id, created_at) - префиксы idx_vedomosti_users_vk_list (vk_id, COALESCE(created_at, 0)):
+    # выборки по пользователю идут по нему, а эти индексы только добавляли запись на каждую вставку
+    conn.execute("DROP INDEX IF EXISTS idx_vedomosti_users_vk_created")
+    conn.execute("DROP INDEX IF EXISTS idx_vedomosti_users_vk_id")
+
+
+def _create_indexes(conn):
+    for index_sql in VEDOMOSTI_INDEXES:
+        conn.execute(index_sql)
+
+
+# (версия, имя, функция, порционная ли миграция). Новые миграции только дописываются в конец.
+# Порционная функция принимает (conn, last_id, chunk_size) и возвращает новый last_id или None по окончании.
+MIGRATIONS = [
+    (1, 'create_vedomosti_users', _create_vedomosti_users, False),
+    (2, 'vedomosti_status_columns', _add_status_columns, False),
+    (3, 'state_split_columns', _add_state_split_columns, False),
+    (4, 'backfill_state_split', _backfill_state_split, True),
+    (5, 'unique_import_states', _unique_import_states, True),
+    (6, 'vedomosti_indexes', _create_indexes, False),
+    (7, 'vedomosti_total_column', _add_total_column, False),
+    (8, 'vedomosti_summary_columns', _add_summary_columns, False),
+    (9, 'vedomosti_list_index', _create_list_index, False),
+    (10, 'tg_state_tables', _create_tg_state_tables, False),
+    (11, 'statements_registry', _create_statements_registry, False),
+    (12, 'rendered_payment_text', _add_rendered_text_columns, False),
+    (13, 'vk_sessions', _create_vk_sessions, False),
+    (14, 'drop_redundant_indexes', _drop_redundant_indexes, False),
+    (15, 'vedomosti_list_cursor_index', _create_list_cursor_index, False),
+    (16, 'vedomosti_changes', _create_vedomosti_changes, False),
+    (17, 'statements_registry_by_folder', _statements_registry_by_folder, False),
+    (18, 'vedomosti_render_version_index', _create_render_version_index, False),
+    (19, 'vk_sessions_flow_index', _create_vk_sessions_flow_index, False),
+    (20, 'vk_sessions_flow_reset', _add_session_flow_reset_column, False),
+    (21, 'drop_prefix_duplicate_indexes', _drop_prefix_duplicate_indexes, False),
+    # Повтор 5-й для баз, прошедших её, пока она пропускала repet_imported; UUID-строки не трогает
+    (22, 'unique_repet_import_states', _unique_import_states, True),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def ensure_archive_schema(conn, schema='archive'):
+    """Создаёт или дополняет холодный архив vedomosti_users в присоединённой БД schema.
+
+    Таблица архива повторяет столбцы основной (новые столбцы добавляются по мере появления)
+    плюс archived_at; id остаётся первичным ключом, поэтому повторный перенос тех же строк
+    не создаёт дублей. Возвращает список столбцов основной таблицы.
+    """
+    main_columns = [(r[1], r[2]) for r in conn.execute("PRAGMA main.table_info(vedomosti_users)")]
+    existing = {r[1] for r in conn.execute(f"PRAGMA {schema}.table_info(vedomosti_users)")}
+    if not existing:
+        decls = ['id INTEGER PRIMARY KEY'] + [f"{name} {decl}" for name, decl in main_columns if name != 'id']
+        conn.execute(f"CREATE TABLE {schema}.vedomosti_users ({', '.join(decls + ['archived_at INTEGER'])})")
+    else:
+        for name, decl in main_columns:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {schema}.vedomosti_users ADD COLUMN {name} {decl}")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_archive_vk_created ON vedomosti_users(vk_id, created_at)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_archive_filename ON vedomosti_users(original_filename)")
+    return [name for name, _ in main_columns]
+
+
+def _user_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _ensure_checkpoints_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS migration_checkpoints (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0,
+            completed_at INTEGER,
+            updated_at INTEGER
+        )
+    """)
+
+
+def _run_chunked(conn, version, name, func, chunk_size):
+    """Выполняет порционную миграцию: каждая порция - отдельная транзакция BEGIN IMMEDIATE.
+
+    Граница обработанных id сохраняется в migration_checkpoints в той же транзакции,
+    что и порция, поэтому после прерывания миграция продолжается с места остановки,
+    а после отметки completed_at не выполняется совсем. Обрабатываются строки, существовавшие
+    на момент запуска: новые вставляются уже актуальным кодом, а погоня за хвостом таблицы,
+    в которую пишет второй бот, могла бы не закончиться.
+    """
+    _ensure_checkpoints_table(conn)
+    chunks = 0
+    stop_id = None
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if _user_version(conn) >= version:
+                conn.execute("COMMIT")
+                return chunks
+            row = conn.execute(
+                "SELECT last_id, completed_at FROM migration_checkpoints WHERE name = ?", (name,)
+            ).fetchone()
+            last_id, completed_at = row if row else (0, None)
+            if completed_at:
+                conn.execute("COMMIT")
+                return chunks
+            if stop_id is None:
+                stop_id = conn.execute("SELECT IFNULL(MAX(id), 0) FROM vedomosti_users").fetchone()[0]
+                if last_id:
+                    log.info("Resuming migration %s from id %d", name, last_id)
+            next_id = func(conn, last_id, chunk_size) if last_id < stop_id else None
+            now = int(time.time())
+            conn.execute(
+                "INSERT OR REPLACE INTO migration_checkpoints(name, last_id, completed_at, updated_at) VALUES (?,?,?,?)",
+                (name, last_id if next_id is None else next_id, now if next_id is None else None, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if next_id is None:
+            return chunks
+        chunks += 1
+        time.sleep(BACKFILL_CHUNK_PAUSE)
+
+
+def apply_migrations(db_path, chunk_size=BACKFILL_CHUNK_SIZE):
+    """Применяет недостающие миграции к db_path и возвращает итоговую версию схемы.
+
+    Ошибка миграции пишется в лог и пробрасывается: бот не должен работать на схеме,
+    мигрированной наполовину. Уже применённые миграции остаются, повторный запуск
+    продолжит с упавшей.
+    """
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    version = 0
+    try:
+        version = _user_version(conn)
+        if version >= SCHEMA_VERSION:
+            return version
+        conn.execute("PRAGMA journal_mode=WAL")
+        for mig_version, name, func, chunked in MIGRATIONS:
+            if mig_version <= version:
+                continue
+            started = time.perf_counter()
+            chunks = _run_chunked(conn, mig_version, name, func, chunk_size) if chunked else 0
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Второй бот мог применить эту миграцию, пока мы ждали блокировку
+                if _user_version(conn) < mig_version:
+                    if not chunked:
+                        func(conn)
+                    conn.execute(f"PRAGMA user_version = {int(mig_version)}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            version = mig_version
+            log.info("Applied migration %d %s (%d chunks) in %.3fs",
+                     mig_version, name, chunks, time.perf_counter() - started)
+        return version
+    except Exception:
+        log.exception("Failed to apply DB migrations at version %s (%s)", version, db_path)
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,532 @@
+"""Тексты сообщений о выплате, общие для TG и VK ботов.
+
+TG бот рендерит тексты при публикации и обновлении ведомости и сохраняет их в
+vedomosti_users.rendered_text вместе с render_version. VK бот отправляет сохранённый
+текст, если его версия совпадает с TEMPLATE_VERSION, иначе рендерит заново теми же
+функциями. Любое изменение текста шаблонов ниже требует увеличить TEMPLATE_VERSION,
+иначе куратор увидит текст старого шаблона.
+"""
+
+import re
+import string
+
+# Версия шаблонов render_payment_text / render_repet_payment_text
+TEMPLATE_VERSION = 1
+# render_version строк, которые не удалось отрендерить текущей версией шаблона (нет файла,
+# пустой файл, ошибка шаблона). Такие строки не перебираются повторно, пока файл не
+# перепишут (/update сбрасывает render_version) или не сменится TEMPLATE_VERSION
+RENDER_FAILED_VERSION = -TEMPLATE_VERSION
+
+
+def fill_missing(row: dict, fill: str) -> dict:
+    """Аналог fillna(): None -> fill."""
+    return {key: fill if value is None else value for key, value in row.items()}
+
+
+def to_int_safe(value) -> int:
+    try:
+        if value is None:
+            return 0
+        s = str(value).replace('\u00A0', '').replace('\xa0', '').replace(' ', '').replace(',', '.')
+        if s == '' or s.lower() == 'nan':
+            return 0
+        return int(float(s))
+    except Exception:
+        return 0
+
+
+def to_float_safe(value) -> float:
+    try:
+        if value is None:
+            return 0.0
+        s = str(value).replace('\u00A0', '').replace('\xa0', '').replace(' ', '').replace(',', '.')
+        if s == '' or s.lower() == 'nan':
+            return 0.0
+        return float(s)
+    except Exception:
+        return 0.0
+
+
+def parse_amount(value):
+    """Итоговая сумма строки ведомости для обоих ботов: пусто -> 0.0, нечисловое -> None (не ноль).
+
+    Пробелы и неразрывные пробелы (разделители тысяч) отбрасываются, запятая - десятичный разделитель.
+    """
+    if value is None:
+        return 0.0
+    s = str(value).replace('\u00A0', '').replace(' ', '').replace(',', '.')
+    if s == '' or s.lower() == 'nan':
+        return 0.0
+    try:
+        amount = float(s)
+    except ValueError:
+        return None
+    return 0.0 if amount == 0 else amount
+
+
+def to_float_str_money(value) -> str:
+    try:
+        if value is None:
+            return '0'
+        s = str(value).replace('\u00A0', '').replace('\xa0', '').replace(' ', '').replace(',', '.')
+        if s == '' or s.lower() == 'nan':
+            return '0'
+        return str(round(float(s), 2))
+    except Exception:
+        return '0'
+
+
+def is_meaningful_comment(comment) -> bool:
+    """Проверяет, содержит ли комментарий полезный текст (не '0', '-', 'nan' и т.п.)."""
+    if comment is None:
+        return False
+    comment_str = str(comment).strip()
+    if not comment_str:
+        return False
+    lowered = comment_str.lower()
+    meaningless_values = {
+        '0', '0.0', '0,0', 'nan', 'none', 'нет', 'no', 'none', 'пусто', 'n/a', 'н/д', '—', '-', '––'
+    }
+    if lowered in meaningless_values:
+        return False
+    if re.fullmatch(r'0+(\.0+)?', lowered):
+        return False
+    stripped = comment_str.strip('-').strip('—').strip()
+    if not stripped:
+        return False
+    return True
+
+
+def format_percent(value) -> str:
+    """Процент для текста выплаты: '0.85' -> '85%', '12,5%' -> '12.5%'; пустое -> ''."""
+    if value is None:
+        return ''
+    s = str(value).strip()
+    if not s or s.lower() in ('nan', 'none', '-', '—'):
+        return ''
+    try:
+        has_pct = s.endswith('%')
+        num = float(s.replace('%', '').replace(',', '.'))
+        if not has_pct and abs(num) <= 1:
+            num *= 100
+        num = round(num, 2)
+        if num.is_integer():
+            return f"{int(num)}%"
+        return f"{num}%"
+    except Exception:
+        return s
+
+
+def _has_explicit(value) -> bool:
+    if value is None:
+        return False
+    if isinstance(value, str):
+        return value.strip() != ''
+    return True
+
+
+def _comment_text(value) -> str:
+    return str(value).strip() if is_meaningful_comment(value) else ''
+
+
+# ----------------- декларативный шаблон выплаты куратора -----------------
+#
+# Шаблон - данные: поля строки, производные значения и разделы из строк с условиями.
+# compile_payment_template() один раз при импорте генерирует по нему функцию Python
+# (чтение и преобразование полей, затем условия и f-строки разделов подряд), и строка
+# рендерится за один проход без промежуточных блоков и правки заголовков. Оформление
+# ведомости (STATEMENT_STYLE) подставляется при компиляции.
+#
+# Условия: ('pos', поле) - число > 0; ('set', поле) - непустая строка;
+# ('nonzero', поле) - сумма != '0'; ('paid', поле) - сумма != '0' и > 0;
+# ('not', у), ('any', у, ...), ('all', у, ...).
+
+FIELD_KINDS = {
+    'int': to_int_safe,
+    'money': to_float_str_money,
+    'percent': format_percent,
+    'explicit': _has_explicit,
+    'text': lambda value: value,
+    'strip': lambda value: str(value).strip(),
+    'comment': _comment_text,
+}
+
+# (имя, вид, столбец CSV, значение по умолчанию, если столбца нет)
+PAYMENT_FIELDS = (
+    ('name', 'text', 'name', ''),
+    ('type', 'text', 'type', ''),
+    ('email', 'text', 'email', ''),
+    ('groups', 'strip', 'groups', ''),
+    ('stud_gk', 'int', 'stud_gk', None),
+    ('stud_gkp', 'int', 'stud_gkp', None),
+    ('stud_all', 'int', 'stud_all', None),
+    ('stud_rep', 'int', 'stud_rep', None),
+    ('rep_salary', 'money', 'rep_salary', None),
+    ('base', 'int', 'base', None),
+    ('stud_salary', 'int', 'stud_salary', None),
+    ('stud_salary_gk', 'int', 'stud_salary_gk', None),
+    ('stud_salary_gk_explicit', 'explicit', 'stud_salary_gk', None),
+    ('stud_salary_gkp', 'int', 'stud_salary_gkp', None),
+    ('stud_salary_gkp_explicit', 'explicit', 'stud_salary_gkp', None),
+    ('rr_gk', 'percent', 'rr_gk', None),
+    ('rr_salary_gk', 'money', 'rr_salary_gk', None),
+    ('okk_gk', 'percent', 'okk_gk', None),
+    ('okk_salary_gk', 'money', 'okk_salary_gk', None),
+    ('rr_gkp', 'percent', 'rr_gkp', None),
+    ('rr_salary_gkp', 'money', 'rr_salary_gkp', None),
+    ('okk_gkp', 'percent', 'okk_gkp', None),
+    ('okk_salary_gkp', 'money', 'okk_salary_gkp', None),
+    ('kpi_total', 'money', 'kpi_total', None),
+    ('checks_salary', 'int', 'checks_salary', None),
+    ('dop_checks', 'int', 'dop_checks', None),
+    ('up', 'int', 'up', None),
+    ('chats', 'int', 'chats', None),
+    ('webs', 'int', 'webs', None),
+    ('meth', 'int', 'meth', None),
+    ('dop_sk', 'int', 'dop_sk', None),
+    ('callsg', 'int', 'callsg', None),
+    ('callsp', 'int', 'callsp', None),
+    ('fines', 'int', 'fines', None),
+    ('total', 'money', 'total', None),
+    ('comment', 'comment', 'comment', ''),
+)
+
+# (имя, вид, исходные поля): 'money_sum' - сумма денежных полей, 'int_sum' - целых
+PAYMENT_DERIVED = (
+    ('kpi_gk', 'money_sum', ('rr_salary_gk', 'okk_salary_gk')),
+    ('kpi_gkp', 'money_sum', ('rr_salary_gkp', 'okk_salary_gkp')),
+    ('extras_total', 'int_sum', ('up', 'chats', 'webs', 'meth', 'dop_sk', 'callsg', 'callsp')),
+)
+
+_SPLIT = ('any', ('pos', 'stud_gk'), ('pos', 'stud_gkp'))
+_GK_SALARY = ('any', ('pos', 'stud_salary_gk'), ('set', 'stud_salary_gk_explicit'))
+_GKP_SALARY = ('any', ('pos', 'stud_salary_gkp'), ('set', 'stud_salary_gkp_explicit'))
+
+# (ключ раздела, условие раздела, заголовок, [(условие строки, формат)])
+PAYMENT_SECTIONS = (
+    ('studs', ('pos', 'stud_gk'), '\n[Сопровождение ГК]\n', (
+        (None, '\nВсего учеников - ГК: {stud_gk}'),
+        (('pos', 'base'), '\nОклад за ученика: {base}₽'),
+        (_GK_SALARY, '\n→ Сумма оклада: {stud_salary_gk}₽'),
+        (('all', ('not', _GK_SALARY), ('pos', 'stud_salary')), '\n→ Сумма оклада: {stud_salary}₽'),
+        (('all', ('not', _GK_SALARY), ('pos', 'stud_salary'), ('pos', 'stud_rep')),
+         '\nКол-во учеников с тарифом с репетитором: {stud_rep}'),
+        (('paid', 'rep_salary'), '\nДоплата за учеников с репетитором: {rep_salary}₽'),
+        (('set', 'rr_gk'), '\nRetention ГК: {rr_gk}'),
+        (('nonzero', 'rr_salary_gk'), '\n→ Оплата за retention ГК: {rr_salary_gk}₽'),
+        (('set', 'okk_gk'), '\nOKK ГК: {okk_gk}'),
+        (('nonzero', 'okk_salary_gk'), '\n→ Оплата за OKK ГК: {okk_salary_gk}₽'),
+        (('any', ('nonzero', 'rr_salary_gk'), ('nonzero', 'okk_salary_gk')),
+         '\n→ Сумма KPI (OKK+Retention): {kpi_gk}₽'),
+        (None, '\n'),
+    )),
+    ('studs', ('pos', 'stud_gkp'), '\n[Сопровождение ГК+]\n', (
+        (None, '\nВсего учеников - ГК+: {stud_gkp}'),
+        (('pos', 'base'), '\nОклад за ученика: {base}₽'),
+        (_GKP_SALARY, '\n→ Сумма оклада: {stud_salary_gkp}₽'),
+        (('set', 'rr_gkp'), '\nRetention ГК+: {rr_gkp}'),
+        (('nonzero', 'rr_salary_gkp'), '\n→ Оплата за retention ГК+: {rr_salary_gkp}₽'),
+        (('set', 'okk_gkp'), '\nOKK ГК+: {okk_gkp}'),
+        (('nonzero', 'okk_salary_gkp'), '\n→ Оплата за OKK ГК+: {okk_salary_gkp}₽'),
+        (('any', ('nonzero', 'rr_salary_gkp'), ('nonzero', 'okk_salary_gkp')),
+         '\n→ Сумма KPI (OKK+Retention): {kpi_gkp}₽'),
+        (None, '\n'),
+    )),
+    # Общие блоки показываются только без отдельных разделов ГК / ГК+
+    ('studs', ('all', ('not', _SPLIT), ('any', ('pos', 'stud_all'), ('pos', 'stud_rep'), ('pos', 'stud_salary'),
+                                        ('paid', 'rep_salary'))), '\n[Сопровождение учеников]', (
+        (('pos', 'stud_all'), '\nВсего учеников в группах: {stud_all}'),
+        (('pos', 'stud_rep'), '\nКол-во учеников с тарифом с репетитором: {stud_rep}'),
+        (('pos', 'base'), '\nОклад за ученика: {base}₽'),
+        (('paid', 'rep_salary'), '\nДоплата за учеников с репетитором: {rep_salary}₽'),
+        (('pos', 'stud_salary'), '\n→ Сумма оклада: {stud_salary}₽'),
+        (('paid', 'kpi_total'), '\n→ Сумма KPI (OKK+Retention): {kpi_total}₽'),
+    )),
+    ('retention', ('all', ('not', _SPLIT), ('any', ('paid', 'rr_salary_gk'), ('paid', 'rr_salary_gkp'))), '\n[Retention]', (
+        (('set', 'rr_gk'), '\nRetention ГК: {rr_gk}'),
+        (('nonzero', 'rr_salary_gk'), '\nОплата за retention ГК: {rr_salary_gk}₽'),
+        (('set', 'rr_gkp'), '\nRetention ГК+: {rr_gkp}'),
+        (('nonzero', 'rr_salary_gkp'), '\nОплата за retention ГК+: {rr_salary_gkp}₽'),
+    )),
+    ('okk', ('all', ('not', _SPLIT), ('any', ('paid', 'okk_salary_gk'), ('paid', 'okk_salary_gkp'), ('paid', 'kpi_total'))),
+     '\n[Показатели ОКК]', (
+        (('set', 'okk_gk'), '\nOKK ГК: {okk_gk}'),
+        (('nonzero', 'okk_salary_gk'), '\nОплата за OKK ГК: {okk_salary_gk}₽'),
+        (('set', 'okk_gkp'), '\nOKK ГК+: {okk_gkp}'),
+        (('nonzero', 'okk_salary_gkp'), '\nОплата за OKK ГК+: {okk_salary_gkp}₽'),
+        (('paid', 'kpi_total'), '\n→ Сумма KPI (OKK+Retention): {kpi_total}₽'),
+    )),
+    ('checks', ('any', ('pos', 'checks_salary'), ('pos', 'dop_checks')), '', (
+        (('pos', 'checks_salary'), '\n→ Проверка домашних работ: {checks_salary}₽'),
+        (('pos', 'dop_checks'), '\n→ Дополнительно – за проверки (данные СК): {dop_checks}₽'),
+        (None, '\n'),
+    )),
+    ('extras', ('pos', 'extras_total'), '\n\n[Иная деятельность]', (
+        (('pos', 'up'), '\nЗа учебную поддержку: {up}₽'),
+        (('pos', 'chats'), '\nМодерация чатов: {chats}₽'),
+        (('pos', 'webs'), '\nМодерация вебинаров: {webs}₽'),
+        (('pos', 'meth'), '\nСтол заказов: {meth}₽'),
+        (('pos', 'dop_sk'), '\nДоп. суммы, начисленные СК: {dop_sk}₽'),
+        (('pos', 'callsg'), '\nГрупповые созвоны: {callsg}₽'),
+        (('pos', 'callsp'), '\nИндивидуальные созвоны: {callsp}₽'),
+        (None, '\n→ Всего в категории: {extras_total}₽'),
+    )),
+    ('fines', ('pos', 'fines'), '', ((None, '\n\n→ Штрафы: -{fines}₽'),)),
+    ('fines', ('not', ('pos', 'fines')), '', ((None, '\n\nШтрафы: отсутствуют'),)),
+    ('total', None, '', (
+        (None, '\n\n→ ИТОГО К ВЫПЛАТЕ: {total}₽'),
+        (('set', 'comment'), '\n[!!!] Комментарий: {comment}'),
+    )),
+)
+
+# Оформление ведомости (текст для VK): заголовок проверок, штрафы и итог без стрелки
+STATEMENT_STYLE = {
+    'headers': {'checks': '\n[Проверки]'},
+    'lines': {
+        '\n\n→ Штрафы: -{fines}₽': '\n\nШтрафы: -{fines}₽',
+        '\n\n→ ИТОГО К ВЫПЛАТЕ: {total}₽': '\n\nИТОГО К ВЫПЛАТЕ: {total}₽',
+    },
+}
+
+STATEMENT_HEAD = ('head', None, '=== Согласование выплаты ===', (
+    (None, '\nВедомость: {statement}'),
+    (None, '\nКуратор: {name}'),
+    (None, '\nТип куратора: {type}'),
+    (None, '\nПочта на платформе: {email}'),
+    (('set', 'groups'), '\nГруппы: {groups}'),
+    (None, '\n'),
+))
+
+STATEMENT_TAIL = ('tail', None, ("\n\nНажмите «Согласен», если у Вас нет разногласий с выставленными цифрами"
+                                 "\nНажмите «Не согласен», если Вы не согласны с каким-либо из пунктов"
+                                 "\nПросмотр ведомости возможен в течение 36 часов"), ())
+
+
+_MISSING = object()
+
+
+def _memoized(convert, limit: int = 4096):
+    """Кэш преобразования строковых значений: в ведомости одни и те же значения ('0', ставки) повторяются."""
+    cache = {}
+
+    def memo(value):
+        if value.__class__ is str:
+            result = cache.get(value)
+            if result is None:
+                if len(cache) >= limit:
+                    cache.clear()
+                result = cache[value] = convert(value)
+            return result
+        return convert(value)
+    return memo
+
+
+def _condition_source(cond) -> str:
+    op, *args = cond
+    if op == 'pos':
+        return f"(f_{args[0]} > 0)"
+    if op == 'set':
+        return f"f_{args[0]}"
+    if op == 'nonzero':
+        return f"(f_{args[0]} != '0')"
+    if op == 'paid':
+        return f"(f_{args[0]} != '0' and to_float_safe(f_{args[0]}) > 0)"
+    if op == 'not':
+        return f"(not {_condition_source(args[0])})"
+    if op == 'any':
+        return '(' + ' or '.join(_condition_source(arg) for arg in args) + ')'
+    if op == 'all':
+        return '(' + ' and '.join(_condition_source(arg) for arg in args) + ')'
+    raise ValueError(f'Unknown template condition: {op}')
+
+
+def _format_source(fmt: str, names: set) -> str:
+    """Строка формата '...{поле}...' -> исходник f-строки по локальным переменным f_<поле>."""
+    pieces = []
+    fields = False
+    for literal, field, _, _ in string.Formatter().parse(fmt):
+        pieces.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is not None:
+            names.add(field)
+            pieces.append('{f_' + field + '}')
+            fields = True
+    return 'f' + repr(''.join(pieces)) if fields else repr(fmt)
+
+
+def _derived_source(kind: str, sources: tuple) -> str:
+    if kind == 'money_sum':
+        return 'to_float_str_money(' + ' + '.join(f'to_float_safe(f_{name})' for name in sources) + ')'
+    if kind == 'int_sum':
+        return ' + '.join(f'f_{name}' for name in sources)
+    raise ValueError(f'Unknown derived field kind: {kind}')
+
+
+class PaymentTemplate:
+    """Шаблон, скомпилированный в функции Python: чтение полей и разделы за один проход.
+
+    render(row, fill, extra) - весь текст; sections(row, fill) - dict текстов по ключам разделов.
+    fill заменяет пустые (None) значения существующих столбцов, как fill_missing().
+    """
+
+    def __init__(self, sections, fields=PAYMENT_FIELDS, derived=PAYMENT_DERIVED, style=None):
+        style = style or {}
+        headers = style.get('headers', {})
+        line_styles = style.get('lines', {})
+        self.keys = tuple(dict.fromkeys(key for key, _, _, _ in sections))
+        known = set()
+        prologue = ['get = row.get']
+        for name, kind, column, default in fields:
+            known.add(name)
+            prologue += [f'v = get({column!r}, _MISSING)',
+                         'if v is _MISSING:',
+                         f'    v = {default!r}',
+                         'elif v is None:',
+                         '    v = fill',
+                         f'f_{name} = kind_{kind}(v)']
+        for name, kind, sources in derived:
+            known.add(name)
+            prologue.append(f'f_{name} = {_derived_source(kind, sources)}')
+
+        body = []
+        used = set()
+        for key, cond, header, parts in sections:
+            indent = ''
+            if cond is not None:
+                body.append(f'if {_condition_source(cond)}:')
+                indent = '    '
+            header = headers.get(key, header)
+            if header:
+                body.append(f'{indent}o_{key}.append({header!r})')
+            for line_cond, fmt in parts:
+                line = f'o_{key}.append({_format_source(line_styles.get(fmt, fmt), used)})'
+                if line_cond is None:
+                    body.append(indent + line)
+                else:
+                    body.append(f'{indent}if {_condition_source(line_cond)}:')
+                    body.append(f'{indent}    {line}')
+            if not body or body[-1].endswith(':'):
+                body.append(indent + 'pass')
+        prologue += [f'f_{name} = extra[{name!r}]' for name in sorted(used - known)]
+
+        def function(name, outputs, result):
+            lines = [f'def {name}(row, fill=None, extra=None):']
+            lines += ['    ' + line for line in prologue + outputs + body]
+            lines.append('    return ' + result)
+            return '\n'.join(lines)
+
+        render_outputs = ['o = []'] + [f'o_{key} = o' for key in self.keys]
+        sections_outputs = [f'o_{key} = []' for key in self.keys]
+        sections_result = '{' + ', '.join(f"{key!r}: ''.join(o_{key})" for key in self.keys) + '}'
+        self.source = (function('render', render_outputs, "''.join(o)") + '\n\n\n'
+                       + function('sections', sections_outputs, sections_result) + '\n')
+        namespace = {'_MISSING': _MISSING, 'to_float_safe': to_float_safe, 'to_float_str_money': to_float_str_money}
+        # Текстовые поля (имя, почта) почти всегда уникальны - их не кэшируем
+        namespace.update({f'kind_{kind}': convert if kind == 'text' else _memoized(convert)
+                          for kind, convert in FIELD_KINDS.items()})
+        exec(compile(self.source, '<payment template>', 'exec'), namespace)
+        self.render = namespace['render']
+        self.sections = namespace['sections']
+
+
+def compile_payment_template(sections=PAYMENT_SECTIONS, style=None) -> PaymentTemplate:
+    return PaymentTemplate(sections, style=style)
+
+
+PAYMENT_TEMPLATE = compile_payment_template()
+STATEMENT_SECTIONS_TEMPLATE = compile_payment_template(style=STATEMENT_STYLE)
+STATEMENT_TEMPLATE = compile_payment_template((STATEMENT_HEAD,) + PAYMENT_SECTIONS + (STATEMENT_TAIL,),
+                                              style=STATEMENT_STYLE)
+
+
+def compose_payment_sections(p: dict) -> dict:
+    """Строит текстовые блоки для разных разделов выплаты."""
+    return PAYMENT_TEMPLATE.sections(p)
+
+
+def compose_statement_sections(p: dict) -> dict:
+    """Блоки разделов в оформлении ведомости (как в render_payment_text)."""
+    return STATEMENT_SECTIONS_TEMPLATE.sections(p)
+
+
+def render_payment_text(row: dict, original_filename: str) -> str:
+    """Текст выплаты куратора по строке персонального CSV."""
+    statement = original_filename.replace('.csv', '').replace('_', ' ')
+    return STATEMENT_TEMPLATE.render(row, '0', {'statement': statement})
+
+
+def _pick(row: dict, *keys) -> str:
+    for key in keys:
+        value = row.get(key)
+        if value is not None and value == value:  # None и NaN — пусто
+            return str(value)
+    return ''
+
+
+def repet_row_data(row: dict) -> dict:
+    """Поля строки репетитора, которыми render_repet_payment_text дополняет пустые столбцы.
+
+    Те же ключи, что у маппинга выплаты репетитора в VK боте.
+    """
+    return {
+        'fio': _pick(row, 'Репетитор', 'ФИО', 'fio', 'name', 'full_name', 'FIO'),
+        'subject': _pick(row, 'Предмет'),
+        'lessons_held': _pick(row, 'Кол-во состоявшихся занятий'),
+        'lessons_no_student': _pick(row, 'Кол-во занятий, на которые не явился ученик'),
+        'base_payment': _pick(row, 'Базовое вознаграждение за проведенные занятия'),
+        'okk': _pick(row, 'OKK', 'ОКК'),
+        'rr': _pick(row, 'RR'),
+        'kpi': _pick(row, 'KPI'),
+        'preparation': _pick(row, 'Подготовка к занятиям'),
+        'penalties': _pick(row, 'Штраф'),
+        'total': _pick(row, 'ИТОГ', 'Итого', 'Total', 'total'),
+    }
+
+
+def render_repet_payment_text(row: dict, data=None) -> str:
+    """Текст выплаты репетитора; data - данные выплаты (по умолчанию из той же строки)."""
+    if data is None:
+        data = repet_row_data(row)
+    p = fill_missing(row, '0')
+    
+    # Форматируем сообщение по новому шаблону
+    msg = "Открыта ведомость\n\n"
+    msg += "=== Согласование выплаты ===\n"
+    msg += f"ФИО: {p.get('Репетитор', '') or data.get('fio', '')}\n"
+    msg += f"Предмет: {p.get('Предмет', '') or data.get('subject', '')}\n"
+    msg += f"Кол-во проведенных занятий: {p.get('Кол-во состоявшихся занятий', '') or data.get('lessons_held', '')}\n"
+    msg += f"Уроки без подключения ученика: {p.get('Кол-во занятий, на которые не явился ученик', '') or data.get('lessons_no_student', '')}\n"
+    msg += f"Оплата за занятия: {p.get('Базовое вознаграждение за проведенные занятия', '') or data.get('base_payment', '')}\n"
+    msg += f"Оценка контроля качества: {p.get('OKK', '') or p.get('ОКК', '') or data.get('okk', '')}\n"
+    msg += f"Критерий удержания учеников: {p.get('RR', '') or data.get('rr', '')}\n"
+    msg += f"Дополнительное вознаграждение за качество: {p.get('KPI', '') or data.get('kpi', '')}\n"
+    # Приоритет: data['preparation'] (из маппинга), затем из CSV напрямую
+    prep_val = data.get('preparation', '') or ''
+    if not str(prep_val).strip() or str(prep_val).strip() == '0':
+        prep_val = p.get('Подготовка к занятиям', '')
+    prep_str = str(prep_val).strip() if prep_val else '0'
+    msg += f"Доп. вознаграждение за подготовку: {prep_str}\n"
+    msg += f"Штрафы: {p.get('Штраф', '') or data.get('penalties', '')}\n"
+    msg += f"Итоговая сумма: {p.get('ИТОГ', '') or data.get('total', '')}\n\n"
+    msg += "Нажмите «Согласен», если у Вас нет разногласий с выставленными цифрами\n"
+    msg += "Нажмите «Не согласен», если Вы не согласны с каким-либо из пунктов\n"
+    msg += "Просмотр ведомости возможен в течение 36 часов"
+    
+    return msg
+
+
+def render_rows(items) -> list:
+    """[(db_id, is_repet, original_filename, row)] -> [(текст, db_id)]; выполняется и в пуле процессов.
+
+    Строки, которые не удалось отрендерить, пропускаются - VK бот отрендерит их сам.
+    """
+    rendered = []
+    for db_id, is_repet, original_filename, row in items:
+        try:
+            if is_repet:
+                text = render_repet_payment_text(row)
+            else:
+                text = render_payment_text(row, original_filename)
+        except Exception:
+            continue
+        rendered.append((text, db_id))
+    return rendered
@@ -0,0 +1,299 @@
+"""Бинарный снимок открытых ведомостей, общий для TG и VK ботов.
+
+TG бот после публикации/обновления/архивации пересобирает файл снимка: строки
+персональных CSV всех открытых ведомостей (как их читает read_csv_rows) плюс два
+отсортированных индекса - vk_id -> смещения записей и хэш personal_path -> смещение.
+Файл пишется во временный и подменяется os.replace, поэтому читатель всегда видит
+целый снимок. VK бот отображает файл в память (mmap) и перечитывает его, когда
+меняется inode/mtime: страницы снимка лежат в page cache ОС один раз на оба процесса,
+а открытие выплаты не требует открытия персонального файла.
+
+Формат (little-endian):
+  заголовок  HEADER
+  схемы      u16 число столбцов, далее столбцы: u16 длина + utf-8
+  записи     u32 схема, u64 vk_id, i64 mtime_ns, u64 size, u16 длина пути, u32 длина
+             значений в байтах, путь, длины значений в символах по столбцам схемы
+             (u32, NONE_LEN = None), затем все значения одной строкой utf-8
+  индексы    пары u64 (ключ, смещение записи), отсортированные по ключу
+"""
+
+import csv
+import hashlib
+import io
+import logging
+import mmap
+import os
+import struct
+import threading
+
+log = logging.getLogger('snapshot')
+
+MAGIC = b'STSNAP01'
+HEADER = struct.Struct('<8sIIQQQQQ')  # magic, схем, записей, поколение, смещения: схемы, записи, vk-индекс, path-индекс
+RECORD_HEAD = struct.Struct('<IQqQHI')
+INDEX_ENTRY = struct.Struct('<QQ')
+U16 = struct.Struct('<H')
+NONE_LEN = 0xFFFFFFFF
+
+# Значения, которые pd.read_csv по умолчанию считает пустыми (NaN); читаем их как None
+CSV_NA_VALUES = frozenset({
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+})
+
+
+def csv_rows_from_text(text: str, limit: int = None) -> list:
+    """Разбирает текст CSV в список dict так же, как pd.read_csv(dtype=str).
+
+    Пустые и NA-значения -> None, безымянные столбцы -> 'Unnamed: N',
+    повторяющиеся -> 'name.1'.
+    """
+    reader = csv.reader(io.StringIO(text, newline=''))
+    header = next(reader, None)
+    if not header:
+        return []
+    columns = []
+    seen = {}
+    for i, name in enumerate(header):
+        name = name or f"Unnamed: {i}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    rows = []
+    for values in reader:
+        if not values:
+            continue
+        row = {}
+        for i, column in enumerate(columns):
+            value = values[i] if i < len(values) else ''
+            row[column] = None if value in CSV_NA_VALUES else value
+        rows.append(row)
+        if limit and len(rows) >= limit:
+            break
+    return rows
+
+
+def read_first_csv_row(path: str):
+    """Первая строка персонального CSV (utf-8, затем cp1251) или None."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    for encoding in ('utf-8-sig', 'cp1251'):
+        try:
+            text = raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        rows = csv_rows_from_text(text, limit=1)
+        return rows[0] if rows else None
+    return None
+
+
+def path_key(path: str) -> int:
+    return int.from_bytes(hashlib.blake2b(path.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _encode_str(value: str, length: struct.Struct) -> bytes:
+    data = value.encode('utf-8')
+    return length.pack(len(data)) + data
+
+
+def write_snapshot(path: str, records, generation: int) -> int:
+    """Записывает снимок атомарно; records - (vk_id, personal_path, mtime_ns, size, row). Возвращает число записей."""
+    schemas = {}
+    body = io.BytesIO()
+    vk_index = []
+    path_index = []
+    for vk_id, personal_path, mtime_ns, size, row in records:
+        columns = tuple(row)
+        schema_id = schemas.setdefault(columns, len(schemas))
+        offset = body.tell()
+        path_bytes = personal_path.encode('utf-8')
+        values = [None if value is None else str(value) for value in row.values()]
+        blob = ''.join(value for value in values if value is not None).encode('utf-8')
+        body.write(RECORD_HEAD.pack(schema_id, vk_id, mtime_ns, size, len(path_bytes), len(blob)))
+        body.write(path_bytes)
+        body.write(struct.pack(f'<{len(values)}I', *(NONE_LEN if value is None else len(value) for value in values)))
+        body.write(blob)
+        vk_index.append((vk_id, offset))
+        path_index.append((path_key(personal_path), offset))
+
+    schema_blob = b''.join(
+        U16.pack(len(columns)) + b''.join(_encode_str(col, U16) for col in columns) for columns in schemas
+    )
+    schemas_off = HEADER.size
+    records_off = schemas_off + len(schema_blob)
+    vk_index_off = records_off + body.tell()
+    path_index_off = vk_index_off + INDEX_ENTRY.size * len(vk_index)
+    header = HEADER.pack(MAGIC, len(schemas), len(vk_index), generation,
+                         schemas_off, records_off, vk_index_off, path_index_off)
+
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(schema_blob)
+        f.write(body.getbuffer())
+        for key, offset in sorted(vk_index):
+            f.write(INDEX_ENTRY.pack(key, offset))
+        for key, offset in sorted(path_index):
+            f.write(INDEX_ENTRY.pack(key, offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(vk_index)
+
+
+class StatementSnapshot:
+    """Открытый только на чтение снимок (mmap). Потокобезопасен: данные не меняются."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+        (magic, n_schemas, self.count, self.generation, schemas_off, self.records_off,
+         self.vk_index_off, self.path_index_off) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'Not a statements snapshot: {path}')
+        self.schemas = []
+        pos = schemas_off
+        for _ in range(n_schemas):
+            (ncols,) = U16.unpack_from(self.mm, pos)
+            pos += U16.size
+            columns = []
+            for _ in range(ncols):
+                (length,) = U16.unpack_from(self.mm, pos)
+                pos += U16.size
+                columns.append(self.mm[pos:pos + length].decode('utf-8'))
+                pos += length
+            self.schemas.append((tuple(columns), struct.Struct(f'<{ncols}I')))
+
+    def _lower_bound(self, index_off: int, key: int) -> int:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if INDEX_ENTRY.unpack_from(self.mm, index_off + mid * INDEX_ENTRY.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _offsets(self, index_off: int, key: int):
+        i = self._lower_bound(index_off, key)
+        while i < self.count:
+            entry_key, offset = INDEX_ENTRY.unpack_from(self.mm, index_off + i * INDEX_ENTRY.size)
+            if entry_key != key:
+                break
+            yield offset
+            i += 1
+
+    def _record_path(self, offset: int):
+        pos = self.records_off + offset
+        head = RECORD_HEAD.unpack_from(self.mm, pos)
+        pos += RECORD_HEAD.size
+        path_end = pos + head[4]
+        return head, self.mm[pos:path_end].decode('utf-8'), path_end
+
+    def _record_row(self, head: tuple, pos: int) -> dict:
+        columns, lengths_struct = self.schemas[head[0]]
+        lengths = lengths_struct.unpack_from(self.mm, pos)
+        pos += lengths_struct.size
+        text = self.mm[pos:pos + head[5]].decode('utf-8')
+        row = {}
+        start = 0
+        for column, length in zip(columns, lengths):
+            if length == NONE_LEN:
+                row[column] = None
+            else:
+                row[column] = text[start:start + length]
+                start += length
+        return row
+
+    def record(self, personal_path: str):
+        """(vk_id, mtime_ns, size, row) записи персонального файла или None."""
+        for offset in self._offsets(self.path_index_off, path_key(personal_path)):
+            head, record_path, pos = self._record_path(offset)
+            if record_path == personal_path:
+                return head[1], head[2], head[3], self._record_row(head, pos)
+        return None
+
+    def get_row(self, personal_path: str):
+        record = self.record(personal_path)
+        return record[3] if record else None
+
+    def rows_for_vk(self, vk_id: int) -> list:
+        """[(personal_path, row)] всех открытых выплат пользователя."""
+        result = []
+        for offset in self._offsets(self.vk_index_off, vk_id):
+            head, record_path, pos = self._record_path(offset)
+            result.append((record_path, self._record_row(head, pos)))
+        return result
+
+    def records(self):
+        """Все записи (vk_id, personal_path, mtime_ns, size, row) - для инкрементальной пересборки."""
+        for i in range(self.count):
+            offset = INDEX_ENTRY.unpack_from(self.mm, self.vk_index_off + i * INDEX_ENTRY.size)[1]
+            head, record_path, pos = self._record_path(offset)
+            yield head[1], record_path, head[2], head[3], self._record_row(head, pos)
+
+
+class SnapshotHandle:
+    """Текущий снимок процесса; check() перечитывает файл, если его подменили."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.current = None
+        self.lock = threading.Lock()
+        self.reloads = 0
+        self.hits = 0
+        self.misses = 0
+
+    def check(self) -> bool:
+        """Сверяет inode/mtime файла снимка; True, если снимок перечитан."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            if self.current is not None:
+                log.info('Statements snapshot %s removed', self.path)
+            self.current = None
+            return False
+        current = self.current
+        if current is not None and current.identity == (st.st_ino, st.st_mtime_ns, st.st_size):
+            return False
+        with self.lock:
+            try:
+                snap = StatementSnapshot(self.path)
+            except Exception:
+                log.exception('Failed to map statements snapshot %s', self.path)
+                return False
+            # Старое отображение закроется сборщиком мусора, когда его перестанут читать другие потоки
+            self.current = snap
+            self.reloads += 1
+        log.info('Statements snapshot mapped: %s records, generation %s', snap.count, snap.generation)
+        return True
+
+    def get_record(self, personal_path: str):
+        """(vk_id, mtime_ns, size, row) записи текущего снимка или None."""
+        snap = self.current
+        record = snap.record(personal_path) if snap is not None else None
+        if record is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return record
+
+    def get_row(self, personal_path: str):
+        record = self.get_record(personal_path)
+        return record[3] if record else None
+
+    def stats(self) -> dict:
+        snap = self.current
+        return {
+            "records": snap.count if snap else 0,
+            "generation": snap.generation if snap else None,
+            "bytes": len(snap.mm) if snap else 0,
+            "reloads": self.reloads,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
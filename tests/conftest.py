@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+# Модули ботов лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations  # noqa: E402
+
+
+@pytest.fixture
+def vk_bot(tmp_path, monkeypatch):
+    """Модуль VK бота, работающий с пустой hosting.db во временном каталоге."""
+    vk = pytest.importorskip('main_bot_VK')
+    db_path = str(tmp_path / 'hosting.db')
+    assert migrations.apply_migrations(db_path) == migrations.SCHEMA_VERSION
+    monkeypatch.setattr(vk, 'DB_PATH', db_path)
+    return vk
+
+
+@pytest.fixture
+def tg_bot(tmp_path, monkeypatch):
+    """Модуль TG бота: hosting.db, архив, папки ведомостей и загрузок во временном каталоге."""
+    tg = pytest.importorskip('main_bot_TG')
+    paths = {
+        'DB_PATH': tmp_path / 'hosting.db',
+        'ARCHIVE_DB_PATH': tmp_path / 'archive.db',
+        'HOSTING_ROOT': tmp_path / 'hosting',
+        'USERS_FILE': tmp_path / 'users.json',
+        'CURRENT_SHEETS_FILE': tmp_path / 'current_sheets.json',
+        'UPLOADS_DIR': tmp_path / 'uploads',
+        'UPLOADS_STORE_DIR': tmp_path / 'uploads' / 'store',
+        'SNAPSHOT_PATH': tmp_path / 'statements.snap',
+    }
+    for name, path in paths.items():
+        monkeypatch.setattr(tg, name, str(path))
+    monkeypatch.setattr(tg, 'DRY_RUN', False)
+    tg.init_db()
+    return tg
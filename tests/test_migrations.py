@@ -0,0 +1,283 @@
+import sqlite3
+
+import pytest
+
+import migrations
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / 'hosting.db')
+    assert migrations.apply_migrations(path) == migrations.SCHEMA_VERSION
+    conn = sqlite3.connect(path)
+    yield conn
+    conn.close()
+
+
+def _plan(conn, sql, params=()):
+    return ' | '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params))
+
+
+def _indexes(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+
+@pytest.mark.parametrize('state, expected', [
+    ('imported:0b7a8f4e-1111-2222-3333-444455556666', ('imported', '0b7a8f4e-1111-2222-3333-444455556666')),
+    ('repet_imported:abc', ('repet_imported', 'abc')),
+    ('repet', ('repet', None)),
+    ('', ('', None)),
+    (None, ('', None)),
+])
+def test_split_vedomosti_state(state, expected):
+    assert migrations.split_vedomosti_state(state) == expected
+
+
+def test_redundant_index_dropped(db):
+    indexes = _indexes(db)
+    assert 'idx_vedomosti_users_vk_kind_created' not in indexes
+    # Префиксы idx_vedomosti_users_vk_list
+    assert 'idx_vedomosti_users_vk_created' not in indexes
+    assert 'idx_vedomosti_users_vk_id' not in indexes
+    assert 'idx_vedomosti_users_vk_list' in indexes
+
+
+def test_redundant_index_dropped_on_upgrade(tmp_path):
+    path = str(tmp_path / 'hosting.db')
+    migrations.apply_migrations(path)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE INDEX idx_vedomosti_users_vk_kind_created ON vedomosti_users(vk_id, state_kind, created_at)")
+    conn.execute("PRAGMA user_version = 13")
+    conn.commit()
+    conn.close()
+    assert migrations.apply_migrations(path) == migrations.SCHEMA_VERSION
+    conn = sqlite3.connect(path)
+    assert 'idx_vedomosti_users_vk_kind_created' not in _indexes(conn)
+    conn.close()
+
+
+@pytest.mark.parametrize('sql, params, index', [
+    # Загрузка выплат пользователя в VK (hydrate_user_payments)
+    ("SELECT id FROM vedomosti_users WHERE vk_id = ? AND state_kind IN ('imported', 'repet_imported') "
+     "ORDER BY COALESCE(created_at, 0), id", ('1',), 'idx_vedomosti_users_vk_list'),
+    # /find в TG
+    ("SELECT original_filename, status, created_at, 0 AS archived, id FROM vedomosti_users "
+     "WHERE vk_id = ? AND state_kind = 'imported' ORDER BY COALESCE(created_at, 0) DESC, id DESC", ('1',),
+     'idx_vedomosti_users_vk_list'),
+
+    # Поиск выплаты по payment_uuid (update_vedomosti_status_by_payment)
+    ("SELECT id, vk_id, original_filename FROM vedomosti_users WHERE payment_uuid = ?", ('x',),
+     'idx_vedomosti_users_payment_uuid'),
+    # Неподтвердившие по ведомости (напоминания в TG)
+    ("SELECT DISTINCT vk_id FROM vedomosti_users WHERE original_filename = ? AND state_kind = 'imported' "
+     "AND IFNULL(status, '') <> 'agreed'", ('x',), 'idx_vedomosti_users_filename_kind'),
+    # Отбор строк к архивации
+    ("SELECT DISTINCT original_filename FROM vedomosti_users WHERE archive_at > 0 AND archive_at <= ? "
+     "AND state_kind = 'imported'", (1,), 'idx_vedomosti_users_archive_at'),
+])
+def test_queries_use_indexes(db, sql, params, index):
+    plan = _plan(db, sql, params)
+    assert f'USING INDEX {index}' in plan or f'USING COVERING INDEX {index}' in plan, plan
+    assert 'USE TEMP B-TREE FOR ORDER BY' not in plan, plan
+
+
+@pytest.mark.parametrize('sql', [
+    "SELECT id FROM vedomosti_users WHERE vk_id = ? AND state_kind IN ('imported', 'repet_imported') "
+    "ORDER BY COALESCE(created_at, 0), id",
+    "SELECT id FROM vedomosti_users WHERE vk_id = ? AND state_kind IN ('imported', 'repet_imported') "
+    "AND COALESCE(created_at, 0) <= ? AND (COALESCE(created_at, 0) < ? OR id < ?) "
+    "ORDER BY COALESCE(created_at, 0) DESC, id DESC LIMIT 5",
+])
+def test_list_queries_prefer_list_index_over_kind_index(db, sql):
+    """Даже при наличии (vk_id, state_kind, created_at) список идёт по vk_list без сортировки:
+    по двум state_kind тот индекс порядок COALESCE(created_at, 0), id не даёт."""
+    db.execute("CREATE INDEX idx_vedomosti_users_vk_kind_created ON vedomosti_users(vk_id, state_kind, created_at)")
+    _insert_payments(db, '42', list(range(50)))
+    db.execute("ANALYZE")
+    params = ('42',) + (1,) * (sql.count('?') - 1)
+    plan = _plan(db, sql, params)
+    assert 'idx_vedomosti_users_vk_list' in plan, plan
+    assert 'TEMP B-TREE' not in plan, plan
+
+
+def test_prefix_duplicate_indexes_dropped_on_upgrade(tmp_path):
+    path = str(tmp_path / 'hosting.db')
+    migrations.apply_migrations(path)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE INDEX idx_vedomosti_users_vk_id ON vedomosti_users(vk_id)")
+    conn.execute("CREATE INDEX idx_vedomosti_users_vk_created ON vedomosti_users(vk_id, created_at)")
+    conn.execute("PRAGMA user_version = 20")
+    conn.commit()
+    conn.close()
+    assert migrations.apply_migrations(path) == migrations.SCHEMA_VERSION
+    conn = sqlite3.connect(path)
+    assert not {'idx_vedomosti_users_vk_id', 'idx_vedomosti_users_vk_created'} & _indexes(conn)
+    conn.close()
+
+
+def _insert_payments(conn, vk_id, created_values):
+    for i, created_at in enumerate(created_values):
+        conn.execute(
+            "INSERT INTO vedomosti_users(vk_id, original_filename, state, state_kind, payment_uuid, created_at) "
+            "VALUES (?, ?, ?, 'imported', ?, ?)",
+            (vk_id, f'S{i}.csv', f'imported:u{i}', f'u{i}', created_at))
+    conn.commit()
+
+
+def _page_through(conn, vk_id, limit):
+    """Листает список так же, как кнопка "Ещё": курсор - (created_at, id) последней строки порции."""
+    seen = []
+    before = None
+    for _ in range(100):
+        rows = migrations.select_payment_page(conn, vk_id, 'id, COALESCE(created_at, 0)', limit + 1, before)
+        seen.extend(row[0] for row in rows[:limit])
+        if len(rows) <= limit:
+            return seen
+        before = rows[limit - 1][1], rows[limit - 1][0]
+    raise AssertionError('pagination did not terminate')
+
+
+@pytest.mark.parametrize('created_values', [
+    [0] * 7,
+    [None] * 7,
+    [0, None, 0, None, 0, None, 0],
+    [100, 0, 200, None, 200, 50, 0],
+])
+def test_payment_page_cursor_covers_rows_without_created_at(db, created_values):
+    _insert_payments(db, '42', created_values)
+    _insert_payments(db, '43', [0, 0])
+    expected = [row[0] for row in db.execute(
+        "SELECT id FROM vedomosti_users WHERE vk_id = '42' ORDER BY COALESCE(created_at, 0) DESC, id DESC")]
+    assert _page_through(db, '42', 2) == expected
+    assert len(expected) == len(created_values)
+
+
+def test_payment_page_query_uses_list_index(db):
+    plan = _plan(db, "SELECT id FROM vedomosti_users WHERE vk_id = ? AND state_kind IN ('imported', 'repet_imported') "
+                     "AND COALESCE(created_at, 0) <= ? AND (COALESCE(created_at, 0) < ? OR id < ?) "
+                     "ORDER BY COALESCE(created_at, 0) DESC, id DESC LIMIT 5", ('1', 1, 1, 1))
+    assert 'USING INDEX idx_vedomosti_users_vk_list' in plan, plan
+    assert 'TEMP B-TREE' not in plan, plan
+
+
+def test_vedomosti_version_tracks_list_changes(db):
+    version = migrations.read_vedomosti_version(db)
+    _insert_payments(db, '42', [1])
+    assert migrations.read_vedomosti_version(db) == version + 1
+    db.execute("UPDATE vedomosti_users SET status = NULL, render_version = NULL WHERE vk_id = '42'")
+    db.commit()
+    assert migrations.read_vedomosti_version(db) == version + 2
+    # Столбцы, которых нет в списке, счётчик не меняют
+    db.execute("UPDATE vedomosti_users SET rendered_text = 'x', warning_sent = 1")
+    db.commit()
+    assert migrations.read_vedomosti_version(db) == version + 2
+    db.execute("DELETE FROM vedomosti_users")
+    db.commit()
+    assert migrations.read_vedomosti_version(db) == version + 3
+
+
+def test_statements_registry_keeps_copies_with_same_name(db):
+    rows = [('Био_ЕГЭ_X.csv', 'био егэ x', '/open/Био/ЕГЭ/X', 'open'),
+            ('Био_ЕГЭ_X.csv', 'био егэ x', '/archive/Био/ЕГЭ/Био_ЕГЭ_X.zip', 'archive')]
+    db.executemany("INSERT INTO statements(filename, normalized_name, folder, location) VALUES (?,?,?,?)", rows)
+    db.commit()
+    assert sorted(row[0] for row in db.execute("SELECT location FROM statements")) == ['archive', 'open']
+    with pytest.raises(sqlite3.IntegrityError):
+        db.execute("INSERT INTO statements(filename, normalized_name, folder, location) VALUES (?,?,?,?)", rows[0])
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'statements_fts'").fetchone():
+        found = db.execute("SELECT rowid FROM statements_fts WHERE statements_fts MATCH '\"егэ x\"'").fetchall()
+        assert len(found) == 2
+
+
+def test_stale_render_files_skip_current_and_failed_versions(db):
+    rows = [('a.csv', '/p/a1', 1), ('a.csv', '/p/a2', -1), ('b.csv', '/p/b1', None), ('c.csv', '/p/c1', 0),
+            ('d.csv', '/p/d1', -1), ('e.csv', '', None), ('f.csv', '/p/f1', 2)]
+    db.executemany("INSERT INTO vedomosti_users(vk_id, original_filename, personal_path, render_version) "
+                   "VALUES ('1', ?, ?, ?)", rows)
+    db.commit()
+    assert sorted(migrations.select_stale_render_files(db, (1, -1))) == ['b.csv', 'c.csv', 'f.csv']
+    plan = _plan(db, "SELECT original_filename FROM vedomosti_users WHERE personal_path != '' "
+                     "AND render_version > ? AND render_version < ?", (-1, 1))
+    assert 'USING INDEX idx_vedomosti_users_render_version' in plan, plan
+
+
+def test_vk_sessions_flow_reset_uses_index(db):
+    plan = _plan(db, "UPDATE vk_sessions SET flow_payment_id = NULL WHERE flow_payment_id = ?", ('x',))
+    assert 'USING INDEX idx_vk_sessions_flow_payment' in plan, plan
+
+
+def test_failed_migration_raises_and_resumes(tmp_path, monkeypatch):
+    path = str(tmp_path / 'hosting.db')
+    calls = []
+
+    def broken(conn):
+        calls.append(1)
+        conn.execute("CREATE TABLE half_done (id INTEGER)")
+        raise RuntimeError('boom')
+
+    last = migrations.SCHEMA_VERSION
+    monkeypatch.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS + [(last + 1, 'broken', broken, False)])
+    monkeypatch.setattr(migrations, 'SCHEMA_VERSION', last + 1)
+    with pytest.raises(RuntimeError):
+        migrations.apply_migrations(path)
+
+    conn = sqlite3.connect(path)
+    # Предыдущие миграции применены, упавшая откатилась целиком
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == last
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+    conn.close()
+
+    monkeypatch.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS[:-1] + [(last + 1, 'fixed', lambda conn: None, False)])
+    assert migrations.apply_migrations(path) == last + 1
+
+
+def test_unique_import_states_resume_from_checkpoint(tmp_path, monkeypatch):
+    path = str(tmp_path / 'hosting.db')
+    migrations.apply_migrations(path)
+    conn = sqlite3.connect(path)
+    rows = [(str(i), f'{kind}:Физ_ЕГЭ.csv', kind, 'Физ_ЕГЭ.csv')
+            for i in range(10) for kind in ('imported', 'repet_imported')]
+    conn.executemany("INSERT INTO vedomosti_users(vk_id, state, state_kind, payment_uuid) VALUES (?,?,?,?)", rows)
+    conn.execute("DELETE FROM migration_checkpoints")
+    conn.execute("PRAGMA user_version = 4")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(migrations, 'BACKFILL_CHUNK_PAUSE', 0)
+
+    starts = []
+    fail_at = [3]
+
+    def interrupted(conn, last_id, chunk_size):
+        starts.append(last_id)
+        if len(starts) == fail_at[0]:
+            raise RuntimeError('killed')
+        return migrations._unique_import_states(conn, last_id, chunk_size)
+
+    original = migrations.MIGRATIONS
+    monkeypatch.setattr(migrations, 'MIGRATIONS', [
+        (n, name, interrupted if name == 'unique_import_states' else func, chunked)
+        for n, name, func, chunked in original])
+    with pytest.raises(RuntimeError):
+        migrations.apply_migrations(path, chunk_size=4)
+    assert starts == [0, 4, 8]
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 4
+    assert conn.execute("SELECT last_id FROM migration_checkpoints WHERE name = 'unique_import_states'").fetchone() == (8,)
+    # Первые две порции уже переписаны и при продолжении не трогаются
+    done = dict(conn.execute("SELECT id, state FROM vedomosti_users WHERE id <= 8"))
+    conn.close()
+
+    starts.clear()
+    fail_at[0] = None
+    assert migrations.apply_migrations(path, chunk_size=4) == migrations.SCHEMA_VERSION
+    assert starts[0] == 8
+
+    conn = sqlite3.connect(path)
+    result = conn.execute("SELECT id, state, state_kind, payment_uuid FROM vedomosti_users").fetchall()
+    conn.close()
+    assert {db_id: state for db_id, state, _, _ in result if db_id <= 8} == done
+    assert len({payment_uuid for _, _, _, payment_uuid in result}) == len(rows)
+    for _, state, kind, payment_uuid in result:
+        assert state == f'{kind}:{payment_uuid}'
+        assert migrations.split_vedomosti_state(state) == (kind, payment_uuid)
@@ -0,0 +1,29 @@
+import pytest
+
+import payment_render
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, 0.0),
+    ('', 0.0),
+    ('  ', 0.0),
+    (float('nan'), 0.0),
+    ('nan', 0.0),
+    ('1500', 1500.0),
+    ('1500,5', 1500.5),
+    ('1 000', 1000.0),
+    ('1\xa0000', 1000.0),
+    ('-0', 0.0),
+    (42, 42.0),
+    ('не указано', None),
+    ('12р', None),
+])
+def test_parse_amount(value, expected):
+    assert payment_render.parse_amount(value) == expected
+
+
+def test_curator_template_matches_reference_renderer():
+    from benchmarks import bench_payment_render as bench
+
+    rows = bench.edge_rows(2000) + bench.realistic_rows(500)
+    assert bench.find_mismatches(rows) == []
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def publish(tg_bot, monkeypatch):
+    """Публикует строки как /send Физ ЕГЭ 1 после загрузки файла; возвращает (был ли файл в хранилище, ответ)."""
+    notified = []
+    monkeypatch.setattr(tg_bot, 'send_update_notifications', lambda users, name: notified.append((list(users), name)))
+
+    def run(rows):
+        path = _write_csv(os.path.join(tg_bot.UPLOADS_DIR, 'upload.csv'), rows)
+        stored_path, duplicate = tg_bot.store_upload(path)
+        tg_bot.save_current_for_user(1, file_path=stored_path, awaiting_meta=True)
+        replies = []
+
+        async def reply(text):
+            replies.append(text)
+        asyncio.run(tg_bot._process_send_command(1, '/send Физ ЕГЭ 1', reply))
+        return duplicate, replies[-1]
+    run.notified = notified
+    return run
+
+
+def _write_csv(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('vk_id,name,groups,total\n')
+        for row in rows:
+            f.write(','.join(map(str, row)) + '\n')
+    return path
+
+
+def _db_rows(tg):
+    conn = sqlite3.connect(tg.DB_PATH)
+    try:
+        return conn.execute("SELECT vk_id, personal_path FROM vedomosti_users ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+
+def _store_files(tg):
+    return sorted(name for _, _, names in os.walk(tg.UPLOADS_STORE_DIR) for name in names)
+
+
+ROWS = [(100001, 'Иванова', 'g1', 1000), (100002, 'Петров', 'g2', 2000), (100003, 'Сидорова', 'g3', 3000)]
+
+
+def test_same_upload_is_stored_once(tg_bot):
+    first = _write_csv(os.path.join(tg_bot.UPLOADS_DIR, 'a.csv'), ROWS)
+    stored, duplicate = tg_bot.store_upload(first)
+    assert not duplicate and not os.path.exists(first)
+    assert os.path.basename(stored) == tg_bot.file_sha256(stored) + '.csv'
+
+    second = _write_csv(os.path.join(tg_bot.UPLOADS_DIR, 'b.csv'), ROWS)
+    assert tg_bot.store_upload(second) == (stored, True)
+    assert not os.path.exists(second)
+
+    other = _write_csv(os.path.join(tg_bot.UPLOADS_DIR, 'c.csv'), ROWS[:1])
+    assert tg_bot.store_upload(other)[0] != stored
+    assert len(_store_files(tg_bot)) == 2
+
+
+def test_republish_imports_only_new_rows(tg_bot, publish):
+    assert publish(ROWS)[0] is False
+    first = _db_rows(tg_bot)
+    assert [vk_id for vk_id, _ in first] == ['100001', '100002', '100003']
+
+    # Тот же файл: ни новых строк БД, ни уведомлений
+    duplicate, reply = publish(ROWS)
+    assert duplicate is True and 'без изменений' in reply
+    assert _db_rows(tg_bot) == first and publish.notified == []
+
+    # Изменилась одна сумма и добавился куратор: импортируется только новая строка
+    changed = [ROWS[0], ROWS[1][:3] + (2500,), ROWS[2], (100004, 'Новиков', 'g4', 4000)]
+    duplicate, reply = publish(changed)
+    assert duplicate is False and 'обновлена' in reply
+    rows = _db_rows(tg_bot)
+    assert rows[:3] == first and [vk_id for vk_id, _ in rows[3:]] == ['100004']
+    assert publish.notified == [(['100002'], 'Физ_ЕГЭ_1')]
+    with open(rows[1][1], encoding='utf-8') as f:
+        assert '2500' in f.read()
+    assert len(_store_files(tg_bot)) == 2
+
+
+@pytest.mark.parametrize('import_new, updated, imported', [
+    # /update: строка с новыми группами - правка прежней строки того же vk_id
+    (None, ['100001'], []),
+    # Публикация: это новая выплата куратора, прежняя строка не трогается
+    ('record', [], ['100001']),
+])
+def test_vk_id_match_only_without_import(tg_bot, publish, import_new, updated, imported):
+    publish(ROWS)
+    folder = os.path.join(tg_bot.HOSTING_ROOT, tg_bot.OPEN_DIRNAME, 'Физ', 'ЕГЭ', '1')
+    new_csv = _write_csv(os.path.join(str(tg_bot.UPLOADS_DIR), 'new.csv'),
+                         [(100001, 'Иванова', 'g9', 1500), ROWS[1], ROWS[2]])
+    seen = []
+
+    def record(path, original_filename):
+        with open(path, encoding='utf-8') as f:
+            seen.extend(line.split(',')[0] for line in f.read().splitlines()[1:])
+
+    ok, updated_users = tg_bot.update_statement_data(folder, 'Физ_ЕГЭ_1.csv', new_csv,
+                                                     import_new=record if import_new else None)
+    assert ok
+    assert updated_users == updated
+    assert seen == imported
@@ -0,0 +1,41 @@
+import os
+
+
+def _open_statement(tg, subject, kind, filename):
+    folder = os.path.join(tg.HOSTING_ROOT, 'open', subject, kind, os.path.splitext(filename)[0])
+    os.makedirs(folder)
+    with open(os.path.join(folder, filename), 'w', encoding='utf-8') as f:
+        f.write('vk_id,total\n')
+    tg.register_statement(filename, folder)
+    return folder
+
+
+def test_action_commands_need_exact_statement_name(tg_bot):
+    folder = _open_statement(tg_bot, 'Физ', 'ЕГЭ', 'Физ_ЕГЭ_1.csv')
+    _open_statement(tg_bot, 'Физ', 'ЕГЭ', 'Физ_ЕГЭ_10.csv')
+
+    assert tg_bot.resolve_statement_for_action('физ егэ 1') == ((folder, 'Физ_ЕГЭ_1.csv'), [])
+
+    found, candidates = tg_bot.resolve_statement_for_action('Физ ЕГЭ')
+    assert found is None
+    assert sorted(name for _, name in candidates) == ['Физ_ЕГЭ_1.csv', 'Физ_ЕГЭ_10.csv']
+    text = tg_bot.statement_candidates_text('Физ ЕГЭ', candidates)
+    assert '• Физ_ЕГЭ_1' in text and '• Физ_ЕГЭ_10' in text
+
+    assert tg_bot.resolve_statement_for_action('Хим ОГЭ') == (None, [])
+
+
+def test_batch_runs_of_same_upload_use_separate_dirs(tg_bot, monkeypatch):
+    seen = []
+
+    def fake_split(path, batch_dir, default_kind):
+        assert os.path.isdir(batch_dir)
+        seen.append(batch_dir)
+        return [], []
+    monkeypatch.setattr(tg_bot, 'split_batch_upload', fake_split)
+
+    upload = os.path.join(tg_bot.UPLOADS_STORE_DIR, 'abc123.xlsx')
+    tg_bot.publish_batch(upload, 1)
+    tg_bot.publish_batch(upload, 1)
+    assert len(set(seen)) == 2
+    assert all(os.path.basename(d).startswith('abc123-') and not os.path.exists(d) for d in seen)
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+import snapshot
+
+
+@pytest.fixture
+def csv_cache(vk_bot, tmp_path, monkeypatch):
+    """VK бот с пустыми кэшами строк CSV и снимком во временном каталоге."""
+    monkeypatch.setattr(vk_bot, 'csv_row_cache', vk_bot.LRUStore(vk_bot.CSV_CACHE_MAX_BYTES, weigh=lambda e: e.nbytes))
+    monkeypatch.setattr(vk_bot, '_snapshot_checks', vk_bot.LRUStore(100))
+    monkeypatch.setattr(vk_bot, 'statement_snapshot', snapshot.SnapshotHandle(str(tmp_path / 'statements.snap')))
+    return vk_bot
+
+
+@pytest.fixture
+def reads(csv_cache, monkeypatch):
+    """Пути персональных файлов, которые get_cached_csv_row прочитал с диска."""
+    paths = []
+    read_csv_rows = csv_cache.read_csv_rows
+
+    def counting_read(path, *args, **kwargs):
+        paths.append(path)
+        return read_csv_rows(path, *args, **kwargs)
+    monkeypatch.setattr(csv_cache, 'read_csv_rows', counting_read)
+    return paths
+
+
+def _write_personal(path, total, mtime_ns):
+    path.write_text(f'vk_id,total\n123456,{total}\n', encoding='utf-8')
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    return str(path)
+
+
+def _snapshot(vk, paths, row):
+    records = []
+    for path, mtime_ns in paths:
+        st = os.stat(path)
+        records.append((123456, path, st.st_mtime_ns if mtime_ns is None else mtime_ns, st.st_size, row))
+    snapshot.write_snapshot(vk.statement_snapshot.path, records, 1)
+    assert vk.statement_snapshot.check()
+
+
+def test_fresh_snapshot_row_is_served_without_reading_file(csv_cache, reads, tmp_path):
+    path = _write_personal(tmp_path / 'a.csv', 100, 1_700_000_000_000_000_000)
+    _snapshot(csv_cache, [(path, None)], {'vk_id': '123456', 'total': 'из снимка'})
+
+    assert csv_cache.get_cached_csv_row(path)['total'] == 'из снимка'
+    assert csv_cache.get_cached_csv_row(path)['total'] == 'из снимка'
+    assert reads == []
+    assert csv_cache.statement_snapshot.stats()['hits'] == 2
+
+
+def test_stale_snapshot_falls_back_to_file(csv_cache, reads, tmp_path):
+    path = _write_personal(tmp_path / 'a.csv', 100, 1_700_000_000_000_000_000)
+    # Снимок собран по прежней версии файла
+    _snapshot(csv_cache, [(path, 1_600_000_000_000_000_000)], {'vk_id': '123456', 'total': 'из снимка'})
+
+    assert csv_cache.get_cached_csv_row(path)['total'] == '100'
+    assert csv_cache.get_cached_csv_row(path)['total'] == '100'
+    # Второй раз строка берётся из csv_row_cache
+    assert reads == [path]
+
+
+def test_file_rewritten_after_snapshot_is_reread_after_interval(csv_cache, reads, tmp_path, monkeypatch):
+    path = _write_personal(tmp_path / 'a.csv', 100, 1_700_000_000_000_000_000)
+    _snapshot(csv_cache, [(path, None)], {'vk_id': '123456', 'total': 'из снимка'})
+    assert csv_cache.get_cached_csv_row(path)['total'] == 'из снимка'
+
+    _write_personal(tmp_path / 'a.csv', 2500, 1_700_000_000_500_000_000)
+    # До истечения интервала сверки отдаётся проверенная запись снимка
+    assert csv_cache.get_cached_csv_row(path)['total'] == 'из снимка'
+    monkeypatch.setattr(csv_cache, 'CSV_CACHE_REVALIDATE_INTERVAL', 0)
+    assert csv_cache.get_cached_csv_row(path)['total'] == '2500'
+    assert reads == [path]
+
+    # Следующая правка файла замечается уже сверкой csv_row_cache
+    _write_personal(tmp_path / 'a.csv', 31337, 1_700_000_001_000_000_000)
+    assert csv_cache.get_cached_csv_row(path)['total'] == '31337'
+    assert reads == [path, path]
+
+
+def test_unchanged_file_is_not_reread_on_revalidation(csv_cache, reads, tmp_path, monkeypatch):
+    path = _write_personal(tmp_path / 'a.csv', 100, 1_700_000_000_000_000_000)
+    monkeypatch.setattr(csv_cache, 'CSV_CACHE_REVALIDATE_INTERVAL', 0)
+    first = csv_cache.get_cached_csv_row(path)
+    assert csv_cache.get_cached_csv_row(path) is first
+    assert reads == [path]
+
+
+def test_empty_or_missing_personal_file(csv_cache, tmp_path, monkeypatch):
+    empty = tmp_path / 'empty.csv'
+    empty.write_text('vk_id,total\n', encoding='utf-8')
+    assert csv_cache.get_cached_csv_row(str(empty)) is None
+    assert csv_cache.get_cached_csv_row(str(tmp_path / 'missing.csv')) is None
+
+    # Файл из снимка удалён: запись снимка не отдаётся, а закэшированная строка выбрасывается
+    path = _write_personal(tmp_path / 'a.csv', 100, 1_700_000_000_000_000_000)
+    other = _write_personal(tmp_path / 'b.csv', 200, 1_700_000_000_000_000_000)
+    _snapshot(csv_cache, [(path, None)], {'vk_id': '123456', 'total': 'из снимка'})
+    assert csv_cache.get_cached_csv_row(other)['total'] == '200'
+    monkeypatch.setattr(csv_cache, 'CSV_CACHE_REVALIDATE_INTERVAL', 0)
+    os.remove(path)
+    os.remove(other)
+    assert csv_cache.get_cached_csv_row(path) is None
+    assert csv_cache.get_cached_csv_row(other) is None
+    assert csv_cache.csv_row_cache.peek(other) is None
@@ -0,0 +1,78 @@
+import pytest
+
+
+@pytest.fixture
+def lru(vk_bot):
+    """Фабрика LRUStore с весом по длине списка и журналом вытесненных ключей."""
+    def make(max_weight):
+        evicted = []
+        store = vk_bot.LRUStore(max_weight, weigh=len, on_evict=evicted.append)
+        return store, evicted
+    return make
+
+
+def test_eviction_bounded_by_weight(lru):
+    store, evicted = lru(5)
+    store.set('a', [1, 2])
+    store.set('b', [1, 2])
+    assert store.weight == 4 and evicted == []
+    store.set('c', [1, 2])
+    # Вытесняется самый давний ключ, пока вес не уложится в лимит
+    assert evicted == ['a'] and [key for key, _ in store.items()] == ['b', 'c']
+    assert store.weight == 4 and store.stats()['evictions'] == 1
+
+    store.set('d', [1, 2, 3, 4, 5])
+    assert evicted == ['a', 'b', 'c'] and store.weight == 5
+    # Один элемент тяжелее лимита остаётся: самый свежий ключ не вытесняется
+    store.set('e', list(range(7)))
+    assert evicted == ['a', 'b', 'c', 'd'] and len(store) == 1 and store.weight == 7
+
+
+def test_get_refreshes_and_peek_does_not(lru):
+    store, evicted = lru(3)
+    for key in 'abc':
+        store.set(key, [key])
+    assert store.get('a') == ['a']
+    assert store.peek('b') == ['b']
+    store.set('d', ['d'])
+    assert evicted == ['b']
+    store.set('c', ['c2'], touch=False)
+    store.set('e', ['e'])
+    assert evicted == ['b', 'c']
+    assert store.get('missing') is None
+    stats = store.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_on_evict_only_for_evicted_keys(lru):
+    store, evicted = lru(2)
+    store.set('a', [1])
+    store.set('b', [1])
+    assert store.pop('a') == [1]
+    assert store.pop('a', 'gone') == 'gone'
+    store.set('b', [1, 2])
+    assert evicted == [] and store.weight == 2
+    store.set('c', [1])
+    assert evicted == ['b'] and 'b' not in store
+
+
+def test_update_reweighs_value(lru):
+    store, evicted = lru(6)
+    store.set('a', [1, 2])
+    store.set('b', [1, 2])
+    store.set('a', [1])
+    assert store.weight == 3
+
+    # append пересчитывает вес списка и поднимает ключ
+    store.append('b', 3)
+    store.append('c', 1)
+    assert store.peek('b') == [1, 2, 3] and store.weight == 5
+    store.append('c', 2)
+    assert store.weight == 6 and evicted == []
+    store.append('b', 4)
+    assert evicted == ['a'] and store.weight == 6
+
+    # Замена на более тяжёлое значение вытесняет остальные
+    store.set('c', [1, 2, 3, 4, 5])
+    assert evicted == ['a', 'b'] and store.weight == 5
+    assert [key for key, _ in store.items()] == ['c']
@@ -0,0 +1,77 @@
+import sqlite3
+
+import pytest
+
+
+def _add_imported_row(vk, tmp_path, vk_id, payment_uuid, created_at):
+    personal_path = tmp_path / f'{payment_uuid}.csv'
+    personal_path.write_text(f'vk_id,ФИО,Группы,total\n{vk_id},Иванова А.,Г1,1500\n', encoding='utf-8')
+    conn = sqlite3.connect(vk.DB_PATH)
+    try:
+        cur = conn.execute(
+            "INSERT INTO vedomosti_users(vk_id, personal_path, original_filename, state, state_kind, payment_uuid, "
+            "created_at, total) VALUES (?, ?, 'Физ_ЕГЭ_1.csv', ?, 'imported', ?, ?, 1500)",
+            (str(vk_id), str(personal_path), f'imported:{payment_uuid}', payment_uuid, created_at))
+        conn.commit()
+        return cur.lastrowid
+    finally:
+        conn.close()
+
+
+def test_opened_list_item_is_served_from_memory(vk_bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(vk_bot, 'STARTUP_HYDRATION', 'lazy')
+    db_id = _add_imported_row(vk_bot, tmp_path, 100001, 'u-1', 1700000000)
+    _add_imported_row(vk_bot, tmp_path, 100001, 'u-2', 1700000001)
+
+    listed = {item['id'] for item in vk_bot.get_payment_summaries_for_user(100001)}
+    assert f'u-1_{db_id}' in listed
+
+    opened = vk_bot.find_payment(100001, f'u-1_{db_id}')
+    in_memory = vk_bot.user_payments.peek(100001)
+    assert any(record is opened for record in in_memory)
+    assert {record['id'] for record in in_memory} == listed
+    assert opened['db_id'] == db_id and opened['original_payment_id'] == 'u-1'
+
+    # Повторное открытие не ходит в БД
+    def no_db(*args, **kwargs):
+        raise AssertionError('find_payment went to the DB')
+    monkeypatch.setattr(vk_bot.sqlite3, 'connect', no_db)
+    monkeypatch.setattr(vk_bot.vk_sessions, 'apply_flow', lambda user_id, payment: None)
+    assert vk_bot.find_payment(100001, f'u-1_{db_id}') is opened
+
+
+def test_payment_record_contains_fields_like_dict(vk_bot):
+    record = vk_bot.PaymentRecord(id='u-1', data=vk_bot.PaymentData(fio='x'), status='new')
+    for key in ('id', 'data', 'status', 'db_id', 'original_payment_id', 'disagree_reason', 'created_at'):
+        assert key in record
+    assert record['db_id'] is None and record.get('db_id', 'default') is None
+    assert 'unknown' not in record and record.get('unknown', 'default') == 'default'
+    with pytest.raises(KeyError):
+        record['unknown']
+    with pytest.raises(KeyError):
+        record['unknown'] = 1
+
+
+def test_payment_data_behaves_like_dict(vk_bot):
+    items = {'fio': 'Иванова А.', 'mail': '', 'total': '1500', 'chats': None}
+    data = vk_bot.PaymentData(items)
+    assert data.to_dict() == {'fio': 'Иванова А.', 'mail': '', 'total': '1500'}
+    assert 'mail' in data and data['mail'] == '' and data.get('mail', 'default') == ''
+    assert 'chats' not in data and data.get('chats') is None
+    data['chats'] = '55'
+    assert data['chats'] == '55' and list(data) == ['fio', 'mail', 'total', 'chats']
+
+
+def test_payment_shapes_keyed_by_columns_and_bounded(vk_bot, monkeypatch):
+    monkeypatch.setattr(vk_bot, '_payment_shapes', {})
+    monkeypatch.setattr(vk_bot, 'PAYMENT_SHAPES_MAX', 3)
+    rows = [{'ФИО': 'А', 'total': '1'}, {'ФИО': '', 'total': ''}, {'ФИО': 'Б', 'chats': '5'}, {}]
+    mapped = [vk_bot._map_row_to_payment_data(row, 1, 'Физ_ЕГЭ_1.csv') for row in rows]
+    # Пустые и заполненные значения одних столбцов - одна форма
+    assert len(vk_bot._payment_shapes) == 1
+    assert len({id(data._shape) for data in mapped}) == 1
+    assert mapped[1]['fio'] == '' and mapped[2]['chats'] == '5'
+
+    extra = [vk_bot.PaymentData({f'k{i}': 'v'}) for i in range(10)]
+    assert len(vk_bot._payment_shapes) == 3
+    assert [data[f'k{i}'] for i, data in enumerate(extra)] == ['v'] * 10
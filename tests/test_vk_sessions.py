@@ -0,0 +1,78 @@
+import sqlite3
+import time
+
+import migrations
+
+
+def _db_session(vk, vk_id):
+    conn = sqlite3.connect(vk.DB_PATH)
+    try:
+        return conn.execute("SELECT last_payment_id, flow_payment_id, flow_status FROM vk_sessions WHERE vk_id = ?",
+                            (str(vk_id),)).fetchone()
+    finally:
+        conn.close()
+
+
+def _reset_from_tg(vk, rows):
+    """То, что делает update_statement_data TG бота для строк, переписанных /update."""
+    conn = sqlite3.connect(vk.DB_PATH)
+    try:
+        migrations.reset_session_flows(conn, rows, time.time())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_flush_writes_session_and_restart_restores_it(vk_bot):
+    store = vk_bot.SessionStore(100, 60)
+    store.set_last_opened(100001, 'u1_1')
+    store.set_flow(100001, 'u1_1', 'agree_pending_verify')
+    assert store.flush() == 1
+    assert _db_session(vk_bot, 100001) == ('u1_1', 'u1_1', 'agree_pending_verify')
+
+    restarted = vk_bot.SessionStore(100, 60)
+    assert restarted.get(100001)[:3] == ('u1_1', 'u1_1', 'agree_pending_verify')
+
+
+def test_flush_after_update_does_not_restore_reset_step(vk_bot):
+    store = vk_bot.SessionStore(100, 60)
+    store.set_flow(100001, 'u1_1', 'agree_pending_verify')
+    store.set_flow(100002, 'u2_2', 'agree_pending_pro')
+    time.sleep(0.01)
+    # /update переписал строку первого пользователя до того, как шаг попал в БД
+    _reset_from_tg(vk_bot, [('100001', 'u1', 1)])
+    store.flush()
+
+    assert _db_session(vk_bot, 100001)[1:] == (None, None)
+    assert store.get(100001)[1:3] == (None, None)
+    assert _db_session(vk_bot, 100002)[1:] == ('u2_2', 'agree_pending_pro')
+
+
+def test_step_chosen_after_update_is_written(vk_bot):
+    _reset_from_tg(vk_bot, [('100001', 'u1', 1)])
+    time.sleep(0.01)
+    store = vk_bot.SessionStore(100, 60)
+    store.set_flow(100001, 'u1_1', 'agree_pending_verify')
+    store.flush()
+    assert _db_session(vk_bot, 100001)[1:] == ('u1_1', 'agree_pending_verify')
+
+
+def test_flush_keeps_columns_it_did_not_change(vk_bot):
+    store = vk_bot.SessionStore(100, 60)
+    store.set_flow(100001, 'u1_1', 'agree_pending_verify')
+    store.flush()
+    _reset_from_tg(vk_bot, [('100001', 'u1', 1)])
+    # Открытие другой выплаты меняет только last_payment_id и шаг (сбрасывает его)
+    store.set_last_opened(100001, 'u3_3')
+    store.flush()
+    assert _db_session(vk_bot, 100001) == ('u3_3', None, None)
+
+
+def test_apply_flow_skips_step_cleared_by_update(vk_bot):
+    store = vk_bot.SessionStore(100, 60)
+    store.set_flow(100001, 'u1_1', 'agree_pending_verify')
+    store.flush()
+    _reset_from_tg(vk_bot, [('100001', 'u1', 1)])
+    payment = {'id': 'u1_1', 'status': 'new'}
+    store.apply_flow(100001, payment)
+    assert payment['status'] == 'new'